@@ -0,0 +1,232 @@
+# Columnar alternative to steps 3-5 (associate_each_paper, author_topic,
+# corpus_topic, specific_topic, corpus_specific_topic). The columns those
+# stages need are exported once from papers and annotated_papers to Parquet,
+# read back memory-mapped, and the join -> explode -> group-by-union -> filter
+# chain runs as pyarrow compute over list and dictionary-encoded arrays. Only
+# the collections the backend reads are bulk-loaded; temp_* collections and
+# corpus_topics are never written unless asked for with --collections.
+#
+# Requires pyarrow (pip install pyarrow).
+
+import argparse
+import logging
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from bson import ObjectId
+import numpy as np
+
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from metrics import stage_metrics
+from profiling import phase, profiled
+from specific_topic import load_specific_topics, SPECIFIC_TOPICS_FILE
+
+WORK_DIR = "Output/arrow"
+EXPORT_BATCH_SIZE = 50000
+LOAD_BATCH_SIZE = 1000
+PAPERS_COLLECTION = "papers"
+ANNOTATIONS_COLLECTION = "annotated_papers"
+PAPER_FIELDS = {"corpusid": 1, "authors.authorId": 1}
+ANNOTATION_FIELDS = {"_id": 0, "corpusid": 1, "syntactic": 1, "semantic": 1, "enhanced": 1, "union": 1}
+ANNOTATION_KEYS = ["syntactic", "semantic", "enhanced", "union"]
+FINAL_COLLECTIONS = ["author_paper_topics", "author_topics", "author_specific_topics", "corpus_specific_topics"]
+ALL_COLLECTIONS = FINAL_COLLECTIONS + ["corpus_topics"]
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+def paper_schema():
+    return pa.schema([
+        ("paperId", pa.binary(12)),
+        ("corpusid", pa.int64()),
+        ("authorIds", pa.list_(pa.string()))
+    ])
+
+def annotation_schema():
+    return pa.schema([
+        ("corpusid", pa.int64()),
+        ("topics", pa.list_(pa.string()))
+    ])
+
+def paper_row(doc):
+    return {
+        "paperId": doc["_id"].binary if isinstance(doc.get("_id"), ObjectId) else None,
+        "corpusid": doc.get("corpusid"),
+        "authorIds": [author.get("authorId") for author in doc.get("authors") or []]
+    }
+
+def annotation_row(doc):
+    topics = set()
+    for key in ANNOTATION_KEYS:
+        topics.update(doc.get(key, []))
+    return {"corpusid": doc["corpusid"], "topics": list(topics)}
+
+def export_collection(storage, name, projection, to_row, schema, path):
+    metrics = stage_metrics()
+    rows = []
+    total = 0
+    with pq.ParquetWriter(path + ".tmp", schema) as writer:
+        for doc in storage.find(name, projection = projection, batch_size = EXPORT_BATCH_SIZE):
+            rows.append(to_row(doc))
+            if len(rows) >= EXPORT_BATCH_SIZE:
+                writer.write_table(pa.Table.from_pylist(rows, schema = schema))
+                metrics.inc("docs_read_total", len(rows), collection = name)
+                total += len(rows)
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema = schema))
+            metrics.inc("docs_read_total", len(rows), collection = name)
+            total += len(rows)
+    os.replace(path + ".tmp", path)
+    logging.info(f"[{name}] Exported {total:,} documents to {path}")
+
+def read_parquet(path):
+    return pq.read_table(path, memory_map = True)
+
+def explode(table, column, keep):
+    # One row per list element, the other columns repeated by parent index.
+    parents = pc.list_parent_indices(table[column])
+    exploded = table.select(keep).take(parents)
+    return exploded.append_column(column, pc.list_flatten(table[column]))
+
+def author_paper_topics(papers, annotations):
+    # Hash join via index_in. Annotations are searched newest-first so a
+    # duplicated corpusid resolves to its last document, as the dict in
+    # associate_each_paper does.
+    annotations = annotations.take(pa.array(np.arange(annotations.num_rows - 1, -1, -1)))
+    positions = pc.index_in(papers["corpusid"], value_set = annotations["corpusid"].combine_chunks())
+    papers = papers.append_column("_annotation", positions).filter(pc.is_valid(positions))
+    topics = annotations["topics"].take(papers["_annotation"])
+    joined = papers.drop_columns(["_annotation"]).append_column("topics", topics)
+    joined = joined.filter(pc.and_(
+        pc.greater(pc.list_value_length(joined["authorIds"]), 0),
+        pc.greater(pc.list_value_length(joined["topics"]), 0)
+    ))
+    rows = explode(joined, "authorIds", ["paperId", "corpusid", "topics"])
+    return pa.table({
+        "authorId": rows["authorIds"],
+        "paperId": rows["paperId"],
+        "corpusId": rows["corpusid"],
+        "topics": rows["topics"]
+    })
+
+def topic_pairs(table, key):
+    # Distinct (key, topic code) pairs; topics are dictionary-encoded once so
+    # grouping and filtering work on int32 codes instead of strings.
+    valid = pc.is_valid(table[key])
+    if pa.types.is_string(table[key].type):
+        valid = pc.and_(valid, pc.not_equal(table[key], ""))
+    else:
+        valid = pc.and_(valid, pc.not_equal(table[key], 0))
+    table = table.filter(valid)
+    rows = explode(table, "topics", [key])
+    encoded = pa.table({"topic": pc.dictionary_encode(rows["topics"])}).unify_dictionaries()["topic"]
+    if encoded.num_chunks == 0:
+        return pa.table({key: rows[key], "topic": pa.array([], pa.int32())}), pa.array([], pa.string())
+    indices = pa.chunked_array([chunk.indices for chunk in encoded.chunks], pa.int32())
+    pairs = pa.table({key: rows[key], "topic": indices})
+    pairs = pairs.filter(pc.is_valid(pairs["topic"])).group_by([key, "topic"]).aggregate([])
+    return pairs, encoded.chunk(0).dictionary
+
+def union_by_key(pairs, dictionary, key, mask = None):
+    if mask is not None:
+        pairs = pairs.filter(pc.take(mask, pairs["topic"]))
+    grouped = pairs.group_by(key).aggregate([("topic", "list")])
+    codes = grouped["topic_list"].combine_chunks()
+    topics = pa.ListArray.from_arrays(codes.offsets, dictionary.take(codes.values))
+    return pa.table({key: grouped[key], "topics": topics})
+
+def specific_mask(dictionary, specific_topics):
+    return pc.is_in(pc.utf8_lower(dictionary), value_set = pa.array(sorted(specific_topics), pa.string()))
+
+def compute(papers, annotations, specific_topics):
+    tables = {}
+    with phase("join"):
+        tables["author_paper_topics"] = author_paper_topics(papers, annotations)
+    with phase("group"):
+        author_pairs, author_dictionary = topic_pairs(tables["author_paper_topics"], "authorId")
+        corpus_pairs, corpus_dictionary = topic_pairs(tables["author_paper_topics"], "corpusId")
+        tables["author_topics"] = union_by_key(author_pairs, author_dictionary, "authorId")
+        tables["corpus_topics"] = union_by_key(corpus_pairs, corpus_dictionary, "corpusId")
+    with phase("filter"):
+        tables["author_specific_topics"] = union_by_key(
+            author_pairs, author_dictionary, "authorId", specific_mask(author_dictionary, specific_topics)
+        )
+        tables["corpus_specific_topics"] = union_by_key(
+            corpus_pairs, corpus_dictionary, "corpusId", specific_mask(corpus_dictionary, specific_topics)
+        )
+    for name, table in tables.items():
+        logging.info(f"[{name}] {table.num_rows:,} rows")
+    return tables
+
+def to_documents(batch):
+    docs = batch.to_pylist()
+    if "paperId" in batch.schema.names:
+        for doc in docs:
+            doc["paperId"] = ObjectId(doc["paperId"]) if doc["paperId"] is not None else None
+    return docs
+
+def load_collection(storage, name, table):
+    storage.drop(name)
+    prepare_for_load(storage, name)
+    for batch in table.to_batches(max_chunksize = LOAD_BATCH_SIZE):
+        storage.insert_many(name, to_documents(batch))
+    build_indexes(storage, name)
+    logging.info(f"[{name}] Loaded {table.num_rows:,} documents")
+
+def run(storage, work_dir = WORK_DIR, export = True, collections = FINAL_COLLECTIONS,
+        specific_topics_file = SPECIFIC_TOPICS_FILE):
+    if pa is None:
+        raise SystemExit("arrow_pipeline requires pyarrow: pip install pyarrow")
+
+    start_time = time.time()
+    metrics = stage_metrics("arrow_pipeline")
+    os.makedirs(work_dir, exist_ok = True)
+    papers_path = os.path.join(work_dir, "papers.parquet")
+    annotations_path = os.path.join(work_dir, "annotations.parquet")
+
+    with phase("export"):
+        if export or not os.path.exists(papers_path):
+            export_collection(storage, PAPERS_COLLECTION, PAPER_FIELDS, paper_row, paper_schema(), papers_path)
+        if export or not os.path.exists(annotations_path):
+            export_collection(storage, ANNOTATIONS_COLLECTION, ANNOTATION_FIELDS, annotation_row,
+                              annotation_schema(), annotations_path)
+
+    specific_topics = load_specific_topics(specific_topics_file)
+    tables = compute(read_parquet(papers_path), read_parquet(annotations_path), specific_topics)
+
+    with phase("write"):
+        for name in collections:
+            load_collection(storage, name, tables[name])
+    metrics.close()
+    logging.info(f"Columnar pipeline done in {round(time.time() - start_time, 2)} seconds.")
+    return tables
+
+def main(storage):
+    parser = argparse.ArgumentParser(description = "Run steps 3-5 of the import as a columnar pipeline.")
+    parser.add_argument("--work-dir", default = WORK_DIR, help = "Directory for the Parquet exports")
+    parser.add_argument("--reuse-export", action = "store_true",
+                        help = "Reuse existing Parquet exports instead of re-reading the source collections")
+    parser.add_argument("--collections", nargs = "+", choices = ALL_COLLECTIONS, default = FINAL_COLLECTIONS,
+                        help = "Collections to load into the database")
+    parser.add_argument("--specific-topics", default = SPECIFIC_TOPICS_FILE)
+    args = parser.parse_args()
+    run(storage, args.work_dir, not args.reuse_export, args.collections, args.specific_topics)
+
+if __name__ == "__main__":
+    storage = get_storage()
+    try:
+        with profiled("arrow_pipeline"):
+            main(storage)
+    finally:
+        storage.close()
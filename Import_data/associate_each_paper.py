@@ -1,24 +1,32 @@
 # Step 3: Associate each paper with its authors and annotated topics
 
-from pymongo import MongoClient
-from pymongo.errors import BulkWriteError
 from threading import Thread, Lock
 from queue import Queue
 from tqdm import tqdm
 import time
 import logging
-import itertools
+
+from parallel_reader import reader_checkpoint
+from document_access import transfer_meter
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from sharding import current_shard, shard_collection, finish_shard
+from connection import configure_pool
+from metrics import stage_metrics
+from profiling import phase, profiled
 
 BATCH_SIZE = 1000
 NUM_WORKERS = 4             
+NUM_READERS = 4
 QUEUE_MAXSIZE = 1000         
-DB_NAME = "research_db"
 PAPERS_COLLECTION = "papers"
 ANNOTATIONS_COLLECTION = "annotated_papers"
-NEW_COLLECTION = "author_paper_topics"
-
-client = MongoClient("mongodb://localhost:27017/")
-db = client[DB_NAME]
+NEW_COLLECTION = shard_collection("author_paper_topics")
+PAPER_FIELDS = {"corpusid": 1, "authors.authorId": 1}
+ANNOTATION_FIELDS = {"_id": 0, "corpusid": 1, "syntactic": 1, "semantic": 1, "enhanced": 1, "union": 1}
+# A resumed run re-reads the ranges that were not checkpointed, some of which
+# were partly written: documents are then replaced by this key, not inserted.
+RESUME_KEY = ["authorId", "paperId"]
 
 batch_queue = Queue(maxsize = QUEUE_MAXSIZE)
 pbar_lock = Lock()
@@ -32,105 +40,131 @@ def safe_update_pbar(pbar):
     with pbar_lock:
         pbar.update(1)
 
-def load_all_annotations():
-    logging.info("Préchargement des annotations...")
+def load_all_annotations(storage, meter = None):
+    logging.info("Preloading annotations ...")
     annotations = {}
-    cursor = db[ANNOTATIONS_COLLECTION].find({}, {
-        "corpusid": 1,
-        "syntactic": 1,
-        "semantic": 1,
-        "enhanced": 1,
-        "union": 1
-    })
+    cursor = storage.find(ANNOTATIONS_COLLECTION, projection = ANNOTATION_FIELDS, raw = True)
     for doc in cursor:
+        if meter:
+            meter.add(ANNOTATIONS_COLLECTION, [doc])
         corpusid = doc["corpusid"]
         topics = set()
         for key in ["syntactic", "semantic", "enhanced", "union"]:
             topics.update(doc.get(key, []))
         annotations[corpusid] = list(topics)
-    logging.info(f"{len(annotations)} annotations chargées en mémoire.")
+    logging.info(f"{len(annotations)} annotations loaded in memory.")
     return annotations
 
-def safe_insert_many(docs, batch_size = 500):
-    for i in range(0, len(docs), batch_size):
-        try:
-            db[NEW_COLLECTION].insert_many(docs[i : i + batch_size], ordered = False)
-        except BulkWriteError as e:
-            logging.warning("Bulk write error: %s", e.details)
-
-def worker(worker_id, pbar, annotations):
+def author_paper_topic_docs(paper_batch, annotations):
+    local_docs = []
+    for paper in paper_batch:
+        corpusid = paper.get("corpusid")
+        authors = paper.get("authors", [])
+        topics = annotations.get(corpusid)
+        if not topics or not authors:
+            continue
+
+        for author in authors:
+            doc = {
+                "authorId": author.get("authorId"),
+                "paperId": paper.get("_id"),
+                "corpusId": corpusid,
+                "topics": topics
+            }
+            local_docs.append(doc)
+    return local_docs
+
+def worker(worker_id, storage, pbar, annotations, resuming = False):
     while True:
         paper_batch = batch_queue.get()
         if paper_batch is None:
             break
 
-        local_docs = []
-        for paper in paper_batch:
-            corpusid = paper.get("corpusid")
-            authors = paper.get("authors", [])
-            topics = annotations.get(corpusid)
-            if not topics or not authors:
-                continue
-
-            for author in authors:
-                doc = {
-                    "authorId": author.get("authorId"),
-                    "paperId": paper.get("_id"),
-                    "corpusId": corpusid,
-                    "topics": topics
-                }
-                local_docs.append(doc)
-
-        if local_docs:
-            safe_insert_many(local_docs)
-
-        batch_queue.task_done()
-        safe_update_pbar(pbar)
-
-    logging.info(f"[Worker-{worker_id}] terminé.")
-
-def chunked_cursor(cursor, size):
-    while True:
-        batch = list(itertools.islice(cursor, size))
-        if not batch:
-            break
-        yield batch
-
-def producer():
-    cursor = db[PAPERS_COLLECTION].find({}, no_cursor_timeout = True).batch_size(BATCH_SIZE)
+        batch_start = time.perf_counter()
+        try:
+            local_docs = author_paper_topic_docs(paper_batch, annotations)
+            if local_docs and resuming:
+                storage.upsert_many(NEW_COLLECTION, RESUME_KEY, local_docs)
+            elif local_docs:
+                storage.insert_many(NEW_COLLECTION, local_docs)
+        except Exception as e:
+            logging.error(f"[Worker-{worker_id}] Batch failed: {e}")
+            stage_metrics().inc("batch_errors_total")
+        finally:
+            stage_metrics().record_batch(worker_id, time.perf_counter() - batch_start)
+            batch_queue.task_done()
+            safe_update_pbar(pbar)
+
+    logging.info(f"[Worker-{worker_id}] done.")
+
+def producer(reader):
     batch_count = 0
-    try:
-        for batch in chunked_cursor(cursor, BATCH_SIZE):
-            batch_queue.put(batch)
-            batch_count += 1
-        logging.info(f"[Producteur] {batch_count} batches envoyés à la file.")
-    finally:
-        cursor.close()
+    for batch in reader.batches(barrier = batch_queue.join):
+        batch_queue.put(batch)
+        stage_metrics().set("queue_depth", batch_queue.qsize())
+        batch_count += 1
+    logging.info(f"[Producer] {batch_count} batches queued.")
 
-if __name__ == "__main__":
+def run(storage):
     start_time = time.time()
-
-    db[NEW_COLLECTION].drop()
-    logging.info("Collection cible vidée.")
-
-    total_docs = db[PAPERS_COLLECTION].estimated_document_count()
+    metrics = stage_metrics("associate_each_paper")
+    configure_pool(workers = NUM_WORKERS, readers = NUM_READERS)
+
+    meter = transfer_meter("associate_each_paper")
+    reader = storage.reader(
+        PAPERS_COLLECTION,
+        projection = PAPER_FIELDS,
+        num_ranges = NUM_READERS,
+        batch_size = BATCH_SIZE,
+        checkpoint_file = reader_checkpoint("associate_each_paper"),
+        raw = True,
+        meter = meter,
+        shard = current_shard(),
+        shard_key = "corpusid"
+    )
+    if not reader.resuming:
+        storage.drop(NEW_COLLECTION)
+        logging.info("Target collection dropped.")
+    prepare_for_load(storage, NEW_COLLECTION)
+    if reader.resuming:
+        # The upserts look documents up by author.
+        storage.create_indexes(NEW_COLLECTION, [[("authorId", 1)]])
+
+    total_docs = storage.count(PAPERS_COLLECTION)
     total_batches = total_docs // BATCH_SIZE + (1 if total_docs % BATCH_SIZE else 0)
-    logging.info(f"Total de documents : {total_docs} → environ {total_batches} batches")
+    logging.info(f"{total_docs} documents to process, about {total_batches} batches")
 
-    annotations = load_all_annotations()
+    with phase("load"):
+        annotations = load_all_annotations(storage, meter)
 
-    pbar = tqdm(total=total_batches, desc="Progression", unit="batch")
+    pbar = tqdm(total=total_batches, desc="Progress", unit="batch")
 
-    workers = [Thread(target = worker, args = (i, pbar, annotations)) for i in range(NUM_WORKERS)]
+    workers = [
+        Thread(target = worker, args = (i, storage, pbar, annotations, reader.resuming)) for i in range(NUM_WORKERS)
+    ]
     for w in workers:
         w.start()
 
-    producer()
+    producer(reader)
 
     for _ in range(NUM_WORKERS):
         batch_queue.put(None)
     for w in workers:
         w.join()
+    reader.clear_checkpoint()
+    build_indexes(storage, NEW_COLLECTION)
+    finish_shard(storage, "associate_each_paper")
+    if meter:
+        meter.report()
+    metrics.close()
 
     pbar.close()
-    logging.info(f"Insertion terminée en {round(time.time() - start_time, 2)} secondes.")
+    logging.info(f"Insertion done in {round(time.time() - start_time, 2)} seconds.")
+
+if __name__ == "__main__":
+    storage = get_storage()
+    try:
+        with profiled("associate_each_paper"):
+            run(storage)
+    finally:
+        storage.close()
@@ -0,0 +1,328 @@
+# Async execution mode for the import stages: `python async_pipeline.py
+# <stage>` runs the same transforms as the stage script, but as a pipeline of
+# asyncio tasks on pymongo's AsyncMongoClient. A reader task streams batches
+# into a bounded queue, transform tasks hand CPU work to a thread pool (or
+# await I/O, like link_papers' annotation lookups, which become one $in query
+# per batch) and push the documents into a second bounded queue drained by a
+# fixed number of concurrent bulk writers. Reads, transforms and writes of
+# consecutive batches overlap without a thread per connection.
+#
+# REPA_ASYNC_QUEUE (batches per queue), REPA_ASYNC_WRITES (in-flight bulk
+# writes) and REPA_ASYNC_TRANSFORMS (transform tasks / pool threads) tune it.
+# Setup and teardown (drops, index plan, shard merge) go through the regular
+# storage; with REPA_STORAGE=local the storage calls run in worker threads.
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import argparse
+import asyncio
+import inspect
+import logging
+import os
+import time
+
+from bulk_writer import DEAD_LETTER_COLLECTION, upsert_push_requests
+from connection import close_async_client, configure_pool, get_async_client
+from document_access import RAW_CODEC_OPTIONS, with_field
+from index_plan import prepare_for_load, build_indexes
+from metrics import stage_metrics
+from profiling import phase, profile_mode, profiled
+from sampling import SampledStorage, current_sample
+from sharding import current_shard, finish_shard
+from storage import MongoStorage, get_storage
+
+BATCH_SIZE = 1000
+QUEUE_SIZE = int(os.environ.get("REPA_ASYNC_QUEUE", 8))
+WRITE_CONCURRENCY = int(os.environ.get("REPA_ASYNC_WRITES", 4))
+TRANSFORM_CONCURRENCY = int(os.environ.get("REPA_ASYNC_TRANSFORMS", min(8, os.cpu_count() or 1)))
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+class AsyncMongoStorage:
+    def __init__(self, storage):
+        self.storage = storage
+        self.client = get_async_client(storage.uri)
+        self.db = self.client[storage.db_name]
+
+    def collection(self, name, raw = False):
+        # Sampled runs map the stage's names to the sampled collections.
+        collection = self.db[self.storage.collection_name(name)]
+        return collection.with_options(codec_options = RAW_CODEC_OPTIONS) if raw else collection
+
+    async def batches(self, name, projection = None, query = None, batch_size = BATCH_SIZE, raw = False,
+                      shard = None, shard_key = "_id"):
+        if shard is not None:
+            query = shard.mongo_query(self.storage.db[self.storage.collection_name(name)], shard_key, query)
+        collection = self.collection(name, raw)
+        batch = []
+        async for doc in collection.find(query or {}, projection, batch_size = batch_size):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def find_in(self, name, field, values, projection = None, raw = False):
+        collection = self.collection(name, raw)
+        return await collection.find({field: {"$in": list(values)}}, projection).to_list(None)
+
+    async def _dead_letter(self, docs):
+        await self.db[DEAD_LETTER_COLLECTION].insert_many(docs, ordered = False)
+
+    async def insert_many(self, name, docs):
+        # Shares the sync storage's writer, so both modes adapt the same budgets.
+        writer = self.storage.writer
+        collection = self.collection(name)
+        await writer.run_async(
+            writer.insert_plan(name, docs),
+            lambda batch: collection.insert_many(batch, ordered = False),
+            self._dead_letter
+        )
+
+    async def upsert_push(self, name, key_field, array_field, values):
+        writer = self.storage.writer
+        collection = self.collection(name)
+        await writer.run_async(
+            writer.upsert_push_plan(name, key_field, array_field, values),
+            lambda items: collection.bulk_write(upsert_push_requests(array_field, items), ordered = False),
+            self._dead_letter
+        )
+
+    async def close(self):
+        await close_async_client(self.storage.uri)
+
+class ThreadedStorage:
+    # Same interface over a synchronous storage, each call in a worker thread.
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def batches(self, name, projection = None, query = None, batch_size = BATCH_SIZE, raw = False,
+                      shard = None, shard_key = "_id"):
+        reader = self.storage.reader(name, projection, query, batch_size = batch_size, raw = raw,
+                                     shard = shard, shard_key = shard_key)
+        iterator = reader.batches()
+        while True:
+            batch = await asyncio.to_thread(next, iterator, None)
+            if batch is None:
+                break
+            yield batch
+
+    async def find_in(self, name, field, values, projection = None, raw = False):
+        def lookup():
+            docs = (self.storage.find_one(name, {field: value}, projection, raw = raw) for value in set(values))
+            return [doc for doc in docs if doc is not None]
+        return await asyncio.to_thread(lookup)
+
+    async def insert_many(self, name, docs):
+        await asyncio.to_thread(self.storage.insert_many, name, docs)
+
+    async def upsert_push(self, name, key_field, array_field, values):
+        await asyncio.to_thread(self.storage.upsert_push, name, key_field, array_field, values)
+
+    async def close(self):
+        pass
+
+def async_storage(storage):
+    backend = storage.storage if isinstance(storage, SampledStorage) else storage
+    return AsyncMongoStorage(storage) if isinstance(backend, MongoStorage) else ThreadedStorage(storage)
+
+async def run_pipeline(source, transform, write, transforms = TRANSFORM_CONCURRENCY,
+                       writes = WRITE_CONCURRENCY, queue_size = QUEUE_SIZE):
+    # source: async iterator of batches; transform: batch -> documents, either
+    # a coroutine function (I/O) or a plain function run in the thread pool;
+    # write: coroutine taking the documents of one batch.
+    metrics = stage_metrics()
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers = transforms, thread_name_prefix = "transform")
+    read_queue = asyncio.Queue(maxsize = queue_size)
+    write_queue = asyncio.Queue(maxsize = queue_size)
+    counts = {"batches": 0, "written": 0}
+
+    async def read():
+        async for batch in source:
+            await read_queue.put(batch)
+            counts["batches"] += 1
+            metrics.set("queue_depth", read_queue.qsize(), queue = "read")
+        for _ in range(transforms):
+            await read_queue.put(None)
+
+    async def transform_worker(worker_id):
+        while (batch := await read_queue.get()) is not None:
+            start = time.perf_counter()
+            if inspect.iscoroutinefunction(transform):
+                docs = await transform(batch)
+            else:
+                docs = await loop.run_in_executor(executor, transform, batch)
+            metrics.record_batch(f"transform-{worker_id}", time.perf_counter() - start)
+            if docs:
+                await write_queue.put(docs)
+                metrics.set("queue_depth", write_queue.qsize(), queue = "write")
+
+    async def writer(writer_id):
+        while (docs := await write_queue.get()) is not None:
+            start = time.perf_counter()
+            await write(docs)
+            metrics.observe("write_batch_seconds", time.perf_counter() - start, writer = writer_id)
+            counts["written"] += len(docs)
+
+    async def close_writers(transform_tasks):
+        await asyncio.gather(*transform_tasks)
+        for _ in range(writes):
+            await write_queue.put(None)
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(read())
+            transform_tasks = [group.create_task(transform_worker(i)) for i in range(transforms)]
+            for i in range(writes):
+                group.create_task(writer(i))
+            group.create_task(close_writers(transform_tasks))
+    finally:
+        executor.shutdown(wait = False, cancel_futures = True)
+    logging.info(f"{counts['batches']} batches read, {counts['written']:,} documents written.")
+
+def inserter(astorage, name):
+    async def write(docs):
+        await astorage.insert_many(name, docs)
+    return write
+
+async def link_papers(storage, astorage):
+    import link_papers as stage
+
+    build_indexes(storage, stage.annotated_col)
+    storage.clear(stage.linked_col)
+    prepare_for_load(storage, stage.linked_col)
+
+    async def link(batch):
+        ids = [paper.get("corpusid") for paper in batch if paper.get("corpusid")]
+        annotations = {}
+        for annotation in await astorage.find_in(stage.annotated_col, "corpusid", ids,
+                                                 stage.annotation_fields, raw = True):
+            annotations.setdefault(annotation["corpusid"], annotation)
+        return [
+            with_field(paper, "annotation", annotations.get(paper.get("corpusid")))
+            if paper.get("corpusid") else paper
+            for paper in batch
+        ]
+
+    source = astorage.batches(stage.papers_col, batch_size = stage.batch_size, raw = True,
+                              shard = current_shard(), shard_key = "corpusid")
+    await run_pipeline(source, link, inserter(astorage, stage.linked_col))
+    build_indexes(storage, stage.linked_col)
+    finish_shard(storage, "link_papers")
+
+async def associate_each_paper(storage, astorage):
+    import associate_each_paper as stage
+
+    storage.drop(stage.NEW_COLLECTION)
+    prepare_for_load(storage, stage.NEW_COLLECTION)
+    with phase("load"):
+        annotations = stage.load_all_annotations(storage)
+
+    source = astorage.batches(stage.PAPERS_COLLECTION, stage.PAPER_FIELDS, batch_size = stage.BATCH_SIZE,
+                              raw = True, shard = current_shard(), shard_key = "corpusid")
+    transform = partial(stage.author_paper_topic_docs, annotations = annotations)
+    await run_pipeline(source, transform, inserter(astorage, stage.NEW_COLLECTION))
+    build_indexes(storage, stage.NEW_COLLECTION)
+    finish_shard(storage, "associate_each_paper")
+
+async def author_paper(storage, astorage):
+    import author_paper as stage
+
+    storage.drop(stage.DESTINATION_COLLECTION)
+    prepare_for_load(storage, stage.DESTINATION_COLLECTION)
+
+    async def write(author_papers):
+        await astorage.upsert_push(stage.DESTINATION_COLLECTION, "authorId", "papers", author_papers)
+
+    source = astorage.batches(stage.SOURCE_COLLECTION, stage.SOURCE_FIELDS, batch_size = stage.BATCH_SIZE,
+                              raw = True, shard = current_shard(), shard_key = "corpusid")
+    await run_pipeline(source, stage.papers_by_author, write)
+    build_indexes(storage, stage.DESTINATION_COLLECTION)
+    finish_shard(storage, "author_paper")
+
+async def topic_union(storage, astorage, stage, stage_name, transform, key):
+    storage.drop(stage.DESTINATION_COLLECTION)
+    storage.drop(stage.TEMP_COLLECTION)
+
+    source = astorage.batches(stage.SOURCE_COLLECTION, stage.SOURCE_FIELDS, batch_size = stage.BATCH_SIZE,
+                              raw = True, shard = current_shard(), shard_key = key)
+    await run_pipeline(source, transform, inserter(astorage, stage.TEMP_COLLECTION))
+    with phase("write"):
+        stage.aggregate_and_save(storage)
+    build_indexes(storage, stage.DESTINATION_COLLECTION)
+    finish_shard(storage, stage_name)
+
+async def author_topic(storage, astorage):
+    import author_topic as stage
+    await topic_union(storage, astorage, stage, "author_topic", stage.topics_by_author, "authorId")
+
+async def corpus_topic(storage, astorage):
+    import corpus_topic as stage
+    await topic_union(storage, astorage, stage, "corpus_topic", stage.topics_by_corpus, "corpusId")
+
+async def specific_filter(storage, astorage, stage, stage_name, key):
+    storage.drop(stage.TARGET_COLLECTION)
+    prepare_for_load(storage, stage.TARGET_COLLECTION)
+    specific_topics = stage.load_specific_topics()
+
+    source = astorage.batches(stage.SOURCE_COLLECTION, stage.SOURCE_FIELDS, batch_size = stage.BATCH_SIZE,
+                              raw = True, shard = current_shard(), shard_key = key)
+    transform = partial(stage.filter_batch, specific_topics = specific_topics)
+    await run_pipeline(source, transform, inserter(astorage, stage.TARGET_COLLECTION))
+    build_indexes(storage, stage.TARGET_COLLECTION)
+    finish_shard(storage, stage_name)
+
+async def specific_topic(storage, astorage):
+    import specific_topic as stage
+    await specific_filter(storage, astorage, stage, "specific_topic", "authorId")
+
+async def corpus_specific_topic(storage, astorage):
+    import corpus_specific_topic as stage
+    await specific_filter(storage, astorage, stage, "corpus_specific_topic", "corpusId")
+
+STAGES = {
+    "link_papers": link_papers,
+    "associate_each_paper": associate_each_paper,
+    "author_paper": author_paper,
+    "author_topic": author_topic,
+    "corpus_topic": corpus_topic,
+    "specific_topic": specific_topic,
+    "corpus_specific_topic": corpus_specific_topic
+}
+
+async def run(storage, stage_name):
+    start_time = time.time()
+    metrics = stage_metrics(stage_name)
+    # One reader, and every writer and transform (link lookups) may hold a connection.
+    configure_pool(workers = WRITE_CONCURRENCY + TRANSFORM_CONCURRENCY, readers = 1)
+    astorage = async_storage(storage)
+    try:
+        await STAGES[stage_name](storage, astorage)
+    finally:
+        await astorage.close()
+    metrics.close()
+    logging.info(f"[{stage_name}] Async run done in {round(time.time() - start_time, 2)} seconds.")
+
+def main():
+    # --profile, --shard and --sample are consumed before argparse sees them.
+    mode = profile_mode()
+    current_shard()
+    current_sample()
+    parser = argparse.ArgumentParser(description = "Run an import stage on the asyncio pipeline.")
+    parser.add_argument("stage", choices = sorted(STAGES))
+    args = parser.parse_args()
+
+    storage = get_storage()
+    try:
+        with profiled(f"{args.stage}_async", mode):
+            asyncio.run(run(storage, args.stage))
+    finally:
+        storage.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,162 +1,127 @@
 import logging
 import time
-from pymongo import MongoClient, UpdateOne
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import itertools
-import threading
 import gc
+import threading
 from queue import Queue
 import sys
 
-DB_NAME = "research_db"
+from parallel_reader import reader_checkpoint
+from document_access import transfer_meter
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from sharding import current_shard, shard_collection, finish_shard
+from connection import bulk_read_preference, configure_pool
+from metrics import stage_metrics
+from profiling import profiled
+
 SOURCE_COLLECTION = "papers_with_annotations"
-DESTINATION_COLLECTION = "authors_papers_annotations"
+DESTINATION_COLLECTION = shard_collection("authors_papers_annotations")
 BATCH_SIZE = 1000 
 MAX_WORKERS = 4    
 MAX_PENDING_TASKS = 50  
-BULK_CHUNK_SIZE = 500  
+SOURCE_FIELDS = {"_id": 1, "title": 1, "authors.authorId": 1, "annotation": 1}
+NUM_READERS = 4
 
 logging.basicConfig(
     level = logging.INFO,
-    format = "%(asctime)s - %(levelname)s - %(message)s"
+    format = "%(asctime)s - [%(levelname)s] %(message)s"
 )
 
-thread_local = threading.local()
-
-def get_db_connection():
-    if not hasattr(thread_local, 'client'):
-        thread_local.client = MongoClient(
-            "mongodb://localhost:27017",
-            maxPoolSize = 10
-        )
-        thread_local.db = thread_local.client[DB_NAME]
-        thread_local.output_collection = thread_local.db[DESTINATION_COLLECTION]
+def papers_by_author(batch):
+    author_papers = defaultdict(list)
     
-    return thread_local.output_collection
-
-def batched_cursor(cursor, batch_size):
-    while True:
-        batch = list(itertools.islice(cursor, batch_size))
-        if not batch:
-            break
-        yield batch
-
-def process_batch_chunked(batch):
-    try:
-        output_collection = get_db_connection()
-        
-        author_papers = defaultdict(list)
+    for paper in batch:
+        paper_id = paper.get("_id")
+        title = paper.get("title", "")
+        annotation = paper.get("annotation", {})
         
-        for paper in batch:
-            paper_id = paper.get("_id")
-            title = paper.get("title", "")
-            annotation = paper.get("annotation", {})
+        authors = paper.get("authors", [])
+        if not authors:
+            continue
             
-            authors = paper.get("authors", [])
-            if not authors:
-                continue
-                
-            entry = {
-                "paperId": paper_id,
-                "title": title,
-                "annotation": annotation
-            }
-            
-            for author in authors:
-                author_id = author.get("authorId")
-                if author_id:
-                    author_papers[author_id].append(entry)
+        entry = {
+            "paperId": paper_id,
+            "title": title,
+            "annotation": annotation
+        }
         
-        author_items = list(author_papers.items())
-        total_processed = 0
+        for author in authors:
+            author_id = author.get("authorId")
+            if author_id:
+                author_papers[author_id].append(entry)
+    return author_papers
+
+def process_batch_chunked(storage, batch, resuming = False):
+    batch_start = time.perf_counter()
+    try:
+        author_papers = papers_by_author(batch)
         
-        for i in range(0, len(author_items), BULK_CHUNK_SIZE):
-            chunk = author_items[i : i + BULK_CHUNK_SIZE]
-            requests = []
-            
-            for author_id, papers in chunk:
-                requests.append(UpdateOne(
-                    {"authorId": author_id},
-                    {"$push": {"papers": {"$each": papers}}},
-                    upsert=True
-                ))
-            
-            if requests:
-                try:
-                    output_collection.bulk_write(requests, ordered = False)
-                    total_processed += len(requests)
-                except Exception as e:
-                    logging.error(f"Erreur bulk_write chunk: {str(e)}")
-                    continue
+        # The storage's bulk writer sizes the upserts by bytes. A resumed run
+        # re-reads partly written ranges, so it adds papers only once.
+        storage.upsert_push(DESTINATION_COLLECTION, "authorId", "papers", author_papers, add_to_set = resuming)
         
-        del author_papers, author_items
+        del author_papers
         gc.collect()
         
+        stage_metrics().record_batch(threading.current_thread().name, time.perf_counter() - batch_start)
         return len(batch)
         
     except Exception as e:
-        logging.error(f"Erreur dans process_batch_chunked: {str(e)}")
+        logging.error(f"Error in process_batch_chunked: {str(e)}")
         return 0
 
-def create_indexes():
-    client = MongoClient("mongodb://localhost:27017")
-    db = client[DB_NAME]
-    output_collection = db[DESTINATION_COLLECTION]
-    
-    try:
-        output_collection.create_index("authorId", background=True)
-        logging.info("Index créé sur authorId")
-    except Exception as e:
-        logging.warning(f"Erreur création index: {e}")
-    finally:
-        client.close()
-
-def get_total_documents():
-    client = MongoClient("mongodb://localhost:27017")
-    db = client[DB_NAME]
-    try:
-        return db[SOURCE_COLLECTION].count_documents({})
-    finally:
-        client.close()
-
-def main():
+def run(storage):
     start_time = time.time()
+    metrics = stage_metrics("author_paper")
+    configure_pool(workers = MAX_WORKERS, readers = NUM_READERS)
     
-    logging.info("Création des index...")
-    create_indexes()
-    
-    total_docs = get_total_documents()
-    logging.info(f"Traitement de {total_docs:,} documents")
+    total_docs = storage.count(SOURCE_COLLECTION)
+    logging.info(f"Processing {total_docs:,} documents")
     
-    main_client = MongoClient(
-        "mongodb://localhost:27017",
-        maxPoolSize=20,
-        readPreference='secondaryPreferred'
+    meter = transfer_meter("author_paper")
+    reader = storage.reader(
+        SOURCE_COLLECTION,
+        projection = SOURCE_FIELDS,
+        num_ranges = NUM_READERS,
+        batch_size = BATCH_SIZE,
+        checkpoint_file = reader_checkpoint("author_paper"),
+        raw = True,
+        meter = meter,
+        read_preference = bulk_read_preference(),
+        shard = current_shard(),
+        shard_key = "corpusid"
     )
-    db = main_client[DB_NAME]
-    papers_collection = db[SOURCE_COLLECTION]
+    if not reader.resuming:
+        storage.drop(DESTINATION_COLLECTION)
     
-    cursor = papers_collection.find(
-        {},
-        {"_id": 1, "title": 1, "authors.authorId": 1, "annotation": 1},
-        no_cursor_timeout=True,
-        batch_size=1000
-    )
+    logging.info("Preparing indexes ...")
+    prepare_for_load(storage, DESTINATION_COLLECTION)
     
     total_submitted = 0
     total_completed = 0
     pending_futures = []
     last_log_time = start_time
     
+    def wait_pending():
+        nonlocal total_completed
+        for f in as_completed(pending_futures):
+            try:
+                total_completed += f.result()
+            except Exception as e:
+                logging.error(f"Error in a worker thread: {e}")
+        pending_futures.clear()
+    
     try:
         with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            batch_generator = batched_cursor(cursor, BATCH_SIZE)
+            batch_generator = reader.batches(barrier = wait_pending)
             
             for batch in batch_generator:
-                future = executor.submit(process_batch_chunked, batch)
+                future = executor.submit(process_batch_chunked, storage, batch, reader.resuming)
                 pending_futures.append(future)
                 total_submitted += len(batch)
+                metrics.set("queue_depth", len(pending_futures))
                 
                 if len(pending_futures) >= MAX_PENDING_TASKS:
                     completed_futures = []
@@ -165,7 +130,7 @@ def main():
                             result = f.result()
                             total_completed += result
                         except Exception as e:
-                            logging.error(f"Erreur dans un thread: {e}")
+                            logging.error(f"Error in a worker thread: {e}")
                         completed_futures.append(f)
                     
                     pending_futures = [f for f in pending_futures if f not in completed_futures]
@@ -177,43 +142,51 @@ def main():
                     progress = (total_completed / total_docs) * 100 if total_docs > 0 else 0
                     
                     logging.info(
-                        f"Soumis: {total_submitted:,} | Terminé: {total_completed:,} | "
-                        f"Progression: {progress:.1f}% | Vitesse: {rate:.0f} docs/sec | "
-                        f"Tâches en attente: {len(pending_futures)}"
+                        f"Submitted: {total_submitted:,} | Completed: {total_completed:,} | "
+                        f"Progress: {progress:.1f}% | Rate: {rate:.0f} docs/sec | "
+                        f"Pending tasks: {len(pending_futures)}"
                     )
                     last_log_time = current_time
                 
                 if sys.getsizeof(pending_futures) > 100 * 1024 * 1024:
-                    logging.warning("Limite mémoire atteinte, attente des tâches...")
+                    logging.warning("Memory limit reached, waiting for pending tasks ...")
                     for f in as_completed(pending_futures):
                         try:
                             result = f.result()
                             total_completed += result
                         except Exception as e:
-                            logging.error(f"Erreur dans un thread: {e}")
+                            logging.error(f"Error in a worker thread: {e}")
                     pending_futures.clear()
             
-            logging.info("Traitement des dernières tâches...")
+            logging.info("Processing the last tasks ...")
             for f in as_completed(pending_futures):
                 try:
                     result = f.result()
                     total_completed += result
                 except Exception as e:
-                    logging.error(f"Erreur dans un thread: {e}")
+                    logging.error(f"Error in a worker thread: {e}")
+        reader.clear_checkpoint()
+        build_indexes(storage, DESTINATION_COLLECTION)
+        finish_shard(storage, "author_paper")
+        if meter:
+            meter.report()
+        metrics.close()
     
     except KeyboardInterrupt:
-        logging.info("Interruption utilisateur")
+        logging.info("Interrupted by user")
     except Exception as e:
-        logging.error(f"Erreur principale: {e}")
-    finally:
-        cursor.close()
-        main_client.close()
+        logging.error(f"Fatal error: {e}")
     
     elapsed_time = time.time() - start_time
     logging.info(
-        f"Traitement terminé: {total_completed:,} documents en {elapsed_time:.2f}s "
+        f"Processing done: {total_completed:,} documents in {elapsed_time:.2f}s "
         f"({total_completed/elapsed_time:.0f} docs/sec)"
     )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    storage = get_storage()
+    try:
+        with profiled("author_paper"):
+            run(storage)
+    finally:
+        storage.close()
@@ -0,0 +1,381 @@
+# Similar-author index over author_specific_topics. Each author's topic set
+# becomes a MinHash signature, computed with NumPy over integer topic ids
+# (one universal hash (a*x + b) mod P per permutation, min-reduced per
+# author), and the signatures are split into LSH bands. Every file lives in
+# Output/similarity/ as a .npy array, memory-mapped at query time:
+#
+#   authors.npy        author ids, sorted (row -> authorId, binary search back)
+#   fingerprints.npy   hash of each author's topic set, to detect changes
+#   topic_indptr.npy   CSR of the topic ids of each author, used to verify
+#   topic_ids.npy      candidates with their exact Jaccard similarity
+#   signatures.npy     uint32 MinHash signatures, authors x NUM_PERM
+#   band_sorted.npy    per band, the sorted band keys ...
+#   band_order.npy     ... and the author rows in that order
+#
+# A query looks its band keys up with searchsorted, ranks the candidates by
+# the number of shared bands and verifies the best ones against the topic
+# sets. `update` recomputes the signatures of new and changed authors only
+# (topic ids are stable, the vocabulary only grows) and re-sorts the bands.
+#
+#   python author_similarity.py build [--materialize K]
+#   python author_similarity.py update [--authors ID ...]
+#   python author_similarity.py query AUTHOR_ID [-k 10]
+#   python author_similarity.py topics TOPIC ... [-k 10]
+
+from datetime import datetime
+from hashlib import blake2b
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from metrics import stage_metrics
+from profiling import phase, profile_mode, profiled
+from sampling import current_sample, sample_suffix
+
+SOURCE_COLLECTION = "author_specific_topics"
+SOURCE_FIELDS = {"_id": 0, "authorId": 1, "topics": 1}
+SIMILAR_COLLECTION = "similar_authors"
+INDEX_DIR = "Output/similarity"
+NUM_PERM = 128
+# 64 bands of 2 rows: pairs above a Jaccard of about (1/64)^(1/2) = 0.125
+# become candidates. Specific-topic profiles of related authors overlap far
+# less than near-duplicates do, so the threshold sits low.
+BANDS = 64
+SEED = 1
+PRIME = (1 << 31) - 1
+MINHASH_CHUNK = 20000
+MAX_CANDIDATES = 20000
+READ_BATCH_SIZE = 10000
+WRITE_BATCH_SIZE = 1000
+ARRAYS = ("authors", "fingerprints", "topic_indptr", "topic_ids", "signatures", "band_sorted", "band_order")
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+def index_dir():
+    return INDEX_DIR + sample_suffix()
+
+def hash_parameters(num_perm = NUM_PERM, bands = BANDS, seed = SEED):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, num_perm, dtype = np.uint64)
+    b = rng.integers(0, PRIME, num_perm, dtype = np.uint64)
+    multipliers = rng.integers(1, 2 ** 63, num_perm // bands, dtype = np.uint64) | np.uint64(1)
+    return a, b, multipliers
+
+def fingerprint(topics):
+    digest = blake2b("\x1f".join(sorted(topics)).encode(), digest_size = 8).digest()
+    return int.from_bytes(digest, "big")
+
+def minhash(indptr, ids, a, b):
+    # Authors are processed in chunks so the (topics x permutations) hash
+    # matrix stays small; every author has at least one topic.
+    signatures = np.empty((len(indptr) - 1, len(a)), dtype = np.uint32)
+    for start in range(0, len(indptr) - 1, MINHASH_CHUNK):
+        end = min(len(indptr) - 1, start + MINHASH_CHUNK)
+        low, high = indptr[start], indptr[end]
+        x = ids[low:high].astype(np.uint64) + np.uint64(1)
+        hashed = (np.outer(x, a) + b) % np.uint64(PRIME)
+        signatures[start:end] = np.minimum.reduceat(hashed, indptr[start:end] - low, axis = 0)
+    return signatures
+
+def band_keys(signatures, bands, multipliers):
+    # One 64-bit key per band; colliding keys only add candidates, which are
+    # verified anyway.
+    rows = len(multipliers)
+    banded = signatures[:, :bands * rows].reshape(len(signatures), bands, rows).astype(np.uint64)
+    return (banded * multipliers).sum(axis = 2, dtype = np.uint64)
+
+def csr_take(indptr, ids, rows):
+    lengths = np.diff(indptr)[rows]
+    new_indptr = np.zeros(len(rows) + 1, dtype = np.int64)
+    np.cumsum(lengths, out = new_indptr[1:])
+    positions = np.repeat(indptr[rows] - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return new_indptr, ids[positions]
+
+def csr_from_sets(topic_sets, vocabulary):
+    positions = {topic: i for i, topic in enumerate(vocabulary)}
+    lengths = np.zeros(len(topic_sets) + 1, dtype = np.int64)
+    ids = []
+    for i, topics in enumerate(topic_sets):
+        for topic in topics:
+            if topic not in positions:
+                positions[topic] = len(vocabulary)
+                vocabulary.append(topic)
+            ids.append(positions[topic])
+        lengths[i + 1] = len(topics)
+    return np.cumsum(lengths), np.array(ids, dtype = np.int32)
+
+class SimilarAuthorIndex:
+    def __init__(self, directory, mmap = True):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json"), encoding = "utf-8") as f:
+            self.manifest = json.load(f)
+        with open(os.path.join(directory, "vocabulary.json"), encoding = "utf-8") as f:
+            self.vocabulary = json.load(f)
+        mode = "r" if mmap else None
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode = mode))
+        self.a, self.b, self.multipliers = hash_parameters(
+            self.manifest["num_perm"], self.manifest["bands"], self.manifest["seed"]
+        )
+        self._topic_positions = None
+
+    def __len__(self):
+        return len(self.authors)
+
+    def row(self, author_id):
+        position = int(np.searchsorted(self.authors, str(author_id)))
+        if position < len(self.authors) and self.authors[position] == str(author_id):
+            return position
+        return None
+
+    def ids_of_topics(self, topics):
+        if self._topic_positions is None:
+            self._topic_positions = {topic: i for i, topic in enumerate(self.vocabulary)}
+        return np.array(sorted({self._topic_positions[t] for t in topics if t in self._topic_positions}),
+                        dtype = np.int32)
+
+    def candidates(self, keys):
+        found = []
+        for band, key in enumerate(keys):
+            sorted_keys = self.band_sorted[band]
+            low, high = np.searchsorted(sorted_keys, key, "left"), np.searchsorted(sorted_keys, key, "right")
+            found.append(self.band_order[band, low:high])
+        if not found:
+            return np.array([], dtype = np.int32)
+        rows, hits = np.unique(np.concatenate(found), return_counts = True)
+        if len(rows) > MAX_CANDIDATES:
+            rows = rows[np.argsort(-hits, kind = "stable")[:MAX_CANDIDATES]]
+        return rows
+
+    def jaccard(self, query_ids, rows):
+        # Intersection sizes via a vocabulary mask over the candidates' topics.
+        mask = np.zeros(len(self.vocabulary), dtype = bool)
+        mask[query_ids] = True
+        indptr, ids = csr_take(np.asarray(self.topic_indptr), self.topic_ids, rows)
+        lengths = np.diff(indptr)
+        hits = mask[ids].astype(np.int32)
+        intersection = np.add.reduceat(hits, indptr[:-1]) if len(ids) else np.zeros(len(rows), dtype = np.int32)
+        return intersection / (len(query_ids) + lengths - intersection)
+
+    def _query(self, query_ids, keys, k, exclude = None):
+        rows = self.candidates(keys)
+        if exclude is not None:
+            rows = rows[rows != exclude]
+        if len(rows) == 0 or len(query_ids) == 0:
+            return []
+        scores = self.jaccard(query_ids, rows)
+        best = np.argsort(-scores, kind = "stable")[:k]
+        return [(str(self.authors[rows[i]]), float(scores[i])) for i in best if scores[i] > 0]
+
+    def similar(self, author_id, k = 10):
+        row = self.row(author_id)
+        if row is None:
+            return []
+        query_ids = self.topic_ids_of(row)
+        keys = band_keys(self.signatures[row : row + 1], self.manifest["bands"], self.multipliers)[0]
+        return self._query(query_ids, keys, k, exclude = row)
+
+    def topic_ids_of(self, row):
+        return np.asarray(self.topic_ids[self.topic_indptr[row] : self.topic_indptr[row + 1]])
+
+    def experts(self, topics, k = 10):
+        query_ids = self.ids_of_topics(topics)
+        if len(query_ids) == 0:
+            return []
+        signature = minhash(np.array([0, len(query_ids)]), query_ids, self.a, self.b)
+        keys = band_keys(signature, self.manifest["bands"], self.multipliers)[0]
+        return self._query(query_ids, keys, k)
+
+def save(directory, arrays, vocabulary, manifest):
+    # The manifest is written last: a reader never sees it describe arrays
+    # that are not in place yet.
+    os.makedirs(directory, exist_ok = True)
+    for name, array in arrays.items():
+        path = os.path.join(directory, f"{name}.npy")
+        np.save(path + ".tmp.npy", array)
+        os.replace(path + ".tmp.npy", path)
+    for name, content in (("vocabulary.json", vocabulary), ("manifest.json", manifest)):
+        path = os.path.join(directory, name)
+        with open(path + ".tmp", "w", encoding = "utf-8") as f:
+            json.dump(content, f)
+        os.replace(path + ".tmp", path)
+
+def read_topic_sets(storage, author_ids = None):
+    query = {"authorId": {"$in": list(author_ids)}} if author_ids else None
+    sets = {}
+    count = 0
+    for doc in storage.find(SOURCE_COLLECTION, query = query, projection = SOURCE_FIELDS,
+                            batch_size = READ_BATCH_SIZE):
+        author_id = doc.get("authorId")
+        if author_id:
+            sets.setdefault(str(author_id), set()).update(doc.get("topics") or [])
+        count += 1
+    stage_metrics().inc("docs_read_total", count, collection = SOURCE_COLLECTION)
+    return sets
+
+def empty_index():
+    return {
+        "authors": np.array([], dtype = "U1"),
+        "fingerprints": np.array([], dtype = np.uint64),
+        "topic_indptr": np.zeros(1, dtype = np.int64),
+        "topic_ids": np.array([], dtype = np.int32),
+        "signatures": np.empty((0, NUM_PERM), dtype = np.uint32)
+    }, []
+
+def load_existing(directory):
+    if not os.path.exists(os.path.join(directory, "manifest.json")):
+        return empty_index()
+    index = SimilarAuthorIndex(directory, mmap = False)
+    if (index.manifest["num_perm"], index.manifest["bands"], index.manifest["seed"]) != (NUM_PERM, BANDS, SEED):
+        logging.info("Index parameters changed, rebuilding from scratch.")
+        return empty_index()
+    return {name: getattr(index, name) for name in ARRAYS[:5]}, index.vocabulary
+
+def apply_changes(arrays, vocabulary, changes):
+    # changes: authorId -> topic set (empty set = remove the author).
+    a, b, multipliers = hash_parameters(NUM_PERM, BANDS, SEED)
+    authors = arrays["authors"]
+    kept = np.flatnonzero(~np.isin(authors, np.array(list(changes), dtype = str)))
+    updated = sorted(author for author, topics in changes.items() if topics)
+
+    with phase("minhash"):
+        indptr, ids = csr_from_sets([changes[author] for author in updated], vocabulary)
+        signatures = minhash(indptr, ids, a, b)
+    fingerprints = np.array([fingerprint(changes[author]) for author in updated], dtype = np.uint64)
+
+    with phase("index"):
+        kept_indptr, kept_ids = csr_take(arrays["topic_indptr"], arrays["topic_ids"], kept)
+        all_authors = np.concatenate([authors[kept], np.array(updated, dtype = str)])
+        merged_indptr = np.concatenate([kept_indptr, indptr[1:] + kept_indptr[-1]])
+        merged_ids = np.concatenate([kept_ids, ids])
+        order = np.argsort(all_authors, kind = "stable")
+        topic_indptr, topic_ids = csr_take(merged_indptr, merged_ids, order)
+        all_signatures = np.concatenate([arrays["signatures"][kept], signatures])[order]
+        keys = band_keys(all_signatures, BANDS, multipliers).T
+        band_order = np.argsort(keys, axis = 1, kind = "stable").astype(np.int32)
+        result = {
+            "authors": all_authors[order],
+            "fingerprints": np.concatenate([arrays["fingerprints"][kept], fingerprints])[order],
+            "topic_indptr": topic_indptr,
+            "topic_ids": topic_ids,
+            "signatures": all_signatures,
+            "band_sorted": np.take_along_axis(keys, band_order, axis = 1),
+            "band_order": band_order
+        }
+    return result, len(updated), len(changes) - len(updated)
+
+def changed_sets(arrays, topic_sets, author_ids = None):
+    # Full scans also remove authors that left the collection; targeted
+    # updates only touch the listed ones.
+    known = {str(author): int(value) for author, value in zip(arrays["authors"], arrays["fingerprints"])}
+    changes = {author: topics for author, topics in topic_sets.items()
+               if known.get(author) != fingerprint(topics)}
+    scope = known if author_ids is None else {str(author) for author in author_ids}
+    for author in scope:
+        if author in known and author not in topic_sets:
+            changes[author] = set()
+    return changes
+
+def materialize(storage, index, k):
+    metrics = stage_metrics()
+    storage.drop(SIMILAR_COLLECTION)
+    prepare_for_load(storage, SIMILAR_COLLECTION)
+    docs = []
+    for author_id in index.authors:
+        similar = index.similar(author_id, k)
+        docs.append({"authorId": str(author_id),
+                     "similar": [{"authorId": other, "jaccard": round(score, 4)} for other, score in similar]})
+        if len(docs) >= WRITE_BATCH_SIZE:
+            storage.insert_many(SIMILAR_COLLECTION, docs)
+            docs = []
+    if docs:
+        storage.insert_many(SIMILAR_COLLECTION, docs)
+    build_indexes(storage, SIMILAR_COLLECTION)
+    metrics.set("similar_authors_k", k)
+    logging.info(f"[{SIMILAR_COLLECTION}] Top-{k} similar authors stored for {len(index):,} authors")
+
+def run(storage, directory = None, author_ids = None, rebuild = False, materialize_k = 0):
+    start_time = time.time()
+    metrics = stage_metrics("author_similarity")
+    directory = directory or index_dir()
+
+    arrays, vocabulary = empty_index() if rebuild else load_existing(directory)
+    with phase("read"):
+        topic_sets = read_topic_sets(storage, author_ids)
+    changes = changed_sets(arrays, topic_sets, author_ids)
+    if not changes and len(arrays["authors"]):
+        logging.info("No author changed since the last build.")
+    else:
+        result, updated, removed = apply_changes(arrays, vocabulary, changes)
+        with phase("write"):
+            save(directory, result, vocabulary, {
+                "num_perm": NUM_PERM,
+                "bands": BANDS,
+                "seed": SEED,
+                "authors": len(result["authors"]),
+                "topics": len(vocabulary),
+                "built_at": datetime.now().isoformat(timespec = "seconds")
+            })
+        metrics.inc("authors_hashed_total", updated)
+        logging.info(f"Similarity index in {directory}: {len(result['authors']):,} authors, "
+                     f"{updated:,} (re)hashed, {removed:,} removed")
+
+    if materialize_k:
+        with phase("materialize"):
+            materialize(storage, SimilarAuthorIndex(directory), materialize_k)
+    metrics.close()
+    logging.info(f"Author similarity done in {round(time.time() - start_time, 2)} seconds.")
+
+def print_results(results):
+    for author_id, score in results:
+        print(f"{author_id}\t{score:.3f}")
+
+def main():
+    mode = profile_mode()
+    current_sample()
+    parser = argparse.ArgumentParser(description = "MinHash/LSH index of authors with similar specific topics.")
+    parser.add_argument("--dir", default = None, help = f"Index directory (default: {INDEX_DIR})")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    build = subparsers.add_parser("build", help = "Build the index from scratch")
+    update = subparsers.add_parser("update", help = "Rehash new and changed authors")
+    update.add_argument("--authors", nargs = "+", help = "Only look at these authors")
+    for sub in (build, update):
+        sub.add_argument("--materialize", type = int, default = 0, metavar = "K",
+                         help = f"Store the top-K similar authors of every author in '{SIMILAR_COLLECTION}'")
+    query = subparsers.add_parser("query", help = "Authors similar to an author")
+    query.add_argument("author_id")
+    topics = subparsers.add_parser("topics", help = "Authors whose specific topics match a topic set")
+    topics.add_argument("topics", nargs = "+")
+    for sub in (query, topics):
+        sub.add_argument("-k", type = int, default = 10)
+    args = parser.parse_args()
+    directory = args.dir or index_dir()
+
+    if args.command in ("query", "topics"):
+        start = time.perf_counter()
+        index = SimilarAuthorIndex(directory)
+        if args.command == "query":
+            print_results(index.similar(args.author_id, args.k))
+        else:
+            print_results(index.experts(args.topics, args.k))
+        logging.info(f"Answered in {(time.perf_counter() - start) * 1000:.1f} ms over {len(index):,} authors")
+        return
+
+    storage = get_storage()
+    try:
+        with profiled("author_similarity", mode):
+            run(storage, directory, getattr(args, "authors", None), args.command == "build", args.materialize)
+    finally:
+        storage.close()
+
+if __name__ == "__main__":
+    main()
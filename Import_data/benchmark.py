@@ -0,0 +1,192 @@
+# End-to-end benchmark of the pipeline on synthetic data: every stage runs in
+# its own process so wall time and peak RSS are measured per stage, results go
+# to a JSON file and are compared against a stored baseline.
+
+from datetime import datetime, timezone
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from synthetic_data import SCALES, generate
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = "Output/benchmarks"
+WORK_DIR = os.path.join(RESULTS_DIR, "work")
+BASELINE_FILE = os.path.join(RESULTS_DIR, "baseline.json")
+TOLERANCE = 0.15
+
+# (stage name, script, manifest statistic used as the stage's item count)
+STAGES = [
+    ("specific_topics", "read_cso_csv.py", "cso_rows"),
+    ("load", "load_data.py", "input_documents"),
+    ("link", "link_papers.py", "papers"),
+    ("associate", "associate_each_paper.py", "papers"),
+    ("author_paper", "author_paper.py", "papers"),
+    ("author_topics", "author_topic.py", "annotated_authorships"),
+    ("corpus_topics", "corpus_topic.py", "annotated_authorships"),
+    ("author_specific", "specific_topic.py", "annotated_authors"),
+    ("corpus_specific", "corpus_specific_topic.py", "annotated_papers"),
+    ("ranking", "impact_un_topic.py", "specific_topics")
+]
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+def prepare_dataset(scale, work_dir, seed):
+    root = os.path.join(work_dir, scale)
+    manifest_path = os.path.join(root, "manifest.json")
+    params = dict(SCALES[scale], seed = seed)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding = "utf-8") as f:
+            manifest = json.load(f)
+        if all(manifest["params"].get(k) == v for k, v in params.items()):
+            logging.info(f"[{scale}] Reusing synthetic dataset in {root}")
+            return root, manifest
+
+    logging.info(f"[{scale}] Generating synthetic dataset in {root} ...")
+    manifest = generate(root, seed = seed, **SCALES[scale])
+    return root, manifest
+
+def stage_env(storage, scale, root):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SCRIPT_DIR, env.get("PYTHONPATH")]))
+    env["REPA_STORAGE"] = storage
+    env.pop("REPA_READER_CHECKPOINTS", None)
+    if storage == "local":
+        env["REPA_LOCAL_DIR"] = os.path.join(root, "Output", "local_db")
+    else:
+        env["REPA_DB_NAME"] = f"repa_bench_{scale}"
+    return env
+
+def run_stage(script, root, env, log_path):
+    # os.wait4 returns the rusage of this child only, so ru_maxrss is the
+    # stage's own peak RSS (kilobytes on Linux).
+    start = time.perf_counter()
+    with open(log_path, "w", encoding = "utf-8") as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(SCRIPT_DIR, script)],
+            cwd = root, env = env, stdout = log, stderr = subprocess.STDOUT
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    return {
+        "returncode": process.returncode,
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1)
+    }
+
+def run_scale(scale, storage, work_dir, seed, stages):
+    root, manifest = prepare_dataset(scale, work_dir, seed)
+    if storage == "local":
+        shutil.rmtree(os.path.join(root, "Output", "local_db"), ignore_errors = True)
+    log_dir = os.path.join(root, "logs")
+    os.makedirs(log_dir, exist_ok = True)
+    env = stage_env(storage, scale, root)
+
+    results = {}
+    for name, script, unit in STAGES:
+        if stages and name not in stages:
+            continue
+        logging.info(f"[{scale}] Running {name} ...")
+        result = run_stage(script, root, env, os.path.join(log_dir, f"{name}.log"))
+        items = manifest["stats"].get(unit, 0)
+        result["items"] = items
+        result["throughput"] = round(items / result["wall_seconds"], 1) if result["wall_seconds"] else None
+        results[name] = result
+
+        if result["returncode"] != 0:
+            logging.error(f"[{scale}] {name} failed (exit {result['returncode']}), see {log_dir}/{name}.log")
+        else:
+            logging.info(
+                f"[{scale}] {name}: {result['wall_seconds']}s, {result['throughput']} items/s, "
+                f"peak RSS {result['peak_rss_mb']} MiB"
+            )
+    return {"dataset": manifest, "stages": results}
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd = SCRIPT_DIR,
+            capture_output = True, text = True, check = True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance = TOLERANCE):
+    regressions = []
+    for scale, run in results["runs"].items():
+        base_stages = baseline.get("runs", {}).get(scale, {}).get("stages", {})
+        for name, current in run["stages"].items():
+            previous = base_stages.get(name)
+            if not previous or current["returncode"] != 0 or previous.get("returncode") != 0:
+                continue
+            for metric in ("wall_seconds", "peak_rss_mb"):
+                if not previous.get(metric):
+                    continue
+                ratio = current[metric] / previous[metric]
+                status = "REGRESSION" if ratio > 1 + tolerance else "ok"
+                logging.info(f"[{scale}] {name} {metric}: {previous[metric]} -> {current[metric]} ({ratio:.2f}x) {status}")
+                if status != "ok":
+                    regressions.append((scale, name, metric, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the pipeline stages on synthetic data and record their cost.")
+    parser.add_argument("--scale", action = "append", choices = sorted(SCALES), help = "Repeatable, defaults to 10k")
+    parser.add_argument("--stage", action = "append", choices = [name for name, _, _ in STAGES], help = "Repeatable, defaults to all")
+    parser.add_argument("--storage", choices = ["local", "mongo"], default = os.environ.get("REPA_STORAGE", "local"))
+    parser.add_argument("--work-dir", default = WORK_DIR)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--baseline", default = BASELINE_FILE)
+    parser.add_argument("--update-baseline", action = "store_true", help = "Store these results as the new baseline")
+    parser.add_argument("--tolerance", type = float, default = TOLERANCE)
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec = "seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "storage": args.storage,
+        "runs": {}
+    }
+    for scale in args.scale or ["10k"]:
+        results["runs"][scale] = run_scale(scale, args.storage, work_dir, args.seed, args.stage)
+
+    os.makedirs(RESULTS_DIR, exist_ok = True)
+    results_file = os.path.join(RESULTS_DIR, f"results-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(results_file, "w", encoding = "utf-8") as f:
+        json.dump(results, f, indent = 2)
+    logging.info(f"Results written to {results_file}")
+
+    if args.update_baseline:
+        shutil.copyfile(results_file, args.baseline)
+        logging.info(f"Baseline updated: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        logging.info(f"No baseline at {args.baseline}, run with --update-baseline to store one.")
+        return
+    with open(args.baseline, "r", encoding = "utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    failed = [name for run in results["runs"].values() for name, r in run["stages"].items() if r["returncode"] != 0]
+    if regressions or failed:
+        logging.error(f"{len(regressions)} regression(s), {len(failed)} failed stage(s).")
+        sys.exit(1)
+    logging.info("No regression against the baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+# Bulk writes shared by every stage through MongoStorage (and the async
+# storage of async_pipeline). Batches are cut by estimated BSON bytes instead
+# of a fixed document count, and the byte budget of each collection adapts to
+# the observed write latency: it grows additively while writes are fast and
+# halves when a write is slow or times out. When a bulk write partly fails
+# only the operations listed in writeErrors are retried, with exponential
+# backoff, and operations that keep failing or can never succeed (duplicate
+# keys, documents over the BSON limit, validation errors) are stored in the
+# dead_letters collection instead of aborting the stage.
+#
+# REPA_BULK_BYTES (initial budget), REPA_BULK_MIN_BYTES, REPA_BULK_MAX_BYTES,
+# REPA_BULK_TARGET_SECONDS, REPA_BULK_RETRIES and REPA_DEAD_LETTERS tune it.
+
+from datetime import datetime
+from threading import Lock
+import asyncio
+import logging
+import os
+import random
+import time
+
+from bson.raw_bson import RawBSONDocument
+from document_access import document_size
+from metrics import stage_metrics
+
+MIB = 1024 * 1024
+INITIAL_BATCH_BYTES = int(os.environ.get("REPA_BULK_BYTES", 4 * MIB))
+MIN_BATCH_BYTES = int(os.environ.get("REPA_BULK_MIN_BYTES", 256 * 1024))
+MAX_BATCH_BYTES = int(os.environ.get("REPA_BULK_MAX_BYTES", 32 * MIB))
+BATCH_BYTES_STEP = MIB
+TARGET_SECONDS = float(os.environ.get("REPA_BULK_TARGET_SECONDS", 1.0))
+MAX_BATCH_OPS = 100000
+MAX_RETRIES = int(os.environ.get("REPA_BULK_RETRIES", 5))
+BACKOFF_SECONDS = 0.1
+MAX_BACKOFF_SECONDS = 10
+SIZE_SAMPLE = 32
+DEAD_LETTER_COLLECTION = os.environ.get("REPA_DEAD_LETTERS", "dead_letters")
+DEAD_LETTER_PREVIEW = 2000
+
+DUPLICATE_KEY = 11000
+# Server codes worth another attempt: elections, shutdowns, network and
+# lock/time-limit errors. Everything else in writeErrors is a poison document.
+RETRYABLE_CODES = {
+    6, 7, 50, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436, 16500
+}
+
+def estimate_sizes(items, size_of):
+    # Raw documents know their size; dicts are encoded for a sample only and
+    # the rest are assumed to be as large as the sample's mean.
+    if all(isinstance(item, RawBSONDocument) for item in items):
+        return [len(item.raw) for item in items]
+    sampled = [size_of(item) for item in items[:SIZE_SAMPLE]]
+    mean = sum(sampled) // max(len(sampled), 1)
+    return sampled + [mean] * (len(items) - len(sampled))
+
+def backoff(attempt):
+    return min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+class AdaptiveBatchSize:
+    def __init__(self, initial = INITIAL_BATCH_BYTES, minimum = MIN_BATCH_BYTES, maximum = MAX_BATCH_BYTES,
+                 target_seconds = TARGET_SECONDS):
+        self.bytes = max(minimum, min(maximum, initial))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.lock = Lock()
+
+    def observe(self, batch_bytes, seconds, failed = False):
+        # Additive increase, multiplicative decrease. Small batches finishing
+        # fast say nothing about larger ones, so only growth needs a full batch.
+        with self.lock:
+            if failed or seconds > 2 * self.target_seconds:
+                self.bytes = max(self.minimum, self.bytes // 2)
+            elif seconds < self.target_seconds and batch_bytes >= self.bytes // 2:
+                self.bytes = min(self.maximum, self.bytes + BATCH_BYTES_STEP)
+            return self.bytes
+
+def split_batches(entries, budget):
+    # entries are (item, size); budget() is read per batch so a slow write
+    # shrinks the rest of the same call.
+    start = 0
+    while start < len(entries):
+        limit = budget()
+        end, total = start, 0
+        while end < len(entries) and (end == start or (total + entries[end][1] <= limit
+                                                        and end - start < MAX_BATCH_OPS)):
+            total += entries[end][1]
+            end += 1
+        yield entries[start:end], total
+        start = end
+
+class BulkWriter:
+    def __init__(self):
+        self.budgets = {}
+        self.lock = Lock()
+
+    def budget(self, name):
+        with self.lock:
+            if name not in self.budgets:
+                self.budgets[name] = AdaptiveBatchSize()
+            return self.budgets[name]
+
+    def insert_plan(self, name, docs):
+        entries = list(zip(docs, estimate_sizes(docs, document_size)))
+        return self._plan(name, entries, "insert", idempotent = True)
+
+    def upsert_plan(self, name, key_fields, docs):
+        # Replacing the document matched by its key is idempotent, so a
+        # resumed stage can write a range that was partly written before.
+        items = [({field: doc.get(field) for field in key_fields}, doc) for doc in docs]
+        sizes = estimate_sizes(docs, document_size)
+        return self._plan(name, list(zip(items, sizes)), "upsert", idempotent = True)
+
+    def upsert_push_plan(self, name, key_field, array_field, values, add_to_set = False):
+        # $push is not idempotent: a write whose outcome is unknown (network
+        # error, timeout) is left to the driver's retryable writes instead of
+        # being sent again from here. $addToSet is.
+        items = [({key_field: key}, {array_field: list(pushed)}) for key, pushed in values.items()]
+        sizes = estimate_sizes(items, lambda item: document_size(item[0]) + document_size(item[1]))
+        operation = "upsert_add_to_set" if add_to_set else "upsert_push"
+        return self._plan(name, list(zip(items, sizes)), operation, idempotent = add_to_set)
+
+    def _plan(self, name, entries, operation, idempotent):
+        # Generator of I/O steps, driven by run() or run_async():
+        #   ("write", items)   -> the driver sends back None or the exception
+        #   ("sleep", seconds)
+        #   ("dead_letter", docs)
+        budget = self.budget(name)
+        metrics = stage_metrics()
+        for batch, batch_bytes in split_batches(entries, lambda: budget.bytes):
+            metrics.observe("bulk_batch_bytes", batch_bytes, collection = name)
+            yield from self._write_batch(name, [item for item, _ in batch], batch_bytes, operation,
+                                         idempotent, budget, metrics)
+            metrics.set("bulk_target_bytes", budget.bytes, collection = name)
+
+    def _write_batch(self, name, items, batch_bytes, operation, idempotent, budget, metrics,
+                     attempt = 0, unknown_outcome = False):
+        from pymongo.errors import AutoReconnect, BulkWriteError, ExecutionTimeout, InvalidDocument
+
+        pending = items
+        while pending:
+            start = time.perf_counter()
+            error = yield ("write", pending)
+            seconds = time.perf_counter() - start
+            metrics.observe("write_seconds", seconds, collection = name)
+
+            if error is None:
+                budget.observe(batch_bytes, seconds)
+                metrics.inc("docs_written_total", len(pending), collection = name)
+                return
+
+            if isinstance(error, BulkWriteError):
+                budget.observe(batch_bytes, seconds)
+                retry, dead = [], []
+                for write_error in error.details.get("writeErrors", []):
+                    code = write_error.get("code")
+                    item = pending[write_error["index"]]
+                    if code == DUPLICATE_KEY and unknown_outcome and operation == "insert":
+                        # Landed during the attempt whose outcome was unknown.
+                        continue
+                    if code in RETRYABLE_CODES and attempt < MAX_RETRIES:
+                        retry.append(item)
+                    else:
+                        dead.append((item, code, write_error.get("errmsg")))
+                metrics.inc("docs_written_total", len(pending) - len(retry) - len(dead), collection = name)
+                if dead:
+                    yield ("dead_letter", self.dead_letters(name, operation, dead, attempt + 1))
+                    metrics.inc("write_errors_total", len(dead), collection = name)
+                if retry:
+                    metrics.inc("write_retries_total", len(retry), collection = name)
+                    yield ("sleep", backoff(attempt))
+                pending = retry
+                attempt += 1
+                continue
+
+            if isinstance(error, InvalidDocument):
+                # Raised client-side (e.g. DocumentTooLarge) for the whole
+                # batch; halve it until the offending document is alone.
+                if len(pending) == 1:
+                    yield ("dead_letter", self.dead_letters(name, operation,
+                                                            [(pending[0], None, str(error))], attempt + 1))
+                    metrics.inc("write_errors_total", 1, collection = name)
+                    return
+                middle = len(pending) // 2
+                for half in (pending[:middle], pending[middle:]):
+                    yield from self._write_batch(name, half, batch_bytes // 2, operation, idempotent,
+                                                 budget, metrics, attempt, unknown_outcome)
+                return
+
+            if isinstance(error, (AutoReconnect, ExecutionTimeout)) and idempotent and attempt < MAX_RETRIES:
+                budget.observe(batch_bytes, seconds, failed = True)
+                metrics.inc("write_retries_total", len(pending), collection = name)
+                logging.warning(f"[BulkWriter] {name}: {type(error).__name__} on {len(pending)} documents, "
+                                f"retrying in batches of {budget.bytes // 1024} KiB")
+                yield ("sleep", backoff(attempt))
+                entries = list(zip(pending, estimate_sizes(pending, document_size)))
+                for batch, retry_bytes in split_batches(entries, lambda: budget.bytes):
+                    yield from self._write_batch(name, [item for item, _ in batch], retry_bytes, operation,
+                                                 idempotent, budget, metrics, attempt + 1, True)
+                return
+
+            budget.observe(batch_bytes, seconds, failed = True)
+            metrics.inc("write_errors_total", len(pending), collection = name)
+            raise error
+
+    def dead_letters(self, name, operation, failures, attempts):
+        stage = stage_metrics().stage
+        first = failures[0]
+        logging.warning(f"[BulkWriter] {len(failures)} {operation} operation(s) on '{name}' sent to "
+                        f"'{DEAD_LETTER_COLLECTION}' (code {first[1]}: {first[2]})")
+        return [
+            {
+                "collection": name,
+                "stage": stage,
+                "operation": operation,
+                "document": dead_letter_document(operation, item),
+                "error": {"code": code, "message": message},
+                "attempts": attempts,
+                "failed_at": datetime.now()
+            }
+            for item, code, message in failures
+        ]
+
+    def run(self, plan, write, dead_letter):
+        from pymongo.errors import PyMongoError
+
+        step = next(plan, None)
+        while step is not None:
+            kind, value = step
+            result = None
+            if kind == "write":
+                try:
+                    write(value)
+                except Exception as e:
+                    result = e
+            elif kind == "sleep":
+                time.sleep(value)
+            else:
+                try:
+                    dead_letter(value)
+                except PyMongoError as e:
+                    # The document itself may be what cannot be stored; keep a preview.
+                    logging.error(f"[BulkWriter] Could not store dead letters in full: {e}")
+                    try:
+                        dead_letter(previews(value))
+                    except PyMongoError as e:
+                        logging.error(f"[BulkWriter] Dead letters lost: {e}")
+            try:
+                step = plan.send(result)
+            except StopIteration:
+                step = None
+
+    async def run_async(self, plan, write, dead_letter):
+        from pymongo.errors import PyMongoError
+
+        step = next(plan, None)
+        while step is not None:
+            kind, value = step
+            result = None
+            if kind == "write":
+                try:
+                    await write(value)
+                except Exception as e:
+                    result = e
+            elif kind == "sleep":
+                await asyncio.sleep(value)
+            else:
+                try:
+                    await dead_letter(value)
+                except PyMongoError as e:
+                    logging.error(f"[BulkWriter] Could not store dead letters in full: {e}")
+                    try:
+                        await dead_letter(previews(value))
+                    except PyMongoError as e:
+                        logging.error(f"[BulkWriter] Dead letters lost: {e}")
+            try:
+                step = plan.send(result)
+            except StopIteration:
+                step = None
+
+def dead_letter_document(operation, item):
+    if operation == "insert":
+        return item
+    if operation == "upsert":
+        return {"filter": item[0], "replacement": item[1]}
+    return {"filter": item[0], "push": item[1]}
+
+def previews(dead_letters):
+    return [dict(doc, document = repr(doc["document"])[:DEAD_LETTER_PREVIEW]) for doc in dead_letters]
+
+def upsert_requests(items):
+    from pymongo import ReplaceOne
+
+    return [ReplaceOne(filter, doc, upsert = True) for filter, doc in items]
+
+def upsert_push_requests(array_field, items, add_to_set = False):
+    from pymongo import UpdateOne
+
+    operator = "$addToSet" if add_to_set else "$push"
+    return [
+        UpdateOne(filter, {operator: {array_field: {"$each": pushed[array_field]}}}, upsert = True)
+        for filter, pushed in items
+    ]
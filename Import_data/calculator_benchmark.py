@@ -0,0 +1,218 @@
+# Microbenchmarks for CSOTopicImpactCalculator and TopicGroupImpactCalculator
+# on fixed-seed synthetic graphs of increasing size. Every run is checked
+# against golden values so an optimisation cannot silently change results,
+# and the timings are fitted to a power law to expose the scaling of each
+# operation.
+
+from contextlib import redirect_stdout
+from datetime import datetime
+import argparse
+import io
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from impact_un_topic import CSOTopicImpactCalculator
+from impact_topics import TopicGroupImpactCalculator
+from synthetic_data import write_cso_csv, specific_topics
+
+SIZES = [250, 500, 1000, 2000, 4000]
+SEED = 42
+SAMPLE_TOPICS = 50
+SAMPLE_PAIRS = 200
+GROUP_SIZES = [2, 5, 10, 20, 50]
+GROUPS_PER_SIZE = 5
+RANKING_TOP = 20
+REL_TOLERANCE = 1e-6
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calculator_golden.json")
+RESULTS_DIR = "Output/benchmarks"
+
+def build_inputs(directory, size, seed = SEED):
+    csv_path = os.path.join(directory, f"cso_{size}.csv")
+    specific_path = os.path.join(directory, f"specific_{size}.txt")
+    _, rows = write_cso_csv(csv_path, size, seed = seed)
+    with open(specific_path, "w", encoding = "utf-8") as f:
+        for topic in specific_topics(rows):
+            f.write(topic + "\n")
+    return csv_path, specific_path
+
+def timed(function, *args, **kwargs):
+    # The calculators report progress with print(); keep it out of the timings.
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return result, elapsed
+
+def clear_graph_caches(calculator):
+    calculator.ancestor_cache.clear()
+    calculator.descendant_cache.clear()
+    calculator.similar_cache.clear()
+    calculator._init_reference_cache()
+    calculator._min_descendant_ic = None
+
+def run_size(directory, size, seed = SEED):
+    csv_path, specific_path = build_inputs(directory, size, seed)
+    timings = {}
+
+    calculator, timings["load"] = timed(CSOTopicImpactCalculator, csv_path, specific_path, compute_centrality = False)
+
+    def centrality():
+        calculator._compute_centrality_measures()
+        calculator._compute_influence_scores()
+    _, timings["centrality"] = timed(centrality)
+
+    calculator.depth_cache.clear()
+    _, timings["depth"] = timed(calculator._compute_depths)
+
+    nodes = sorted(calculator.graph.nodes())
+    _, timings["information_content"] = timed(lambda: [calculator.calculate_information_content(t) for t in nodes])
+
+    rng = random.Random(seed)
+    topics = rng.sample(nodes, min(SAMPLE_TOPICS, len(nodes)))
+    pairs = [tuple(rng.sample(nodes, 2)) for _ in range(SAMPLE_PAIRS)]
+    groups = {
+        group_size: [rng.sample(nodes, min(group_size, len(nodes))) for _ in range(GROUPS_PER_SIZE)]
+        for group_size in GROUP_SIZES
+    }
+    reference_topics = calculator.default_reference_topics()
+
+    clear_graph_caches(calculator)
+    _, timings["lca"] = timed(lambda: [calculator.find_lowest_common_ancestor(a, b) for a, b in pairs])
+    clear_graph_caches(calculator)
+    lin, timings["lin_single"] = timed(lambda: [calculator.calculate_lin_similarity(a, b) for a, b in pairs])
+    clear_graph_caches(calculator)
+    semantic, timings["lin_batch"] = timed(
+        lambda: [calculator.calculate_semantic_weight(t, reference_topics) for t in topics]
+    )
+    clear_graph_caches(calculator)
+    _, timings["most_similar"] = timed(calculator.most_similar_batch, topics, 10)
+
+    clear_graph_caches(calculator)
+    impacts, timings["impact_single"] = timed(
+        lambda: [calculator.calculate_impact_factor(t, reference_topics) for t in topics]
+    )
+
+    group_calculator = TopicGroupImpactCalculator(calculator)
+    group_impacts = {}
+    for group_size, size_groups in groups.items():
+        clear_graph_caches(calculator)
+        results, timings[f"group_impact_{group_size}"] = timed(
+            lambda: [group_calculator.compute_group_impact(g) for g in size_groups]
+        )
+        group_impacts[str(group_size)] = [r["impact_factor"] for r in results]
+
+    clear_graph_caches(calculator)
+    ranking, timings["rank"] = timed(
+        calculator.rank_topics_by_impact, specific_topics_only = True, top_k = len(calculator.specific_topics)
+    )
+    ranking = sorted(((r["topic_id"], r["impact_factor"]) for r in ranking), key = lambda x: (-x[1], x[0]))
+
+    values = {
+        "nodes": calculator.graph.number_of_nodes(),
+        "edges": calculator.graph.number_of_edges(),
+        "max_depth": calculator.max_depth,
+        "depth_sum": sum(calculator.depth_cache.get(t, 0) for t in nodes),
+        "lin": [[a, b, s] for (a, b), s in zip(pairs, lin)],
+        "semantic": dict(zip(topics, semantic)),
+        "impact": {t: r.get("impact_factor") for t, r in zip(topics, impacts)},
+        "group_impact": group_impacts,
+        "ranking_top": [list(item) for item in ranking[:RANKING_TOP]],
+        "ranking_size": len(ranking)
+    }
+    return timings, values
+
+def compare_values(expected, actual, path = ""):
+    mismatches = []
+    if isinstance(expected, dict):
+        for key in expected:
+            if key not in actual:
+                mismatches.append(f"{path}/{key}: missing")
+            else:
+                mismatches += compare_values(expected[key], actual[key], f"{path}/{key}")
+    elif isinstance(expected, list):
+        if len(expected) != len(actual):
+            mismatches.append(f"{path}: length {len(actual)} != {len(expected)}")
+        else:
+            for i, (e, a) in enumerate(zip(expected, actual)):
+                mismatches += compare_values(e, a, f"{path}[{i}]")
+    elif isinstance(expected, float) or isinstance(actual, float):
+        if actual is None or not math.isclose(expected, actual, rel_tol = REL_TOLERANCE, abs_tol = 1e-12):
+            mismatches.append(f"{path}: {actual} != {expected}")
+    elif expected != actual:
+        mismatches.append(f"{path}: {actual!r} != {expected!r}")
+    return mismatches
+
+def scaling_exponents(sizes, timings):
+    # Slope of log(time) against log(nodes): ~1 is linear, ~2 quadratic.
+    exponents = {}
+    if len(sizes) < 2:
+        return exponents
+    for operation in timings[sizes[0]]:
+        points = [(n, timings[n][operation]) for n in sizes if timings[n][operation] > 0]
+        if len(points) >= 2:
+            x, y = np.log([p[0] for p in points]), np.log([p[1] for p in points])
+            exponents[operation] = round(float(np.polyfit(x, y, 1)[0]), 2)
+    return exponents
+
+def main():
+    parser = argparse.ArgumentParser(description = "Microbenchmarks for the CSO impact calculators.")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = SIZES)
+    parser.add_argument("--seed", type = int, default = SEED)
+    parser.add_argument("--golden", default = GOLDEN_FILE)
+    parser.add_argument("--update-golden", action = "store_true", help = "Store these outputs as the golden values")
+    args = parser.parse_args()
+
+    sizes = sorted(args.sizes)
+    timings = {}
+    values = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            timings[size], values[size] = run_size(directory, size, args.seed)
+            print(f"{size:>6} topics: " + ", ".join(f"{op} {t * 1000:.1f}ms" for op, t in timings[size].items()))
+
+    exponents = scaling_exponents(sizes, timings)
+    print("\nScaling exponents (time ~ nodes^k):")
+    for operation, exponent in exponents.items():
+        print(f"  {operation:<20} {exponent}")
+
+    os.makedirs(RESULTS_DIR, exist_ok = True)
+    results_file = os.path.join(RESULTS_DIR, f"calculators-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(results_file, "w", encoding = "utf-8") as f:
+        json.dump({"seed": args.seed, "timings": timings, "scaling": exponents}, f, indent = 2)
+    print(f"\nResults written to {results_file}")
+
+    golden_key = str(args.seed)
+    golden = {}
+    if os.path.exists(args.golden):
+        with open(args.golden, "r", encoding = "utf-8") as f:
+            golden = json.load(f)
+
+    if args.update_golden:
+        golden[golden_key] = {str(size): values[size] for size in sizes}
+        with open(args.golden, "w", encoding = "utf-8") as f:
+            json.dump(golden, f, indent = 1, sort_keys = True)
+        print(f"Golden values updated: {args.golden}")
+        return
+
+    expected = golden.get(golden_key, {})
+    mismatches = []
+    for size in sizes:
+        if str(size) not in expected:
+            print(f"No golden values for {size} topics (seed {args.seed}), skipped.")
+            continue
+        mismatches += [f"{size}{m}" for m in compare_values(expected[str(size)], values[size])]
+    if mismatches:
+        print(f"\n{len(mismatches)} golden mismatch(es):")
+        for mismatch in mismatches[:50]:
+            print(f"  {mismatch}")
+        raise SystemExit(1)
+    print("Outputs match the golden values.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# Connection management for the pipeline: one pooled MongoClient (and one
+# AsyncMongoClient for async_pipeline) per process, shared by the storage,
+# the readers and the bulk writer. A stage sizes the pool from its own
+# thread counts with configure_pool() before its first query, instead of
+# every worker opening a client with a pool of its own. Wire compression is
+# negotiated with the server in the order zstd, snappy, zlib, skipping the
+# codecs whose Python package is missing; the ingest link to the database is
+# bandwidth-bound, so the CPU spent compressing pays for itself.
+#
+# Timeouts, compressors and read preferences come from REPA_MONGO_* variables
+# (see CONFIG). Time spent waiting for a pooled connection is recorded as
+# pool_wait_seconds and logged when it exceeds REPA_MONGO_POOL_WAIT_WARN.
+
+from importlib.util import find_spec
+from threading import Lock
+from urllib.parse import parse_qs, urlsplit
+import logging
+import os
+import time
+
+from metrics import metrics_sink, mongo_listeners, stage_metrics
+
+DEFAULT_POOL_SIZE = 10
+# Connections beyond the stage's threads: the main thread (counts, index
+# builds, markers) and the producer handing batches to the workers.
+SPARE_CONNECTIONS = 2
+COMPRESSOR_MODULES = (("zstd", "zstandard"), ("snappy", "snappy"), ("zlib", None))
+WAIT_LOG_INTERVAL = 30
+
+CONFIG = {
+    "pool_size": int(os.environ.get("REPA_MONGO_POOL_SIZE", 0)),
+    "min_pool_size": int(os.environ.get("REPA_MONGO_MIN_POOL_SIZE", 0)),
+    "max_idle_ms": int(os.environ.get("REPA_MONGO_MAX_IDLE_MS", 60000)),
+    "connect_timeout_ms": int(os.environ.get("REPA_MONGO_CONNECT_TIMEOUT_MS", 10000)),
+    "server_selection_timeout_ms": int(os.environ.get("REPA_MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000)),
+    "socket_timeout_ms": int(os.environ.get("REPA_MONGO_SOCKET_TIMEOUT_MS", 0)),
+    "wait_queue_timeout_ms": int(os.environ.get("REPA_MONGO_WAIT_QUEUE_TIMEOUT_MS", 0)),
+    "compressors": os.environ.get("REPA_MONGO_COMPRESSORS", "auto"),
+    "zlib_level": int(os.environ.get("REPA_MONGO_ZLIB_LEVEL", 6)),
+    "read_preference": os.environ.get("REPA_MONGO_READ_PREFERENCE", "primary"),
+    # Bulk scans of the previous stage's output. Secondaries may still lag
+    # behind the writes that stage just made and return a partial collection,
+    # so reading from them is opt-in (e.g. secondaryPreferred).
+    "bulk_read_preference": os.environ.get("REPA_MONGO_BULK_READ_PREFERENCE", "primary"),
+    "pool_wait_warn": float(os.environ.get("REPA_MONGO_POOL_WAIT_WARN", 0.5))
+}
+
+_pool_size = None
+_clients = {}
+_async_clients = {}
+_lock = Lock()
+
+def available_compressors():
+    setting = CONFIG["compressors"].strip().lower()
+    if setting in ("", "none", "off"):
+        return []
+    if setting != "auto":
+        return [name.strip() for name in setting.split(",") if name.strip()]
+    return [name for name, module in COMPRESSOR_MODULES if module is None or find_spec(module)]
+
+def configure_pool(workers = 0, readers = 0):
+    # Must run before the stage's first query: the pool is fixed once the
+    # client exists.
+    global _pool_size
+    size = CONFIG["pool_size"] or max(workers + readers + SPARE_CONNECTIONS, 1)
+    with _lock:
+        if _clients or _async_clients:
+            if size > (_pool_size or DEFAULT_POOL_SIZE):
+                logging.warning(f"[connection] Client already open, pool stays at {_pool_size or DEFAULT_POOL_SIZE} "
+                                f"connections ({size} requested)")
+            return pool_size()
+        _pool_size = size
+    return size
+
+def pool_size():
+    return CONFIG["pool_size"] or _pool_size or DEFAULT_POOL_SIZE
+
+def read_preference(name = None):
+    from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+
+    return make_read_preference(read_pref_mode_from_name(name or CONFIG["read_preference"]), None)
+
+def bulk_read_preference():
+    return read_preference(CONFIG["bulk_read_preference"])
+
+def pool_listener():
+    from pymongo import monitoring
+
+    class PoolWaitLogger(monitoring.ConnectionPoolListener):
+        def __init__(self):
+            self.lock = Lock()
+            self.last_log = 0.0
+            self.slow_waits = 0
+
+        def _waited(self, seconds):
+            stage_metrics().observe("pool_wait_seconds", seconds)
+            if seconds < CONFIG["pool_wait_warn"]:
+                return
+            with self.lock:
+                self.slow_waits += 1
+                now = time.monotonic()
+                if now - self.last_log < WAIT_LOG_INTERVAL:
+                    return
+                slow_waits, self.slow_waits, self.last_log = self.slow_waits, 0, now
+            logging.warning(f"[connection] Waited {seconds:.2f}s for a pooled connection "
+                            f"({slow_waits} slow checkouts, pool of {pool_size()}); "
+                            "the stage has more concurrent operations than connections")
+
+        def connection_checked_out(self, event):
+            self._waited(event.duration)
+
+        def connection_check_out_failed(self, event):
+            stage_metrics().inc("pool_checkout_failures_total", reason = event.reason)
+            self._waited(event.duration)
+
+        def connection_created(self, event):
+            stage_metrics().inc("pool_connections_created_total")
+
+        def connection_closed(self, event):
+            stage_metrics().inc("pool_connections_closed_total", reason = event.reason)
+
+        def pool_cleared(self, event):
+            logging.warning(f"[connection] Pool to {event.address} cleared")
+
+        def pool_created(self, event):
+            pass
+
+        def pool_ready(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_check_out_started(self, event):
+            pass
+
+        def connection_checked_in(self, event):
+            pass
+
+    return PoolWaitLogger()
+
+def client_options(uri = ""):
+    options = {
+        "maxPoolSize": pool_size(),
+        "minPoolSize": min(CONFIG["min_pool_size"], pool_size()),
+        "maxIdleTimeMS": CONFIG["max_idle_ms"],
+        "connectTimeoutMS": CONFIG["connect_timeout_ms"],
+        "serverSelectionTimeoutMS": CONFIG["server_selection_timeout_ms"],
+        "socketTimeoutMS": CONFIG["socket_timeout_ms"] or None,
+        "waitQueueTimeoutMS": CONFIG["wait_queue_timeout_ms"] or None,
+        "readPreference": CONFIG["read_preference"],
+        "retryWrites": True,
+        "retryReads": True,
+        "appname": f"repa-{stage_metrics().stage}",
+        "event_listeners": [pool_listener()] + (mongo_listeners() if metrics_sink() else [])
+    }
+    compressors = available_compressors()
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+        if "zlib" in compressors:
+            options["zlibCompressionLevel"] = CONFIG["zlib_level"]
+    # Options spelled out in the URI win over the defaults.
+    in_uri = {key.lower() for key in parse_qs(urlsplit(uri).query)}
+    return {key: value for key, value in options.items() if key.lower() not in in_uri}
+
+def _describe(options):
+    return (f"pool {options.get('maxPoolSize', 'from URI')}, compressors {options.get('compressors', 'none')}, "
+            f"read preference {options.get('readPreference', 'from URI')}")
+
+def get_client(uri):
+    # Keyed by pid too: a client must not be reused across fork().
+    from pymongo import MongoClient
+
+    key = (uri, os.getpid())
+    with _lock:
+        if key not in _clients:
+            options = client_options(uri)
+            _clients[key] = MongoClient(uri, **options)
+            logging.info(f"[connection] MongoClient for {uri}: {_describe(options)}")
+        return _clients[key]
+
+def get_async_client(uri):
+    from pymongo import AsyncMongoClient
+
+    key = (uri, os.getpid())
+    with _lock:
+        if key not in _async_clients:
+            options = client_options(uri)
+            _async_clients[key] = AsyncMongoClient(uri, **options)
+            logging.info(f"[connection] AsyncMongoClient for {uri}: {_describe(options)}")
+        return _async_clients[key]
+
+def close_client(uri):
+    with _lock:
+        client = _clients.pop((uri, os.getpid()), None)
+    if client is not None:
+        client.close()
+
+async def close_async_client(uri):
+    with _lock:
+        client = _async_clients.pop((uri, os.getpid()), None)
+    if client is not None:
+        await client.close()
@@ -1,23 +1,27 @@
-from pymongo import MongoClient
 from threading import Thread
 from queue import Queue
 from collections import defaultdict
 from tqdm import tqdm
 import logging
 import time
-import itertools
 
-DB_NAME = "research_db"
+from parallel_reader import reader_checkpoint
+from document_access import transfer_meter
+from storage import get_storage
+from sharding import current_shard, shard_collection, finish_shard
+from connection import configure_pool
+from metrics import stage_metrics
+from profiling import phase, profiled
+
 SOURCE_COLLECTION = "author_paper_topics"  
-TEMP_COLLECTION = "temp_corpus_topics"
-DESTINATION_COLLECTION = "corpus_topics"
+TEMP_COLLECTION = shard_collection("temp_corpus_topics")
+DESTINATION_COLLECTION = shard_collection("corpus_topics")
+SOURCE_FIELDS = {"_id": 0, "corpusId": 1, "topics": 1}
 BATCH_SIZE = 1000
 NUM_WORKERS = 4
+NUM_READERS = 4
 QUEUE_MAXSIZE = 1000
 
-client = MongoClient("mongodb://localhost:27017/")
-db = client[DB_NAME]
-
 logging.basicConfig(
     format="%(asctime)s - [%(levelname)s] %(message)s",
     level=logging.INFO
@@ -25,93 +29,82 @@ logging.basicConfig(
 
 batch_queue = Queue(maxsize=QUEUE_MAXSIZE)
 
-def chunked_cursor(cursor, size):
-    while True:
-        batch = list(itertools.islice(cursor, size))
-        if not batch:
-            break
-        yield batch
+def topics_by_corpus(batch):
+    local_data = defaultdict(set)
+
+    for doc in batch:
+        corpus_id = doc.get("corpusId")
+        topics = doc.get("topics", [])
+
+        if corpus_id:
+            local_data[corpus_id].update(topics)
 
-def worker(worker_id, pbar):
+    return [{"corpusId": k, "topics": list(v)} for k, v in local_data.items()]
+
+def worker(worker_id, storage, pbar):
     while True:
         batch = batch_queue.get()
         if batch is None:
             break
 
-        local_data = defaultdict(set)
-
-        for doc in batch:
-            corpus_id = doc.get("corpusId")
-            topics = doc.get("topics", [])
-
-            if corpus_id:
-                local_data[corpus_id].update(topics)
-
-        docs = [{"corpusId": k, "topics": list(v)} for k, v in local_data.items()]
-        if docs:
-            db[TEMP_COLLECTION].insert_many(docs, ordered=False)
-
-        batch_queue.task_done()
-        pbar.update(1)
-
-    logging.info(f"[Worker-{worker_id}] terminé.")
-
-def producer():
-    cursor = db[SOURCE_COLLECTION].find({}, no_cursor_timeout=True).batch_size(BATCH_SIZE)
-    try:
-        for batch in chunked_cursor(cursor, BATCH_SIZE):
-            batch_queue.put(batch)
-    finally:
-        cursor.close()
-
-def aggregate_and_save():
-    logging.info("Agrégation finale dans MongoDB ...")
-
-    pipeline = [
-        {
-            "$group": {
-                "_id": "$corpusId",
-                "topics": {"$addToSet": "$topics"}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "corpusId": "$_id",
-                "topics": {
-                    "$reduce": {
-                        "input": "$topics",
-                        "initialValue": [],
-                        "in": {"$setUnion": ["$$value", "$$this"]}
-                    }
-                }
-            }
-        },
-        {
-            "$out": DESTINATION_COLLECTION
-        }
-    ]
-
-    db[TEMP_COLLECTION].aggregate(pipeline, allowDiskUse=True)
-    logging.info("Agrégation enregistrée dans la collection finale.")
-
-if __name__ == '__main__':
+        batch_start = time.perf_counter()
+        try:
+            docs = topics_by_corpus(batch)
+            if docs:
+                storage.insert_many(TEMP_COLLECTION, docs)
+        except Exception as e:
+            # A dead worker would leave the queue's barrier waiting forever.
+            logging.error(f"[Worker-{worker_id}] Batch failed: {e}")
+            stage_metrics().inc("batch_errors_total")
+        finally:
+            stage_metrics().record_batch(worker_id, time.perf_counter() - batch_start)
+            batch_queue.task_done()
+            pbar.update(1)
+
+    logging.info(f"[Worker-{worker_id}] done.")
+
+def producer(reader):
+    for batch in reader.batches(barrier = batch_queue.join):
+        batch_queue.put(batch)
+        stage_metrics().set("queue_depth", batch_queue.qsize())
+
+def aggregate_and_save(storage):
+    logging.info("Final aggregation ...")
+    storage.union_by_key(TEMP_COLLECTION, "corpusId", "topics", DESTINATION_COLLECTION)
+    logging.info("Aggregation saved to the final collection.")
+
+def run(storage):
     start_time = time.time()
-    logging.info("Nettoyage des anciennes collections ...")
-    db[DESTINATION_COLLECTION].drop()
-    db[TEMP_COLLECTION].drop()
-
-    logging.info("Début de l'agrégation des topics par corpus ...")
-    total_docs = db[SOURCE_COLLECTION].estimated_document_count()
+    metrics = stage_metrics("corpus_topic")
+    configure_pool(workers = NUM_WORKERS, readers = NUM_READERS)
+    meter = transfer_meter("corpus_topic")
+    reader = storage.reader(
+        SOURCE_COLLECTION,
+        projection = SOURCE_FIELDS,
+        num_ranges = NUM_READERS,
+        batch_size = BATCH_SIZE,
+        checkpoint_file = reader_checkpoint("corpus_topic"),
+        raw = True,
+        meter = meter,
+        shard = current_shard(),
+        shard_key = "corpusId"
+    )
+    if not reader.resuming:
+        logging.info("Dropping previous collections ...")
+        storage.drop(DESTINATION_COLLECTION)
+        storage.drop(TEMP_COLLECTION)
+
+    logging.info("Aggregating topics per corpus ...")
+    total_docs = storage.count(SOURCE_COLLECTION)
     total_batches = total_docs // BATCH_SIZE + (1 if total_docs % BATCH_SIZE else 0)
 
     pbar = tqdm(total=total_batches, desc="Aggregation", unit="batch")
 
-    workers = [Thread(target=worker, args=(i, pbar)) for i in range(NUM_WORKERS)]
+    workers = [Thread(target=worker, args=(i, storage, pbar)) for i in range(NUM_WORKERS)]
     for w in workers:
         w.start()
 
-    producer()
+    producer(reader)
 
     for _ in range(NUM_WORKERS):
         batch_queue.put(None)
@@ -120,6 +113,20 @@ if __name__ == '__main__':
         w.join()
 
     pbar.close()
-    aggregate_and_save()
+    with phase("write"):
+        aggregate_and_save(storage)
+    reader.clear_checkpoint()
+    finish_shard(storage, "corpus_topic")
+    if meter:
+        meter.report()
+    metrics.close()
+
+    logging.info(f"Aggregation done in {round(time.time() - start_time, 2)} seconds.")
 
-    logging.info(f"Agrégation terminée en {round(time.time() - start_time, 2)} secondes.")
\ No newline at end of file
+if __name__ == '__main__':
+    storage = get_storage()
+    try:
+        with profiled("corpus_topic"):
+            run(storage)
+    finally:
+        storage.close()
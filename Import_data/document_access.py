@@ -0,0 +1,59 @@
+# Lazy document access for the pipeline stages: cursors hand out
+# RawBSONDocument, so a stage only decodes the fields it touches and nested
+# subdocuments stay as raw bytes, and a measurement mode reports how many
+# BSON bytes each stage pulled from the server.
+
+from bson import encode
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from threading import Lock
+import logging
+import os
+import struct
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class = RawBSONDocument)
+
+def raw_collection(collection):
+    return collection.with_options(codec_options = RAW_CODEC_OPTIONS)
+
+def measure_enabled():
+    return os.environ.get("REPA_MEASURE_BYTES") == "1"
+
+def document_size(doc):
+    if isinstance(doc, RawBSONDocument):
+        return len(doc.raw)
+    return len(encode(doc))
+
+def with_field(doc, name, value):
+    if isinstance(doc, RawBSONDocument) and name not in doc:
+        element = encode({name: value})[4:-1]
+        body = doc.raw[4:-1] + element
+        return RawBSONDocument(struct.pack("<i", len(body) + 5) + body + b"\x00")
+
+    copy = dict(doc)
+    copy[name] = value
+    return copy
+
+class TransferMeter:
+    def __init__(self, stage_name):
+        self.stage_name = stage_name
+        self.counts = {}
+        self.lock = Lock()
+
+    def add(self, source, docs):
+        docs = [doc for doc in docs if doc is not None]
+        size = sum(document_size(doc) for doc in docs)
+        with self.lock:
+            count, total = self.counts.get(source, (0, 0))
+            self.counts[source] = (count + len(docs), total + size)
+
+    def report(self):
+        for source, (count, total) in sorted(self.counts.items()):
+            per_doc = total / count if count else 0
+            logging.info(
+                f"[{self.stage_name}] {source}: {count:,} documents, "
+                f"{total / 1024 / 1024:.1f} MiB read ({per_doc:.0f} bytes/doc)"
+            )
+
+def transfer_meter(stage_name):
+    return TransferMeter(stage_name) if measure_enabled() else None
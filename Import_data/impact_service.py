@@ -0,0 +1,264 @@
+# Resident impact-scoring service: loads the CSO calculators once and serves
+# topic impact, group impact and similarity queries over HTTP.
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import Future
+from collections import defaultdict, deque
+from queue import Queue, Empty
+from threading import Thread, Lock
+import json
+import logging
+import os
+import time
+
+from impact_un_topic import load_calculator
+from impact_topics import TopicGroupImpactCalculator
+from profiling import profiled
+
+HOST = os.environ.get("IMPACT_SERVICE_HOST", "127.0.0.1")
+PORT = int(os.environ.get("IMPACT_SERVICE_PORT", 8001))
+# Sampled cohesion (with cohesion_error) for large groups.
+APPROXIMATE_COHESION = os.environ.get("IMPACT_APPROXIMATE_COHESION") == "1"
+COHESION_CONFIDENCE = float(os.environ.get("IMPACT_COHESION_CONFIDENCE", 0.95))
+CSV_FILE = "Input/CSO.3.4.1.csv"
+SPECIFIC_TOPICS_FILE = "Output/specific_topics.txt"
+SNAPSHOT_FILE = "Output/cso_calculator.pkl"
+
+BATCH_WINDOW = 0.002
+MAX_BATCH_SIZE = 256
+LATENCY_WINDOW = 10000
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+class LatencyTracker:
+    def __init__(self, window = LATENCY_WINDOW):
+        self.samples = defaultdict(lambda: deque(maxlen = window))
+        self.counts = defaultdict(int)
+        self.lock = Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.samples[name].append(seconds * 1000)
+            self.counts[name] += 1
+
+    def summary(self):
+        with self.lock:
+            snapshot = {name: sorted(values) for name, values in self.samples.items()}
+            counts = dict(self.counts)
+
+        stats = {}
+        for name, values in snapshot.items():
+            if not values:
+                continue
+            stats[name] = {
+                "count": counts[name],
+                "p50_ms": percentile(values, 50),
+                "p90_ms": percentile(values, 90),
+                "p99_ms": percentile(values, 99),
+                "max_ms": values[-1]
+            }
+        return stats
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class ScoringEngine:
+    # A single dispatcher thread owns the calculators (their caches are not
+    # thread-safe) and drains concurrent requests into one batch per kind.
+    def __init__(self, calculator, batch_window = BATCH_WINDOW, max_batch_size = MAX_BATCH_SIZE):
+        self.cso = calculator
+        self.group_calculator = TopicGroupImpactCalculator(calculator, approximate = APPROXIMATE_COHESION,
+                                                           confidence = COHESION_CONFIDENCE)
+        self.reference_topics = calculator.default_reference_topics()
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.requests = Queue()
+        self.latency = LatencyTracker()
+        self.batch_counts = defaultdict(int)
+        self.batch_items = defaultdict(int)
+        self.handlers = {
+            "impact": self._score_topics,
+            "group_impact": self._score_groups,
+            "similarity": self._score_pairs,
+            "most_similar": self._score_most_similar
+        }
+        self.dispatcher = Thread(target = self._dispatch, daemon = True)
+        self.dispatcher.start()
+
+    def submit(self, kind, items):
+        future = Future()
+        self.requests.put((kind, items, future))
+        return future.result()
+
+    def _dispatch(self):
+        while True:
+            pending = [self.requests.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout = remaining))
+                except Empty:
+                    break
+
+            by_kind = defaultdict(list)
+            for request in pending:
+                by_kind[request[0]].append(request)
+
+            for kind, requests in by_kind.items():
+                start = time.perf_counter()
+                items = [item for _, request_items, _ in requests for item in request_items]
+                try:
+                    results = self.handlers[kind](items)
+                except Exception:
+                    logging.exception(f"Batch '{kind}' failed, scoring its {len(requests)} requests one by one")
+                    self._run_separately(kind, requests)
+                    continue
+
+                offset = 0
+                for _, request_items, future in requests:
+                    future.set_result(results[offset : offset + len(request_items)])
+                    offset += len(request_items)
+                self.latency.record(f"batch:{kind}", time.perf_counter() - start)
+                self.batch_counts[kind] += 1
+                self.batch_items[kind] += len(items)
+
+    def _run_separately(self, kind, requests):
+        # Only the request that broke the batch fails; the ones coalesced with
+        # it are still answered.
+        for _, request_items, future in requests:
+            try:
+                future.set_result(self.handlers[kind](request_items))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stats(self):
+        batches = {
+            kind: {"batches": count, "mean_batch_size": self.batch_items[kind] / count}
+            for kind, count in list(self.batch_counts.items())
+        }
+        return {"latency": self.latency.summary(), "batches": batches}
+
+    def _score_topics(self, topics):
+        unique = {topic: self.cso.calculate_impact_factor(topic, self.reference_topics) for topic in set(topics)}
+        return [unique[topic] for topic in topics]
+
+    def _score_groups(self, groups):
+        unique = {}
+        for group in groups:
+            key = tuple(group)
+            if key not in unique:
+                unique[key] = self.group_calculator.compute_group_impact(list(group), self.reference_topics)
+        return [unique[tuple(group)] for group in groups]
+
+    def _score_pairs(self, pairs):
+        unique = {}
+        for topic1, topic2 in pairs:
+            key = (topic1, topic2) if topic1 <= topic2 else (topic2, topic1)
+            if key not in unique:
+                unique[key] = self.cso.calculate_lin_similarity(*key)
+        return [unique[(a, b) if a <= b else (b, a)] for a, b in pairs]
+
+    def _score_most_similar(self, queries):
+        return [
+            [{"topic": topic, "similarity": sim} for topic, sim in self.cso.most_similar(topic_id, k, min_sim)]
+            for topic_id, k, min_sim in queries
+        ]
+
+def item_list(value, name):
+    if not isinstance(value, list):
+        raise ValueError(f"'{name}' must be a list")
+    return value
+
+def topic_list(value, name):
+    if not all(isinstance(topic, str) for topic in item_list(value, name)):
+        raise ValueError(f"'{name}' must be a list of topic strings")
+    return list(value)
+
+class ImpactRequestHandler(BaseHTTPRequestHandler):
+    engine = None
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, default = float).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "topics": self.engine.cso.graph.number_of_nodes()})
+        elif self.path == "/stats":
+            self._send_json(200, self.engine.stats())
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        try:
+            # Payloads are checked here, before they can share a batch with
+            # other clients' requests.
+            body = self._read_json()
+            if not isinstance(body, dict):
+                raise ValueError("expected a JSON object")
+            if self.path == "/impact":
+                result = self.engine.submit("impact", topic_list(body.get("topics"), "topics"))
+            elif self.path == "/group_impact":
+                groups = item_list(body.get("groups"), "groups")
+                result = self.engine.submit("group_impact", [topic_list(g, "groups[]") for g in groups])
+            elif self.path == "/similarity":
+                pairs = [topic_list(p, "pairs[]") for p in item_list(body.get("pairs"), "pairs")]
+                if any(len(p) != 2 for p in pairs):
+                    raise ValueError("'pairs' must hold pairs of two topics")
+                result = self.engine.submit("similarity", [tuple(p) for p in pairs])
+            elif self.path == "/most_similar":
+                k = int(body.get("k", 10))
+                min_sim = float(body.get("min_sim", 0.0))
+                topics = topic_list(body.get("topics"), "topics")
+                result = self.engine.submit("most_similar", [(t, k, min_sim) for t in topics])
+            else:
+                self._send_json(404, {"error": "Not found"})
+                return
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        except Exception as e:
+            logging.error(f"Error while scoring {self.path}: {e}")
+            self._send_json(500, {"error": "Internal server error"})
+            return
+
+        self._send_json(200, {"results": result})
+        self.engine.latency.record(f"request:{self.path.strip('/')}", time.perf_counter() - start)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    start_time = time.time()
+    calculator = load_calculator(CSV_FILE, SPECIFIC_TOPICS_FILE, snapshot_path = SNAPSHOT_FILE)
+    ImpactRequestHandler.engine = ScoringEngine(calculator)
+    logging.info(f"Calculator ready in {round(time.time() - start_time, 2)} seconds.")
+
+    server = ThreadingHTTPServer((HOST, PORT), ImpactRequestHandler)
+    logging.info(f"Impact service listening on http://{HOST}:{PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down impact service.")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    with profiled("impact_service"):
+        main()
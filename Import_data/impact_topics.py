@@ -1,13 +1,44 @@
-from impact_un_topic import CSOTopicImpactCalculator
+from impact_un_topic import load_calculator
+from collections import defaultdict
+from statistics import NormalDist
+import argparse
+import json
+import math
+import random
 import numpy as np
-import networkx as nx
+
+from profiling import phase, profiled
+
+CSV_FILE = "Input/CSO.3.4.1.csv"
+SPECIFIC_TOPICS_FILE = "Output/specific_topics.txt"
+SNAPSHOT_FILE = "Output/cso_calculator.pkl"
+
+# Approximate cohesion: groups up to EXACT_MAX_TOPICS topics are always
+# computed exactly; larger ones sample PAIRS_PER_TOPIC pairs per topic.
+EXACT_MAX_TOPICS = 60
+PAIRS_PER_TOPIC = 20
+# Depth of the CSO areas pairs are stratified by.
+STRATUM_DEPTH = 2
+CONFIDENCE = 0.95
+
+def pair_at(index, size):
+    # index-th pair (i < j) of range(size) in lexicographic order.
+    i = size - 2 - int(math.sqrt(4 * size * (size - 1) - 8 * index - 7) / 2 - 0.5)
+    j = index + i + 1 - size * (size - 1) // 2 + (size - i) * (size - i - 1) // 2
+    return i, j
 
 class TopicGroupImpactCalculator:
-    def __init__(self, csocalculator):
+    def __init__(self, csocalculator, approximate = False, confidence = CONFIDENCE,
+                 exact_max_topics = EXACT_MAX_TOPICS, pairs_per_topic = PAIRS_PER_TOPIC, seed = 0):
         self.cso = csocalculator
         self.alpha = self.cso.alpha
         self.beta = self.cso.beta
         self.gamma = self.cso.gamma
+        self.approximate = approximate
+        self.confidence = confidence
+        self.exact_max_topics = exact_max_topics
+        self.pairs_per_topic = pairs_per_topic
+        self.seed = seed
 
     def compute_internal_cohesion(self, topics):
         n = len(topics)
@@ -28,29 +59,91 @@ class TopicGroupImpactCalculator:
 
         return total_similarity / count if count > 0 else 0.0
 
-    def compute_group_impact(self, topics):
+    def _area(self, topic, level):
+        # Deepest ancestor at most `level` deep: the area a topic is
+        # stratified by (the topic itself when it is shallow enough).
+        ancestors = [a for a in self.cso.get_ancestors(topic) if self.cso.calculate_depth(a) <= level]
+        return max(ancestors, key = lambda a: (self.cso.calculate_depth(a), a), default = topic)
+
+    def _strata(self, topics, budget):
+        # (topics, other topics or None for pairs within, number of pairs);
+        # coarser areas when there are too many strata to sample each twice.
+        for level in range(STRATUM_DEPTH, -1, -1):
+            clusters = defaultdict(list)
+            for topic in topics:
+                clusters[self._area(topic, level)].append(topic)
+            members = [clusters[area] for area in sorted(clusters)]
+            if len(members) * (len(members) + 1) // 2 <= budget // 4 or level == 0:
+                break
+        strata = []
+        for a in range(len(members)):
+            for b in range(a, len(members)):
+                if a == b:
+                    size = len(members[a]) * (len(members[a]) - 1) // 2
+                else:
+                    size = len(members[a]) * len(members[b])
+                if size:
+                    strata.append((members[a], members[b] if a != b else None, size))
+        return strata
+
+    def estimate_internal_cohesion(self, topics):
+        # Returns (cohesion, error bound). Pairs are stratified by the CSO
+        # areas of their two topics: pairs within an area are the similar
+        # ones, pairs across areas are mostly unrelated, so each stratum is
+        # far more homogeneous than the whole group. Every stratum gets a
+        # share of the sample proportional to its size (at least two pairs)
+        # and the bound is the half-width of the normal confidence interval
+        # of the stratified mean, finite-population corrected.
+        n = len(topics)
+        total = n * (n - 1) // 2
+        budget = self.pairs_per_topic * n
+        if not self.approximate or n <= self.exact_max_topics or budget >= total:
+            return self.compute_internal_cohesion(topics), 0.0
+
+        rng = random.Random(self.seed)
+        estimate, variance = 0.0, 0.0
+        for first, second, size in self._strata(topics, budget):
+            share = min(size, max(2, round(budget * size / total)))
+            indexes = rng.sample(range(size), share)
+            if second is None:
+                pairs = [pair_at(index, len(first)) for index in indexes]
+                sims = [self.cso.calculate_lin_similarity(first[i], first[j]) for i, j in pairs]
+            else:
+                sims = [self.cso.calculate_lin_similarity(first[index // len(second)], second[index % len(second)])
+                        for index in indexes]
+            weight = size / total
+            estimate += weight * np.mean(sims)
+            if share < size:
+                variance += weight ** 2 * (1 - share / size) * np.var(sims, ddof = 1) / share
+
+        z = NormalDist().inv_cdf((1 + self.confidence) / 2)
+        return float(estimate), float(z * math.sqrt(variance))
+
+    def compute_group_impact(self, topics, reference_topics = None):
+        # reference_topics only matters for single-topic groups; callers scoring
+        # many groups should pass the same list every time.
         valid_topics = [t for t in topics if t in self.cso.graph.nodes()]
         n = len(valid_topics)
-        m = self.cso.graph.number_of_nodes()
         
         if n == 0:
             return {'error': 'Aucun topic valide dans le groupe.'}
         
         if n == 1:
             topic = valid_topics[0]
-            reference_topics = list(self.cso.specific_topics.intersection(set(self.cso.graph.nodes())))[:m]
+            if reference_topics is None:
+                reference_topics = self.cso.all_reference_topics()
             impact = self.cso.calculate_impact_factor(topic, reference_topics)
             return impact
 
         depths = [self.cso.calculate_depth(t) for t in valid_topics]
-        max_depth = max(self.cso.depth_cache.values()) if self.cso.depth_cache else 1
+        max_depth = self.cso.max_depth
         mean_depth_score = np.mean([d / max_depth for d in depths]) if max_depth > 0 else 0
 
         influences = [self.cso.calculate_influence_score(t) for t in valid_topics]
-        max_infl = max(self.cso.influence_cache.values()) if self.cso.influence_cache else 1
+        max_infl = self.cso.max_influence
         mean_influence_score = np.mean([i / max_infl for i in influences]) if max_infl > 0 else 0
 
-        cohesion_score = self.compute_internal_cohesion(valid_topics)
+        cohesion_score, cohesion_error = self.estimate_internal_cohesion(valid_topics)
 
         impact_factor = (
             self.alpha * mean_depth_score +
@@ -63,20 +156,40 @@ class TopicGroupImpactCalculator:
             'depth_score': mean_depth_score,
             'influence_score': mean_influence_score,
             'semantic_cohesion': cohesion_score,
+            'cohesion_error': cohesion_error,
             'impact_factor': impact_factor
         }
 
-if __name__ == "__main__":
-    calculator = CSOTopicImpactCalculator(
-        csv_file_path = "Input/CSO.3.4.1.csv",
-        specific_topics_file = "Output/specific_topics.txt"
-    )
+def main():
+    # The calculator comes from the snapshot written by load_calculator, so
+    # after the first run a query only pays for unpickling the graph.
+    parser = argparse.ArgumentParser(description = "Impact factor of a group of CSO topics.")
+    parser.add_argument("topics", nargs = "*", default = ["chromosome translocation 18"])
+    parser.add_argument("--csv", default = CSV_FILE)
+    parser.add_argument("--specific", default = SPECIFIC_TOPICS_FILE)
+    parser.add_argument("--snapshot", default = SNAPSHOT_FILE)
+    parser.add_argument("--json", action = "store_true", help = "Print the result as JSON")
+    parser.add_argument("--approximate", action = "store_true",
+                        help = f"Sample the cohesion pairs of groups over {EXACT_MAX_TOPICS} topics")
+    parser.add_argument("--confidence", type = float, default = CONFIDENCE,
+                        help = "Confidence level of the cohesion_error bound")
+    args = parser.parse_args()
+
+    calculator = load_calculator(args.csv, args.specific, snapshot_path = args.snapshot)
+    group_calculator = TopicGroupImpactCalculator(calculator, approximate = args.approximate,
+                                                  confidence = args.confidence)
 
-    group_calculator = TopicGroupImpactCalculator(calculator)
+    with phase("scoring"):
+        result = group_calculator.compute_group_impact(args.topics)
+
+    if args.json:
+        print(json.dumps(result, default = float))
+        return
 
-    topics = ["chromosome translocation 18"]
-    result = group_calculator.compute_group_impact(topics)
-    
     print("\nRésultat du facteur d'impact du groupe :")
     for key, value in result.items():
-        print(f"{key}: {value}")
\ No newline at end of file
+        print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    with profiled("impact_topics"):
+        main()
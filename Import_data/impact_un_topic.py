@@ -1,24 +1,20 @@
-import pandas as pd
 import numpy as np
-import urllib.parse
-import re
 import networkx as nx
-from nltk.stem import WordNetLemmatizer
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
+import heapq
 import math
-import nltk
+import os
+import pickle
 
-try:
-    nltk.download('wordnet', quiet = True)
-    nltk.download('omw-1.4', quiet = True)
-except:
-    pass
+from profiling import phase, profiled
+from topic_labels import extract_topic
+
+REFERENCE_CACHE_SIZE = 4
 
 class CSOTopicImpactCalculator:
-    def __init__(self, csv_file_path, specific_topics_file):
+    def __init__(self, csv_file_path, specific_topics_file, compute_centrality = True):
         self.csv_file = csv_file_path
         self.specific_topics_file = specific_topics_file
-        self.lemmatizer = WordNetLemmatizer()
         
         self.graph = nx.DiGraph()
         self.reverse_graph = defaultdict(list)
@@ -30,31 +26,53 @@ class CSOTopicImpactCalculator:
         self.influence_cache = {}
         self.centrality_cache = {}
         self.frequency_cache = {}
+        self.ancestor_cache = {}
+        self.descendant_cache = {}
+        self.total_frequency = 0
+        self.max_depth = 0
+        self.max_influence = 0.0
+        self._init_reference_cache()
+        self._min_descendant_ic = None
+        self.similar_cache = OrderedDict()
+        self.similar_cache_size = 1024
         
         self.alpha = 0.4
         self.beta = 0.35
         self.gamma = 0.25
         
-        self.load_data()
-        self._compute_topic_frequencies()
-        self._compute_centrality_measures()
+        with phase("load"):
+            self.load_data()
+            self._compute_topic_frequencies()
+            self._compute_depths()
+        if compute_centrality:
+            with phase("centrality"):
+                self._compute_centrality_measures()
+                self._compute_influence_scores()
     
+    def _init_reference_cache(self):
+        # id(reference list) -> (list, length, content key), and the bitmask
+        # indexes of the last REFERENCE_CACHE_SIZE reference sets by content.
+        self._reference_ids = OrderedDict()
+        self._reference_indexes = OrderedDict()
+        self._fallback_references = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("_reference_ids", "_reference_indexes", "_fallback_references", "_reference_index"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        state.pop("_reference_index", None)
+        self.__dict__.update(state)
+        self._init_reference_cache()
+
     def extract_topic(self, uri):
-        if isinstance(uri, str) and "topics/" in uri:
-            topics = uri.split("/")[-1]
-            topics = urllib.parse.unquote(topics)
-            topics = topics.lower()
-            topics = re.sub(r"\s*\([^)]*\)", "", topics)
-            topics = topics.replace("-", "").replace("_", " ")
-            topics = topics.strip().lower().strip(">")
-            topics = re.sub(r"\s+", " ", topics).strip()
-            words = topics.split()
-            lemmatized = [self.lemmatizer.lemmatize(word, pos = 'n') for word in words]
-            topics = " ".join(lemmatized)
-            return topics
-        return None
+        return extract_topic(uri)
     
     def load_data(self):
+        import pandas as pd
+
         print("Chargement des données...")
         
         with open(self.specific_topics_file, 'r', encoding = 'utf-8') as f:
@@ -93,6 +111,8 @@ class CSOTopicImpactCalculator:
             
             frequency = in_degree + out_degree + len(self.equivalents.get(node, []))
             self.frequency_cache[node] = max(1, frequency)  
+
+        self.total_frequency = sum(self.frequency_cache.values())
     
     def _compute_centrality_measures(self):
         degree_centrality = nx.degree_centrality(self.graph)
@@ -106,7 +126,7 @@ class CSOTopicImpactCalculator:
             if self.graph.number_of_nodes() < 1000:
                 betweenness_centrality = nx.betweenness_centrality(self.graph)
             else:
-                betweenness_centrality = nx.betweenness_centrality(self.graph, k = min(100, self.graph.number_of_nodes()))
+                betweenness_centrality = nx.betweenness_centrality(self.graph, k = min(100, self.graph.number_of_nodes()), seed = 0)
         except:
             betweenness_centrality = {node: 0 for node in self.graph.nodes()}
         
@@ -118,6 +138,30 @@ class CSOTopicImpactCalculator:
             )
             self.centrality_cache[node] = combined_centrality
     
+    def _compute_depths(self):
+        depths = [self.calculate_depth(node) for node in self.graph.nodes()]
+        self.max_depth = max(depths) if depths else 0
+    
+    def _compute_influence_scores(self):
+        # Influence only depends on per-node counts and the centrality vector,
+        # so the whole graph is scored at load time and normalised by one
+        # global maximum, whatever order topics are scored in later.
+        nodes = list(self.graph.nodes())
+        if not nodes:
+            return
+        
+        children = np.array([self.graph.out_degree(n) for n in nodes], dtype = float)
+        parents = np.array([self.graph.in_degree(n) for n in nodes], dtype = float)
+        equivalents = np.array([len(self.equivalents.get(n, [])) for n in nodes], dtype = float)
+        contributions = np.array([len(self.contributions.get(n, [])) for n in nodes], dtype = float)
+        centrality = np.array([self.centrality_cache.get(n, 0) for n in nodes], dtype = float)
+        
+        connectivity = children + 0.5 * parents + 0.3 * equivalents + 0.2 * contributions
+        influence = 0.6 * centrality + 0.4 * np.log(1 + connectivity)
+        
+        self.influence_cache = dict(zip(nodes, influence.tolist()))
+        self.max_influence = float(influence.max())
+    
     def calculate_depth(self, topic_id, visited = None):
         if visited is None:
             visited = set()
@@ -152,29 +196,41 @@ class CSOTopicImpactCalculator:
         if topic_id not in self.frequency_cache:
             return 0.0
         
-        total_freq = sum(self.frequency_cache.values())
-        if total_freq == 0:
+        if self.total_frequency == 0:
             return 0.0
         
-        prob = self.frequency_cache[topic_id] / total_freq
+        prob = self.frequency_cache[topic_id] / self.total_frequency
         return -math.log(prob + 1e-10)
     
+    def get_ancestors(self, topic_id):
+        if topic_id not in self.ancestor_cache:
+            ancestors = set(nx.ancestors(self.graph, topic_id))
+            ancestors.add(topic_id)
+            self.ancestor_cache[topic_id] = frozenset(ancestors)
+        return self.ancestor_cache[topic_id]
+    
+    def get_descendants(self, topic_id):
+        if topic_id not in self.descendant_cache:
+            descendants = set(nx.descendants(self.graph, topic_id))
+            descendants.add(topic_id)
+            self.descendant_cache[topic_id] = frozenset(descendants)
+        return self.descendant_cache[topic_id]
+    
+    def _lca_key(self, topic_id):
+        # Deepest ancestor wins; equally deep ones are ordered by IC so the
+        # choice no longer depends on set iteration order.
+        return (self.calculate_depth(topic_id), self.calculate_information_content(topic_id))
+    
     def find_lowest_common_ancestor(self, topic1, topic2):
         if topic1 not in self.graph.nodes() or topic2 not in self.graph.nodes():
             return None
         
         try:
-            ancestors1 = set(nx.ancestors(self.graph, topic1))
-            ancestors1.add(topic1)
-            
-            ancestors2 = set(nx.ancestors(self.graph, topic2))
-            ancestors2.add(topic2)
-            
-            common_ancestors = ancestors1.intersection(ancestors2)
+            common_ancestors = self.get_ancestors(topic1) & self.get_ancestors(topic2)
             if not common_ancestors:
                 return None
             
-            lca = max(common_ancestors, key = lambda x: self.calculate_depth(x))
+            lca = max(common_ancestors, key = self._lca_key)
             return lca
         except:
             return None
@@ -199,61 +255,208 @@ class CSOTopicImpactCalculator:
         
         return (2 * ic_lca) / (ic1 + ic2)
     
+    def _compute_min_descendant_ic(self):
+        # The graph also carries equivalence/contribution edges and may have
+        # cycles, so the minimum is propagated over the condensation.
+        condensed = nx.condensation(self.graph)
+        scc_min = {}
+        for scc in reversed(list(nx.topological_sort(condensed))):
+            value = min(self.calculate_information_content(n) for n in condensed.nodes[scc]['members'])
+            for child in condensed.successors(scc):
+                value = min(value, scc_min[child])
+            scc_min[scc] = value
+        
+        mapping = condensed.graph['mapping']
+        self._min_descendant_ic = {node: scc_min[mapping[node]] for node in self.graph.nodes()}
+    
+    def _similarity_bound(self, ic_topic, ancestor):
+        denominator = ic_topic + self._min_descendant_ic[ancestor]
+        if denominator <= 0:
+            return math.inf
+        return (2 * self.calculate_information_content(ancestor)) / denominator
+    
+    def _search_most_similar(self, topic_id, k, min_sim):
+        if topic_id not in self.graph or k <= 0:
+            return []
+        if self._min_descendant_ic is None:
+            self._compute_min_descendant_ic()
+        
+        scores = {}
+        for equivalent in self.equivalents.get(topic_id, []):
+            if equivalent != topic_id and equivalent in self.graph and 0.9 >= min_sim:
+                scores[equivalent] = 0.9
+        kth = heapq.nlargest(k, scores.values())
+        heapq.heapify(kth)
+        
+        ic_topic = self.calculate_information_content(topic_id)
+        ancestors = self.get_ancestors(topic_id)
+        ranks = {a: self._lca_key(a) for a in ancestors}
+        bounds = sorted(((self._similarity_bound(ic_topic, a), a) for a in ranks), reverse = True)
+        
+        seen = set(self.equivalents.get(topic_id, []))
+        seen.add(topic_id)
+        for bound, ancestor in bounds:
+            # Every unseen candidate has its LCA among the remaining ancestors,
+            # so none of them can beat the current k-th score.
+            threshold = kth[0] if len(kth) >= k else min_sim
+            if bound < max(threshold, min_sim):
+                break
+            
+            for candidate in self.get_descendants(ancestor) - seen:
+                seen.add(candidate)
+                
+                lca = max(self.get_ancestors(candidate) & ancestors, key = ranks.get)
+                if not lca:
+                    continue
+                denominator = ic_topic + self.calculate_information_content(candidate)
+                if denominator == 0:
+                    continue
+                sim = (2 * self.calculate_information_content(lca)) / denominator
+                if sim <= 0 or sim < min_sim:
+                    continue
+                
+                scores[candidate] = sim
+                if len(kth) < k:
+                    heapq.heappush(kth, sim)
+                elif sim > kth[0]:
+                    heapq.heapreplace(kth, sim)
+        
+        ranked = sorted(scores.items(), key = lambda x: (-x[1], x[0]))
+        return ranked[:k]
+    
+    def most_similar(self, topic_id, k = 10, min_sim = 0.0):
+        key = (topic_id, k, min_sim)
+        if key in self.similar_cache:
+            self.similar_cache.move_to_end(key)
+            return list(self.similar_cache[key])
+        
+        result = self._search_most_similar(topic_id, k, min_sim)
+        self.similar_cache[key] = result
+        if len(self.similar_cache) > self.similar_cache_size:
+            self.similar_cache.popitem(last = False)
+        return list(result)
+    
+    def most_similar_batch(self, topic_ids, k = 10, min_sim = 0.0):
+        return {topic_id: self.most_similar(topic_id, k, min_sim) for topic_id in topic_ids}
+    
     def calculate_influence_score(self, topic_id):
-        if topic_id in self.influence_cache:
-            return self.influence_cache[topic_id]
-        
-        if topic_id not in self.graph.nodes():
-            return 0.0
-        
-        centrality_score = self.centrality_cache.get(topic_id, 0)
-        
-        children_count = self.graph.out_degree(topic_id)
-        parents_count = self.graph.in_degree(topic_id)
-        
-        equiv_count = len(self.equivalents.get(topic_id, []))
-        contrib_count = len(self.contributions.get(topic_id, []))
-        
-        connectivity_score = children_count + 0.5 * parents_count + 0.3 * equiv_count + 0.2 * contrib_count
-        
-        influence = 0.6 * centrality_score + 0.4 * math.log(1 + connectivity_score)
-        
-        self.influence_cache[topic_id] = influence
-        return influence
+        return self.influence_cache.get(topic_id, 0.0)
     
-    def calculate_semantic_weight(self, topic_id, reference_topics):
-        n = self.graph.number_of_nodes()
-        if not reference_topics:
+    def all_reference_topics(self):
+        # Built once, so every caller falling back to it shares one cached index.
+        if self._fallback_references is None:
+            n = self.graph.number_of_nodes()
             if self.specific_topics:
-                reference_topics = list(self.specific_topics.intersection(set(self.graph.nodes())))[:n]
+                self._fallback_references = list(self.specific_topics.intersection(set(self.graph.nodes())))[:n]
             else:
                 sorted_topics = sorted(self.centrality_cache.items(), key = lambda x: x[1], reverse = True)
-                reference_topics = [t[0] for t in sorted_topics[:n]]
+                self._fallback_references = [t[0] for t in sorted_topics[:n]]
+        return self._fallback_references
+
+    def calculate_semantic_weight(self, topic_id, reference_topics):
+        if not reference_topics:
+            reference_topics = self.all_reference_topics()
         
         if not reference_topics:
             return 0.0
         
-        similarities = []
-        for ref_topic in reference_topics:
-            if ref_topic != topic_id and ref_topic in self.graph.nodes():
-                sim = self.calculate_lin_similarity(topic_id, ref_topic)
-                similarities.append(sim)
+        index = self._get_reference_index(reference_topics)
+        return self._mean_reference_similarity(topic_id, index)
+    
+    def _get_reference_index(self, reference_topics):
+        # Callers score many topics against the same list, so the list's
+        # identity is looked up first, in O(1); the content key is only built
+        # for a list not seen before. Several indexes are kept, so callers
+        # alternating between reference sets do not rebuild each other's.
+        # A reference list must not be modified once it has been scored against.
+        seen = self._reference_ids.get(id(reference_topics))
+        if seen is not None and seen[0] is reference_topics and seen[1] == len(reference_topics):
+            key = seen[2]
+            counts = None
+        else:
+            counts = Counter(t for t in reference_topics if t in self.graph)
+            key = frozenset(counts.items())
+            self._reference_ids[id(reference_topics)] = (reference_topics, len(reference_topics), key)
+            if len(self._reference_ids) > 4 * REFERENCE_CACHE_SIZE:
+                self._reference_ids.popitem(last = False)
+        if key in self._reference_indexes:
+            self._reference_indexes.move_to_end(key)
+            return self._reference_indexes[key]
+        if counts is None:
+            counts = Counter(t for t in reference_topics if t in self.graph)
+        
+        # One bit per distinct reference topic. Every ancestor keeps the mask of
+        # the references below it, and references are grouped by (IC, multiplicity)
+        # so the Lin denominator can be applied per group instead of per pair.
+        positions = {}
+        descendant_masks = defaultdict(int)
+        groups = defaultdict(int)
+        for ref_topic, multiplicity in counts.items():
+            bit = 1 << len(positions)
+            positions[ref_topic] = len(positions)
+            for ancestor in self.get_ancestors(ref_topic):
+                descendant_masks[ancestor] |= bit
+            groups[(self.calculate_information_content(ref_topic), multiplicity)] |= bit
+        
+        index = {
+            'counts': counts,
+            'total': sum(counts.values()),
+            'positions': positions,
+            'descendant_masks': dict(descendant_masks),
+            'groups': list(groups.items())
+        }
+        self._reference_indexes[key] = index
+        if len(self._reference_indexes) > REFERENCE_CACHE_SIZE:
+            self._reference_indexes.popitem(last = False)
+        return index
+    
+    def _mean_reference_similarity(self, topic_id, index):
+        counts = index['counts']
+        total_count = index['total'] - counts.get(topic_id, 0)
+        if total_count == 0 or topic_id not in self.graph:
+            return 0.0
         
-        return np.mean(similarities) if similarities else 0.0
+        positions = index['positions']
+        claimed = 1 << positions[topic_id] if topic_id in positions else 0
+        total = 0.0
+        
+        for equivalent in set(self.equivalents.get(topic_id, [])):
+            if equivalent in positions and not claimed >> positions[equivalent] & 1:
+                claimed |= 1 << positions[equivalent]
+                total += 0.9 * counts[equivalent]
+        
+        # Walking the ancestors from deepest to shallowest, each reference is
+        # claimed by the first one it descends from, which is exactly its LCA.
+        ic_topic = self.calculate_information_content(topic_id)
+        masks = index['descendant_masks']
+        for ancestor in sorted(self.get_ancestors(topic_id), key = self._lca_key, reverse = True):
+            new = masks.get(ancestor, 0) & ~claimed
+            if not new:
+                continue
+            claimed |= new
+            if not ancestor:
+                continue
+            
+            ic_ancestor = self.calculate_information_content(ancestor)
+            for (ic_ref, multiplicity), group in index['groups']:
+                matched = (new & group).bit_count()
+                if matched and ic_topic + ic_ref != 0:
+                    total += matched * multiplicity * (2 * ic_ancestor) / (ic_topic + ic_ref)
+        
+        return total / total_count
     
-    def calculate_impact_factor(self, topic_id, reference_topics):
+    def calculate_impact_factor(self, topic_id, reference_topics, semantic_score = None):
         if topic_id not in self.graph.nodes():
             return {'error': f'Topic {topic_id} not found'}
         
         depth = self.calculate_depth(topic_id)
-        max_depth = max([self.calculate_depth(t) for t in self.graph.nodes()]) if self.graph.nodes() else 1
-        depth_score = depth / max_depth if max_depth > 0 else 0
+        depth_score = depth / self.max_depth if self.max_depth > 0 else 0
         
         influence = self.calculate_influence_score(topic_id)
-        max_influence = max(self.influence_cache.values()) if self.influence_cache else 1
-        influence_score = influence / max_influence if max_influence > 0 else 0
+        influence_score = influence / self.max_influence if self.max_influence > 0 else 0
         
-        semantic_score = self.calculate_semantic_weight(topic_id, reference_topics)
+        if semantic_score is None:
+            semantic_score = self.calculate_semantic_weight(topic_id, reference_topics)
         
         impact_factor = (
             self.alpha * depth_score +
@@ -272,6 +475,23 @@ class CSOTopicImpactCalculator:
             'impact_factor': impact_factor
         }
     
+    def default_reference_topics(self, limit = 20):
+        reference_topics = sorted(self.specific_topics.intersection(set(self.graph.nodes())))[:limit]
+        if not reference_topics:
+            sorted_topics = sorted(self.centrality_cache.items(), key = lambda x: x[1], reverse = True)
+            reference_topics = [t[0] for t in sorted_topics[:limit]]
+        return reference_topics
+    
+    def save_snapshot(self, snapshot_path):
+        with open(snapshot_path, 'wb') as f:
+            pickle.dump(self, f, protocol = pickle.HIGHEST_PROTOCOL)
+        print(f"Snapshot enregistré: {snapshot_path}")
+    
+    @staticmethod
+    def load_snapshot(snapshot_path):
+        with open(snapshot_path, 'rb') as f:
+            return pickle.load(f)
+    
     def rank_topics_by_impact(self, topic_ids=None, top_k=10, specific_topics_only=False):
         if topic_ids is None:
             if specific_topics_only:
@@ -281,32 +501,46 @@ class CSOTopicImpactCalculator:
 
         print(f"Analyse de {len(topic_ids)} topics...")
 
-        reference_topics = list(self.specific_topics.intersection(set(self.graph.nodes())))[:20]
-        if not reference_topics:
-            sorted_topics = sorted(self.centrality_cache.items(), key = lambda x: x[1], reverse = True)
-            reference_topics = [t[0] for t in sorted_topics[:20]]
+        reference_topics = self.default_reference_topics()
 
         results = []
-        for i, topic_id in enumerate(topic_ids):
-            if i % 100 == 0:
-                print(f"Progression: {i}/{len(topic_ids)}")
+        with phase("scoring"):
+            for i, topic_id in enumerate(topic_ids):
+                if i % 100 == 0:
+                    print(f"Progression: {i}/{len(topic_ids)}")
 
-            impact_data = self.calculate_impact_factor(topic_id, reference_topics)
-            if 'error' not in impact_data:
-                results.append(impact_data)
+                impact_data = self.calculate_impact_factor(topic_id, reference_topics)
+                if 'error' not in impact_data:
+                    results.append(impact_data)
 
         results.sort(key=lambda x: x['impact_factor'], reverse=True)
 
         return results[:top_k]
     
+def load_calculator(csv_file_path, specific_topics_file, snapshot_path = None):
+    if snapshot_path and os.path.exists(snapshot_path):
+        snapshot_mtime = os.path.getmtime(snapshot_path)
+        if all(os.path.getmtime(p) <= snapshot_mtime for p in (csv_file_path, specific_topics_file)):
+            print(f"Chargement du snapshot: {snapshot_path}")
+            return CSOTopicImpactCalculator.load_snapshot(snapshot_path)
+
+    calculator = CSOTopicImpactCalculator(csv_file_path, specific_topics_file)
+    if snapshot_path:
+        calculator.save_snapshot(snapshot_path)
+    return calculator
+
 if __name__ == "__main__":
-    calculator = CSOTopicImpactCalculator(
-        csv_file_path = "Input/CSO.3.4.1.csv",
-        specific_topics_file = "Output/specific_topics.txt"
-    )
+    import pandas as pd
+
+    with profiled("impact_un_topic"):
+        calculator = CSOTopicImpactCalculator(
+            csv_file_path = "Input/CSO.3.4.1.csv",
+            specific_topics_file = "Output/specific_topics.txt"
+        )
 
-    print("\nExportation des topics spécifiques classés par facteur d'impact...")
-    all_specific_ranked = calculator.rank_topics_by_impact(specific_topics_only = True, top_k = len(calculator.specific_topics))
-    df_export = pd.DataFrame(all_specific_ranked)
-    df_export.to_csv("Output/specific_topics_ranked.csv", index = False, encoding = 'utf-8')
-    print("Export terminé : Output/specific_topics_ranked.csv")
\ No newline at end of file
+        print("\nExportation des topics spécifiques classés par facteur d'impact...")
+        all_specific_ranked = calculator.rank_topics_by_impact(specific_topics_only = True, top_k = len(calculator.specific_topics))
+        with phase("write"):
+            df_export = pd.DataFrame(all_specific_ranked)
+            df_export.to_csv("Output/specific_topics_ranked.csv", index = False, encoding = 'utf-8')
+        print("Export terminé : Output/specific_topics_ranked.csv")
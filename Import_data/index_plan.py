@@ -0,0 +1,142 @@
+# Declarative secondary indexes for the collections the pipeline writes and
+# the backend reads. Stages drop the planned indexes before a bulk load and
+# rebuild them in one createIndexes pass at the end, keeping only the ones a
+# stage reads through while it writes (LOAD_INDEXES). `python index_plan.py
+# verify` explains the backend's query shapes and reports any that would
+# still scan a whole collection.
+
+import argparse
+import logging
+import time
+
+from metrics import stage_metrics
+from sampling import current_sample
+from sharding import base_collection
+from storage import get_storage
+
+INDEX_PLAN = {
+    "papers": [[("corpusid", 1)]],
+    "annotated_papers": [[("corpusid", 1)]],
+    "authors": [[("authorid", 1)], [("hindex", -1)]],
+    "papers_with_annotations": [
+        [("corpusid", 1)],
+        [("authors.authorId", 1), ("updated", -1)],
+        [("authors.authorId", 1), ("year", -1)],
+        [("citationcount", -1)]
+    ],
+    "authors_papers_annotations": [[("authorId", 1)]],
+    "author_paper_topics": [[("authorId", 1)], [("corpusId", 1)]],
+    "author_topics": [[("authorId", 1)]],
+    "author_specific_topics": [[("authorId", 1)], [("topics", 1)]],
+    "corpus_specific_topics": [[("corpusId", 1)], [("topics", 1)]],
+    "specific_topics": [[("topic", 1)]],
+    "similar_authors": [[("authorId", 1)]],
+    "topic_cooccurrence": [[("topic", 1)]],
+    "specific_topic_cooccurrence": [[("topic", 1)]],
+    "author_topic_rollup": [[("authorId", 1)], [("areas", 1)]],
+    "corpus_topic_rollup": [[("corpusId", 1)], [("areas", 1)]],
+    "paper_impact": [[("corpusid", 1)], [("impact_factor", -1)]]
+}
+
+# Indexes that must exist while the collection is being written, shard
+# collections included: the upserts in author_paper look documents up by
+# authorId. The rest of the plan is built on the merged collection.
+LOAD_INDEXES = {
+    "authors_papers_annotations": [[("authorId", 1)]]
+}
+
+# (route, collection, filter, sort) as issued by repa_backend/routers.
+QUERY_SHAPES = [
+    ("GET /papers/:corpus_id", "papers", {"corpusid": 0}, None),
+    ("GET /annotated_papers/:corpus_id", "annotated_papers", {"corpusid": 0}, None),
+    ("GET /papers_with_annotations/:corpus_id", "papers_with_annotations", {"corpusid": 0}, None),
+    ("GET /papers_with_annotations/author/:author_id", "papers_with_annotations", {"authors.authorId": "0"}, None),
+    ("GET /papers_with_annotations/latest_paper_title/:authorId", "papers_with_annotations",
+        {"authors.authorId": "0"}, [("year", -1)]),
+    ("GET /papers_with_annotations/citation_count", "papers_with_annotations",
+        {"citationcount": {"$ne": None}}, [("citationcount", -1)]),
+    ("GET /authors/:author_id", "papers_with_annotations", {"authors.authorId": "0"}, [("updated", -1)]),
+    ("GET /authors/:author_id", "authors", {"authorid": "0"}, None),
+    ("GET /authors/:author_id/coauthors", "authors", {"authorid": {"$in": ["0"]}}, None),
+    ("GET /authors/hindex", "authors", {"hindex": {"$ne": None}}, [("hindex", -1)]),
+    ("GET /authors_papers_annotations/:author_id", "authors_papers_annotations", {"authorId": "0"}, None),
+    ("GET /author_paper_topics/author/:author_id", "author_paper_topics", {"authorId": "0"}, None),
+    ("GET /author_paper_topics/corpus/:corpus_id", "author_paper_topics", {"corpusId": 0}, None),
+    ("GET /author_topics/:author_id", "author_topics", {"authorId": "0"}, None),
+    ("GET /author_specific_topics/:author_id", "author_specific_topics", {"authorId": "0"}, None),
+    ("GET /specific_topics/search", "author_specific_topics", {"topics": {"$in": [""]}}, None),
+    ("GET /corpus_specific_topics/:corpus_id", "corpus_specific_topics", {"corpusId": 0}, None),
+    ("GET /specific_topics/search", "corpus_specific_topics", {"topics": {"$in": [""]}}, None),
+    ("GET /paper_impact/ranking", "paper_impact", {}, [("impact_factor", -1)]),
+    ("GET /paper_impact/:corpus_id", "paper_impact", {"corpusid": 0}, None)
+]
+
+def prepare_for_load(storage, *names):
+    for name in names:
+        keep = LOAD_INDEXES.get(base_collection(name), [])
+        dropped = storage.drop_indexes(name, keep = keep)
+        if dropped:
+            logging.info(f"[{name}] Dropped indexes before load: {', '.join(dropped)}")
+        if keep:
+            storage.create_indexes(name, keep)
+
+def build_indexes(storage, *names):
+    metrics = stage_metrics()
+    for name in names or INDEX_PLAN:
+        indexes = INDEX_PLAN.get(name)
+        if not indexes:
+            continue
+        start = time.perf_counter()
+        storage.create_indexes(name, indexes)
+        elapsed = time.perf_counter() - start
+        metrics.observe("index_build_seconds", elapsed, collection = name)
+        logging.info(f"[{name}] Built {len(indexes)} index(es) in {elapsed:.1f}s")
+
+def verify(storage):
+    results = []
+    for route, name, query, sort in QUERY_SHAPES:
+        stages = storage.explain(name, query, sort)
+        uses_index = "COLLSCAN" not in stages and any(s in ("IXSCAN", "EXPRESS_IXSCAN", "IDHACK") for s in stages)
+        results.append((route, name, query, stages, uses_index))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Manage the secondary indexes of research_db.")
+    parser.add_argument("action", choices = ["show", "build", "drop", "verify"], nargs = "?", default = "verify")
+    parser.add_argument("collections", nargs = "*", help = "Limit build/drop to these collections")
+    parser.add_argument("--build", action = "store_true",
+                        help = "Build the planned indexes before verifying (local storage keeps them in memory only)")
+    current_sample()
+    args = parser.parse_args()
+    logging.basicConfig(format = "%(asctime)s - [%(levelname)s] %(message)s", level = logging.INFO)
+
+    names = args.collections or list(INDEX_PLAN)
+    if args.action == "show":
+        for name in names:
+            for keys in INDEX_PLAN.get(name, []):
+                during_load = " (kept during load)" if keys in LOAD_INDEXES.get(name, []) else ""
+                print(f"{name}: {', '.join(f'{field} {direction}' for field, direction in keys)}{during_load}")
+        return
+
+    storage = get_storage()
+    try:
+        if args.action == "build":
+            build_indexes(storage, *names)
+        elif args.action == "drop":
+            prepare_for_load(storage, *names)
+        else:
+            if args.build:
+                build_indexes(storage, *names)
+            results = verify(storage)
+            for route, name, query, stages, uses_index in results:
+                status = "ok  " if uses_index else "SCAN"
+                print(f"{status} {route:<58} {name}: {query} -> {' > '.join(stages)}")
+            scans = sum(1 for r in results if not r[4])
+            print(f"\n{len(results) - scans}/{len(results)} query shapes use an index.")
+            if scans:
+                raise SystemExit(1)
+    finally:
+        storage.close()
+
+if __name__ == "__main__":
+    main()
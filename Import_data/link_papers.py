@@ -1,57 +1,97 @@
 # Step 2: Link papers with their annotated topics by corpusid
 
-from pymongo import MongoClient
 from concurrent.futures import ThreadPoolExecutor
+import logging
 import threading
-from itertools import islice
+import time
 
-client = MongoClient('mongodb://localhost:27017/')
-db = client['research_db']
+from parallel_reader import reader_checkpoint
+from document_access import transfer_meter, with_field
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from sharding import current_shard, shard_collection, finish_shard
+from connection import configure_pool
+from metrics import stage_metrics
+from profiling import profiled
 
-papers_col = db['papers']
-annotated_col = db['annotated_papers']
-linked_col = db['papers_with_annotations']
-
-linked_col.delete_many({})
-
-annotated_col.create_index('corpusid')
+papers_col = 'papers'
+annotated_col = 'annotated_papers'
+linked_col = shard_collection('papers_with_annotations')
 
 lock = threading.Lock()  
 inserted_count = 0
 batch_size = 1000
 max_threads = 6
+num_readers = 4
+meter = transfer_meter("link_papers")
+
+# Papers are copied whole, so they are read without projection but stay raw
+# BSON; only corpusid is decoded and the annotation is appended as bytes.
+annotation_fields = {'_id': 0}
+
+logging.basicConfig(
+    format="%(asctime)s - [%(levelname)s] %(message)s",
+    level=logging.INFO
+)
 
-def link_annotation(paper):
+def link_annotation(storage, paper):
     corpusid = paper.get('corpusid')
     if not corpusid:
         return paper
 
-    annotation = annotated_col.find_one({'corpusid': corpusid})
-    if annotation:
-        annotation.pop('_id', None)
-        paper['annotation'] = annotation
-    else:
-        paper['annotation'] = None
-    return paper
-
-def batched_iterator(cursor, size):
-    while True:
-        batch = list(islice(cursor, size))
-        if not batch:
-            break
-        yield batch
+    annotation = storage.find_one(annotated_col, {'corpusid': corpusid}, annotation_fields, raw=True)
+    if meter:
+        meter.add(annotated_col, [annotation])
+    return with_field(paper, 'annotation', annotation if annotation else None)
 
-if __name__ == '__main__':
-    cursor = papers_col.find({}, no_cursor_timeout=True).batch_size(batch_size)
+def run(storage):
+    global inserted_count
+    metrics = stage_metrics("link_papers")
+    configure_pool(workers=max_threads, readers=num_readers)
+    build_indexes(storage, annotated_col)
+
+    reader = storage.reader(
+        papers_col,
+        num_ranges=num_readers,
+        batch_size=batch_size,
+        checkpoint_file=reader_checkpoint("link_papers"),
+        raw=True,
+        meter=meter,
+        shard=current_shard(),
+        shard_key='corpusid'
+    )
+    if not reader.resuming:
+        storage.clear(linked_col)
+    prepare_for_load(storage, linked_col)
 
-    for batch in batched_iterator(cursor, batch_size):
+    for batch in reader.batches():
+        batch_start = time.perf_counter()
         with ThreadPoolExecutor(max_workers=max_threads) as executor:
-            processed_batch = list(executor.map(link_annotation, batch))
+            processed_batch = list(executor.map(lambda paper: link_annotation(storage, paper), batch))
 
-        linked_col.insert_many(processed_batch)
+        if reader.resuming:
+            # Ranges that were not checkpointed may be partly written already.
+            storage.upsert_many(linked_col, ['_id'], processed_batch)
+        else:
+            storage.insert_many(linked_col, processed_batch)
+        metrics.record_batch("main", time.perf_counter() - batch_start)
 
         with lock:
             inserted_count += len(processed_batch)
-            print(f"Inserted and linked {inserted_count} papers...")
+            logging.info(f"Inserted and linked {inserted_count} papers ...")
 
-    print(f"\nDone. Total inserted: {inserted_count} documents in '{linked_col.name}'")
\ No newline at end of file
+    reader.clear_checkpoint()
+    build_indexes(storage, linked_col)
+    finish_shard(storage, "link_papers")
+    if meter:
+        meter.report()
+    metrics.close()
+    logging.info(f"Done. Total inserted: {inserted_count} documents in '{linked_col}'")
+
+if __name__ == '__main__':
+    storage = get_storage()
+    try:
+        with profiled("link_papers"):
+            run(storage)
+    finally:
+        storage.close()
@@ -1,48 +1,107 @@
 # Step 1: Load Data into MongoDB Collections
 
 import jsonlines
-from pymongo import MongoClient
 from concurrent.futures import ThreadPoolExecutor
+import logging
 import os
 
-client = MongoClient('mongodb://localhost:27017/')
-db = client['research_db']
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from sampling import current_sample
+from sharding import current_shard, shard_collection, finish_shard
+from connection import configure_pool
+from metrics import stage_metrics
+from profiling import profiled
+
+AUTHORS_FILE = 'Input/authors.jsonl'
+ANNOTATIONS_FILE = 'Input/D3_annotated_papers.jsonl'
+PAPERS_FILE = 'Input/papers.jsonl'
 
 collections = {
-    'Input/authors.jsonl': db['authors'],
-    'Input/D3_annotated_papers.jsonl': db['annotated_papers'],
-    'Input/papers.jsonl': db['papers']
+    AUTHORS_FILE: shard_collection('authors'),
+    ANNOTATIONS_FILE: shard_collection('annotated_papers'),
+    PAPERS_FILE: shard_collection('papers')
 }
 
-def import_jsonl_to_mongo(filepath, collection, batch_size = 1000):
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+def sampled_authors(sample):
+    # Authors follow their papers: an author is kept if any sampled paper
+    # lists them, whichever shard loads that paper.
+    authors = set()
+    if os.path.exists(PAPERS_FILE):
+        with jsonlines.open(PAPERS_FILE) as reader:
+            for doc in reader:
+                if sample.includes(doc.get('corpusid')):
+                    authors.update(str(author.get('authorId')) for author in doc.get('authors') or [])
+    logging.info(f"Sample {sample}: {len(authors)} authors of sampled papers")
+    return authors
+
+def sample_filters():
+    sample = current_sample()
+    if sample is None:
+        return {}
+    authors = sampled_authors(sample)
+    return {
+        AUTHORS_FILE: lambda doc: str(doc.get('authorid')) in authors,
+        ANNOTATIONS_FILE: lambda doc: sample.includes(doc.get('corpusid')),
+        PAPERS_FILE: lambda doc: sample.includes(doc.get('corpusid'))
+    }
+
+def import_jsonl_to_mongo(storage, filepath, collection, batch_size = 1000, keep = None):
     if not os.path.exists(filepath):
-        print(f"File not found: {filepath}")
+        logging.warning(f"File not found: {filepath}")
         return
 
     total_inserted = 0
     batch = []
+    # Input files have no key to hash, a shard takes every N-th line.
+    shard = current_shard()
     
     with jsonlines.open(filepath) as reader:
-        for doc in reader:
+        for line, doc in enumerate(reader):
+            if shard and line % shard.count != shard.index:
+                continue
+            if keep and not keep(doc):
+                continue
             batch.append(doc)
             if len(batch) >= batch_size:
-                collection.insert_many(batch)
+                storage.insert_many(collection, batch)
                 total_inserted += len(batch)
-                print(f"[{collection.name}] Inserted batch of {len(batch)} (Total: {total_inserted})")
+                logging.info(f"[{collection}] Inserted batch of {len(batch)} (Total: {total_inserted})")
                 batch.clear()
 
         if batch:
-            collection.insert_many(batch)
+            storage.insert_many(collection, batch)
             total_inserted += len(batch)
-            print(f"[{collection.name}] Inserted final batch of {len(batch)} (Total: {total_inserted})")
+            logging.info(f"[{collection}] Inserted final batch of {len(batch)} (Total: {total_inserted})")
 
-    print(f"[{collection.name}] Finished inserting {total_inserted} documents from {filepath}")      
+    logging.info(f"[{collection}] Finished inserting {total_inserted} documents from {filepath}")      
 
-if __name__ == '__main__':
+def run(storage):
+    metrics = stage_metrics("load_data")
+    configure_pool(workers = len(collections))
+    prepare_for_load(storage, *collections.values())
+    filters = sample_filters()
     with ThreadPoolExecutor(max_workers = 3) as executor:
         futures = []
         for filepath, collection in collections.items():
-            futures.append(executor.submit(import_jsonl_to_mongo, filepath, collection))
+            futures.append(executor.submit(import_jsonl_to_mongo, storage, filepath, collection,
+                                           keep = filters.get(filepath)))
         
         for future in futures:
-            future.result()
\ No newline at end of file
+            future.result()
+    build_indexes(storage, *collections.values())
+    finish_shard(storage, "load_data")
+    metrics.close()
+
+if __name__ == '__main__':
+    storage = get_storage()
+    try:
+        with profiled("load_data"):
+            run(storage)
+    finally:
+        storage.close()
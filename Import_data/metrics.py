@@ -0,0 +1,236 @@
+# Shared instrumentation for the pipeline stages: counters, gauges and
+# histograms kept in-process, Mongo command latency from pymongo's command
+# monitoring, and a periodic flush to a Prometheus textfile or a JSON-lines
+# file under Output/metrics/.
+#
+# REPA_METRICS=prometheus|jsonl turns the sink on, REPA_METRICS_DIR and
+# REPA_METRICS_INTERVAL (seconds) configure it.
+
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+import bisect
+import json
+import logging
+import os
+import time
+
+from sampling import sample_suffix
+from sharding import shard_suffix
+
+METRICS_DIR = "Output/metrics"
+FLUSH_INTERVAL = 15
+PREFIX = "repa_"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def metrics_sink():
+    sink = os.environ.get("REPA_METRICS", "").lower()
+    return sink if sink in ("prometheus", "jsonl") else None
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(labels, extra = ()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+class Histogram:
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            yield bound, total
+
+class StageMetrics:
+    def __init__(self, stage, sink = None, directory = None, interval = None):
+        self.stage = stage
+        self.sink = sink
+        self.directory = directory or os.environ.get("REPA_METRICS_DIR", METRICS_DIR)
+        self.interval = interval or float(os.environ.get("REPA_METRICS_INTERVAL", FLUSH_INTERVAL))
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = Lock()
+        self.stop = Event()
+        self.flusher = None
+        if self.sink:
+            os.makedirs(self.directory, exist_ok = True)
+            self.flusher = Thread(target = self._flush_loop, daemon = True)
+            self.flusher.start()
+
+    def inc(self, name, value = 1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def record_batch(self, worker_id, seconds):
+        # Batch latency plus the busy time used for the worker_utilization gauge.
+        self.observe("batch_seconds", seconds)
+        self.inc("worker_busy_seconds_total", seconds, worker = worker_id)
+
+    def _utilization(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            key: min(1.0, busy / elapsed)
+            for (name, key), busy in self.counters.items()
+            if name == "worker_busy_seconds_total"
+        }
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            for labels, value in self._utilization().items():
+                gauges[("worker_utilization", labels)] = value
+            histograms = {
+                key: (h.buckets, list(h.cumulative()), h.sum, h.count)
+                for key, h in self.histograms.items()
+            }
+        return counters, gauges, histograms
+
+    def render_prometheus(self):
+        counters, gauges, histograms = self.snapshot()
+        stage_label = (("stage", self.stage),)
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, "counter")
+            lines.append(f"{PREFIX}{name}{_format_labels(stage_label + labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{PREFIX}{name}{_format_labels(stage_label + labels)} {value}")
+        for (name, labels), (_, cumulative, total, count) in sorted(histograms.items()):
+            declare(name, "histogram")
+            for bound, bucket_count in cumulative:
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(stage_label + labels, (('le', bound),))} {bucket_count}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(stage_label + labels)} {total}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(stage_label + labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def render_jsonl(self):
+        counters, gauges, histograms = self.snapshot()
+        now = time.time()
+        records = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in values.items():
+                records.append({"ts": now, "stage": self.stage, "metric": name, "type": kind, "labels": dict(labels), "value": value})
+        for (name, labels), (buckets, cumulative, total, count) in histograms.items():
+            records.append({
+                "ts": now, "stage": self.stage, "metric": name, "type": "histogram", "labels": dict(labels),
+                "buckets": [[str(bound), c] for bound, c in cumulative], "sum": total, "count": count
+            })
+        return "".join(json.dumps(record) + "\n" for record in records)
+
+    def flush(self):
+        if self.sink == "prometheus":
+            path = os.path.join(self.directory, f"{self.stage}{shard_suffix()}{sample_suffix()}.prom")
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding = "utf-8") as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp_path, path)
+        elif self.sink == "jsonl":
+            with open(os.path.join(self.directory, f"{self.stage}{shard_suffix()}{sample_suffix()}.jsonl"), "a", encoding = "utf-8") as f:
+                f.write(self.render_jsonl())
+
+    def progress(self):
+        counters, gauges, histograms = self.snapshot()
+        elapsed = max(time.time() - self.started, 1e-9)
+        read = sum(v for (name, _), v in counters.items() if name == "docs_read_total")
+        written = sum(v for (name, _), v in counters.items() if name == "docs_written_total")
+        errors = sum(v for (name, _), v in counters.items() if name == "write_errors_total")
+        return (
+            f"[{self.stage}] read {read:,} docs ({read / elapsed:.0f}/s), "
+            f"wrote {written:,} docs ({written / elapsed:.0f}/s), {errors} write errors, "
+            f"elapsed {elapsed:.1f}s"
+        )
+
+    def _flush_loop(self):
+        while not self.stop.wait(self.interval):
+            try:
+                self.flush()
+                logging.info(self.progress())
+            except OSError as e:
+                logging.warning(f"Metrics flush failed: {e}")
+
+    def close(self):
+        self.stop.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flush()
+        logging.info(self.progress())
+
+def mongo_listeners():
+    from pymongo import monitoring
+
+    class CommandTimer(monitoring.CommandListener):
+        def __init__(self):
+            self.pending = {}
+
+        def started(self, event):
+            self.pending[(event.connection_id, event.request_id)] = event.command.get(event.command_name)
+
+        def succeeded(self, event):
+            target = self.pending.pop((event.connection_id, event.request_id), None)
+            stage_metrics().observe(
+                "mongo_command_seconds", event.duration_micros / 1e6,
+                command = event.command_name, collection = target if isinstance(target, str) else ""
+            )
+
+        def failed(self, event):
+            self.pending.pop((event.connection_id, event.request_id), None)
+            stage_metrics().inc("mongo_command_failures_total", command = event.command_name)
+
+    return [CommandTimer()]
+
+_current = None
+_current_lock = Lock()
+
+def stage_metrics(stage = None):
+    # One registry per process: the stage entry point names it, storage and
+    # readers pick up whichever registry is current.
+    global _current
+    with _current_lock:
+        if _current is None or (stage and _current.stage != stage):
+            if _current is not None:
+                _current.close()
+            _current = StageMetrics(stage or "repa", sink = metrics_sink())
+        return _current
@@ -0,0 +1,211 @@
+# Impact score of every paper: the group impact of TopicGroupImpactCalculator
+# (impact_topics.py) applied to the topics of the paper's annotation in
+# papers_with_annotations (syntactic, semantic, enhanced and union merged),
+# stored in the paper_impact collection with an index on impact_factor so the
+# backend can rank papers without scoring anything per request.
+#
+# Many papers share the same topic set, so groups are keyed by their sorted
+# topics and scored once. Papers are processed in chunks: the new groups of a
+# chunk are scored together, the Lin similarity of each distinct topic pair
+# is computed once and cached across chunks, and the depth, influence and
+# cohesion means of all the chunk's groups come out of a few numpy
+# reductions instead of a Python loop per group. Single-topic groups keep the
+# calculator's own single-topic impact. Papers with no topic in the CSO graph
+# get no score.
+#
+# Documents: {"corpusid", "title", "year", "topics", "impact_factor",
+# "depth_score", "influence_score", "semantic_score"}; semantic_score is the
+# semantic cohesion of the group, or the semantic weight of a single topic.
+
+from itertools import combinations
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from impact_un_topic import load_calculator
+from impact_topics import TopicGroupImpactCalculator
+from storage import get_storage
+from connection import configure_pool
+from index_plan import prepare_for_load, build_indexes
+from metrics import stage_metrics
+from profiling import phase, profile_mode, profiled
+from sampling import current_sample
+
+CSV_FILE = "Input/CSO.3.4.1.csv"
+SPECIFIC_TOPICS_FILE = "Output/specific_topics.txt"
+SNAPSHOT_FILE = "Output/cso_calculator.pkl"
+SOURCE_COLLECTION = "papers_with_annotations"
+SOURCE_FIELDS = {"_id": 0, "corpusid": 1, "title": 1, "year": 1, "annotation": 1}
+ANNOTATION_KEYS = ["syntactic", "semantic", "enhanced", "union"]
+DESTINATION_COLLECTION = "paper_impact"
+BATCH_SIZE = 1000
+CHUNK_PAPERS = 20000
+WRITE_BATCH_SIZE = 1000
+# Caches are dropped whole when they outgrow these sizes.
+GROUP_CACHE_SIZE = 1000000
+PAIR_CACHE_SIZE = 5000000
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+class PaperImpactScorer:
+    def __init__(self, calculator):
+        self.cso = calculator
+        self.group_calculator = TopicGroupImpactCalculator(calculator)
+        self.reference_topics = calculator.all_reference_topics()
+        self.groups = {}
+        self.pairs = {}
+        self.topics = {}
+        self.groups_scored = 0
+        self.pairs_computed = 0
+
+    def group_key(self, annotation):
+        topics = set()
+        for key in ANNOTATION_KEYS:
+            topics.update(t.lower() for t in (annotation or {}).get(key) or [] if t)
+        return tuple(sorted(t for t in topics if t in self.cso.graph))
+
+    def topic_scores(self, topic):
+        # (depth score, influence score, information content)
+        if topic not in self.topics:
+            cso = self.cso
+            depth = cso.calculate_depth(topic) / cso.max_depth if cso.max_depth > 0 else 0
+            influence = cso.calculate_influence_score(topic) / cso.max_influence if cso.max_influence > 0 else 0
+            self.topics[topic] = (depth, influence, cso.calculate_information_content(topic))
+        return self.topics[topic]
+
+    def cache_pairs(self, keys):
+        missing = {pair for key in keys for pair in combinations(key, 2) if pair not in self.pairs}
+        if not missing:
+            return
+        if len(self.pairs) + len(missing) > PAIR_CACHE_SIZE:
+            self.pairs = {}
+            missing = {pair for key in keys for pair in combinations(key, 2)}
+        missing = sorted(missing)
+        # Only the LCA needs the graph; the Lin formula runs on arrays.
+        ic = np.empty((len(missing), 3))
+        equivalent = np.zeros(len(missing), dtype = bool)
+        for i, (topic1, topic2) in enumerate(missing):
+            lca = self.cso.find_lowest_common_ancestor(topic1, topic2)
+            equivalent[i] = topic2 in self.cso.equivalents.get(topic1, [])
+            ic[i] = (self.topic_scores(topic1)[2], self.topic_scores(topic2)[2],
+                     self.topic_scores(lca)[2] if lca else np.nan)
+        denominator = ic[:, 0] + ic[:, 1]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            lin = np.where(np.isnan(ic[:, 2]) | (denominator == 0), 0.0, 2 * ic[:, 2] / denominator)
+        sims = np.where(equivalent, 0.9, lin)
+        self.pairs.update(zip(missing, sims.tolist()))
+        self.pairs_computed += len(missing)
+
+    def score_groups(self, keys):
+        if len(self.groups) + len(keys) > GROUP_CACHE_SIZE:
+            self.groups = {}
+        keys = [key for key in keys if key not in self.groups]
+        self.groups_scored += len(keys)
+        for key in keys:
+            if len(key) == 1:
+                impact = self.cso.calculate_impact_factor(key[0], self.reference_topics)
+                self.groups[key] = (impact["impact_factor"], impact["depth_score"], impact["influence_score"],
+                                    impact["semantic_score"])
+        multi = [key for key in keys if len(key) > 1]
+        if not multi:
+            return
+        self.cache_pairs(multi)
+
+        sizes = np.array([len(key) for key in multi])
+        values = np.array([self.topic_scores(topic)[:2] for key in multi for topic in key])
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        depth = np.add.reduceat(values[:, 0], starts) / sizes
+        influence = np.add.reduceat(values[:, 1], starts) / sizes
+
+        pair_sizes = sizes * (sizes - 1) // 2
+        sims = np.array([self.pairs[pair] for key in multi for pair in combinations(key, 2)])
+        pair_starts = np.concatenate(([0], np.cumsum(pair_sizes)[:-1]))
+        cohesion = np.add.reduceat(sims, pair_starts) / pair_sizes
+
+        calculator = self.group_calculator
+        impact = calculator.alpha * depth + calculator.beta * influence + calculator.gamma * cohesion
+        for key, row in zip(multi, zip(impact.tolist(), depth.tolist(), influence.tolist(), cohesion.tolist())):
+            self.groups[key] = row
+
+    def score(self, papers):
+        keyed = [(paper, self.group_key(paper.get("annotation"))) for paper in papers]
+        self.score_groups({key for _, key in keyed if key})
+        docs = []
+        for paper, key in keyed:
+            if not key:
+                continue
+            impact_factor, depth_score, influence_score, semantic_score = self.groups[key]
+            docs.append({
+                "corpusid": paper.get("corpusid"),
+                "title": paper.get("title"),
+                "year": paper.get("year"),
+                "topics": list(key),
+                "impact_factor": impact_factor,
+                "depth_score": depth_score,
+                "influence_score": influence_score,
+                "semantic_score": semantic_score
+            })
+        return docs
+
+def write_chunk(storage, scorer, chunk, metrics):
+    docs = scorer.score(chunk)
+    for start in range(0, len(docs), WRITE_BATCH_SIZE):
+        storage.insert_many(DESTINATION_COLLECTION, docs[start:start + WRITE_BATCH_SIZE])
+    metrics.inc("papers_unscored_total", len(chunk) - len(docs))
+    return len(docs)
+
+def run(storage, csv_file = CSV_FILE, specific_topics_file = SPECIFIC_TOPICS_FILE, snapshot = SNAPSHOT_FILE):
+    start_time = time.time()
+    metrics = stage_metrics("paper_impact")
+    configure_pool(readers = 1)
+
+    with phase("load"):
+        calculator = load_calculator(csv_file, specific_topics_file, snapshot_path = snapshot)
+    scorer = PaperImpactScorer(calculator)
+
+    storage.drop(DESTINATION_COLLECTION)
+    prepare_for_load(storage, DESTINATION_COLLECTION)
+    reader = storage.reader(SOURCE_COLLECTION, projection = SOURCE_FIELDS, batch_size = BATCH_SIZE)
+    papers, scored = 0, 0
+    chunk = []
+    with phase("score"):
+        for batch in reader.batches():
+            chunk.extend(batch)
+            papers += len(batch)
+            if len(chunk) >= CHUNK_PAPERS:
+                scored += write_chunk(storage, scorer, chunk, metrics)
+                chunk = []
+                logging.info(f"{papers:,} papers read, {scorer.groups_scored:,} topic sets scored")
+        if chunk:
+            scored += write_chunk(storage, scorer, chunk, metrics)
+    with phase("indexes"):
+        build_indexes(storage, DESTINATION_COLLECTION)
+
+    metrics.set("topic_sets_scored", scorer.groups_scored)
+    metrics.set("topic_pairs_computed", scorer.pairs_computed)
+    metrics.close()
+    logging.info(f"{scored:,}/{papers:,} papers scored ({scorer.groups_scored:,} topic sets, "
+                 f"{scorer.pairs_computed:,} topic pairs), done in {round(time.time() - start_time, 2)} seconds.")
+
+def main(storage, mode):
+    parser = argparse.ArgumentParser(description = "Group impact of the annotated topics of every paper.")
+    parser.add_argument("--csv", default = CSV_FILE)
+    parser.add_argument("--specific-topics", default = SPECIFIC_TOPICS_FILE)
+    parser.add_argument("--snapshot", default = SNAPSHOT_FILE)
+    args = parser.parse_args()
+    with profiled("paper_impact", mode):
+        run(storage, args.csv, args.specific_topics, args.snapshot)
+
+if __name__ == "__main__":
+    mode = profile_mode()
+    current_sample()
+    storage = get_storage()
+    try:
+        main(storage, mode)
+    finally:
+        storage.close()
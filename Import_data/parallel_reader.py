@@ -0,0 +1,183 @@
+# Shared reader: split a collection into _id ranges and read them through one
+# cursor per range, in parallel, so the read side scales with the workers.
+
+from bson import json_util
+from threading import Thread, Event
+from queue import Queue, Full
+import itertools
+import logging
+import os
+
+from document_access import raw_collection
+from metrics import stage_metrics
+from sampling import sample_suffix
+from sharding import shard_suffix
+
+NUM_RANGES = 4
+SAMPLES_PER_RANGE = 100
+QUEUE_MAXSIZE = 64
+CHECKPOINT_DIR = "Output/checkpoints"
+
+def reader_checkpoint(stage_name):
+    if os.environ.get("REPA_READER_CHECKPOINTS") != "1":
+        return None
+    os.makedirs(CHECKPOINT_DIR, exist_ok = True)
+    return os.path.join(CHECKPOINT_DIR, f"{stage_name}{shard_suffix()}{sample_suffix()}.json")
+
+def compute_split_points(collection, num_ranges, query = None, method = "sample"):
+    if num_ranges <= 1:
+        return []
+
+    match = [{"$match": query}] if query else []
+    if method == "bucketAuto":
+        pipeline = match + [{"$bucketAuto": {"groupBy": "$_id", "buckets": num_ranges}}]
+        buckets = list(collection.aggregate(pipeline, allowDiskUse = True))
+        return [bucket["_id"]["min"] for bucket in buckets[1:]]
+
+    pipeline = match + [
+        {"$sample": {"size": num_ranges * SAMPLES_PER_RANGE}},
+        {"$project": {"_id": 1}}
+    ]
+    ids = sorted(doc["_id"] for doc in collection.aggregate(pipeline, allowDiskUse = True))
+    if not ids:
+        return []
+
+    split_points = []
+    for i in range(1, num_ranges):
+        candidate = ids[i * len(ids) // num_ranges]
+        if not split_points or candidate > split_points[-1]:
+            split_points.append(candidate)
+    return split_points
+
+def range_filters(split_points, query = None):
+    bounds = [None] + list(split_points) + [None]
+    filters = []
+    for low, high in zip(bounds, bounds[1:]):
+        id_range = {}
+        if low is not None:
+            id_range["$gte"] = low
+        if high is not None:
+            id_range["$lt"] = high
+        condition = {"_id": id_range} if id_range else {}
+        if query:
+            condition = {"$and": [query, condition]} if condition else dict(query)
+        filters.append(condition)
+    return filters
+
+class PartitionedReader:
+    def __init__(self, collection, projection = None, query = None, num_ranges = NUM_RANGES,
+                 batch_size = 1000, method = "sample", checkpoint_file = None, raw = False, meter = None):
+        self.collection = collection
+        self.projection = projection
+        self.query = query
+        self.num_ranges = num_ranges
+        self.batch_size = batch_size
+        self.method = method
+        self.checkpoint_file = checkpoint_file
+        self.raw = raw
+        self.meter = meter
+        self.split_points = None
+        self.completed = set()
+        self.resuming = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_file or not os.path.exists(self.checkpoint_file):
+            return False
+        with open(self.checkpoint_file, "r", encoding = "utf-8") as f:
+            state = json_util.loads(f.read())
+        if state.get("collection") != self.collection.full_name:
+            return False
+        self.split_points = state["split_points"]
+        self.completed = set(state.get("completed", []))
+        logging.info(
+            f"[Reader] Resuming {self.collection.name}: "
+            f"{len(self.completed)}/{len(self.split_points) + 1} ranges already read."
+        )
+        return True
+
+    def _save_checkpoint(self):
+        if not self.checkpoint_file:
+            return
+        state = {
+            "collection": self.collection.full_name,
+            "split_points": self.split_points,
+            "completed": sorted(self.completed)
+        }
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w", encoding = "utf-8") as f:
+            f.write(json_util.dumps(state))
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def clear_checkpoint(self):
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def ranges(self):
+        if self.split_points is None:
+            self.split_points = compute_split_points(self.collection, self.num_ranges, self.query, self.method)
+            self._save_checkpoint()
+        return [
+            (index, condition)
+            for index, condition in enumerate(range_filters(self.split_points, self.query))
+            if index not in self.completed
+        ]
+
+    def _read_range(self, index, condition, output, stop):
+        metrics = stage_metrics()
+        collection = raw_collection(self.collection) if self.raw else self.collection
+        cursor = collection.find(condition, self.projection, no_cursor_timeout = True).batch_size(self.batch_size)
+        try:
+            while not stop.is_set():
+                with metrics.timer("read_batch_seconds", collection = self.collection.name):
+                    batch = list(itertools.islice(cursor, self.batch_size))
+                if not batch:
+                    break
+                metrics.inc("docs_read_total", len(batch), collection = self.collection.name)
+                if self.meter:
+                    self.meter.add(self.collection.name, batch)
+                self._put(output, ("batch", index, batch), stop)
+            self._put(output, ("done", index, None), stop)
+        except Exception as e:
+            self._put(output, ("error", index, e), stop)
+        finally:
+            cursor.close()
+
+    def _put(self, output, item, stop):
+        while not stop.is_set():
+            try:
+                output.put(item, timeout = 0.5)
+                return
+            except Full:
+                continue
+
+    def batches(self, barrier = None):
+        # A range is only checkpointed once `barrier` returns, which lets the
+        # stage wait until every batch handed out so far has been written.
+        ranges = self.ranges()
+        output = Queue(maxsize = QUEUE_MAXSIZE)
+        stop = Event()
+        readers = [
+            Thread(target = self._read_range, args = (index, condition, output, stop), daemon = True)
+            for index, condition in ranges
+        ]
+        for reader in readers:
+            reader.start()
+
+        remaining = len(readers)
+        try:
+            while remaining:
+                kind, index, payload = output.get()
+                if kind == "batch":
+                    yield payload
+                elif kind == "done":
+                    remaining -= 1
+                    if self.checkpoint_file and barrier is not None:
+                        barrier()
+                    self.completed.add(index)
+                    self._save_checkpoint()
+                else:
+                    raise payload
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
@@ -0,0 +1,220 @@
+# Opt-in profiling for the pipeline stages and the impact calculators.
+#
+# `--profile cpu|alloc|both` on the command line (or REPA_PROFILE) turns it on:
+# cpu records a cProfile of the main thread plus a sampler over every thread
+# written as collapsed stacks (flamegraph.pl / speedscope), alloc records
+# tracemalloc snapshots and the top allocation sites. Time and memory are also
+# attributed to named phases (load, centrality, scoring, write). Files go to
+# Output/profiles/. REPA_PROFILE_WINDOW limits sampling and the allocation
+# snapshot to the first N seconds, REPA_PROFILE_INTERVAL sets the sampling
+# period.
+
+from collections import Counter
+from datetime import datetime
+from threading import Event, Thread, Lock, get_ident, enumerate as enumerate_threads
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+PROFILE_DIR = "Output/profiles"
+SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 25
+TOP_ENTRIES = 50
+MODES = ("cpu", "alloc", "both")
+
+_active = None
+_phase_stack = []
+_phase_lock = Lock()
+
+def profile_mode(argv = None):
+    # Consumes --profile from argv so scripts with their own argparse keep working.
+    argv = sys.argv if argv is None else argv
+    mode = os.environ.get("REPA_PROFILE", "").lower() or None
+    for i, arg in enumerate(list(argv)):
+        if arg == "--profile" and i + 1 < len(argv):
+            mode = argv[i + 1].lower()
+            del argv[i : i + 2]
+            break
+        if arg.startswith("--profile="):
+            mode = arg.split("=", 1)[1].lower()
+            del argv[i]
+            break
+    if mode and mode not in MODES:
+        raise SystemExit(f"Unknown profile mode '{mode}', expected one of {', '.join(MODES)}")
+    return mode
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name}@{os.path.basename(code.co_filename)}:{code.co_firstlineno}"
+
+class Profiler:
+    def __init__(self, name, mode, directory = PROFILE_DIR, interval = None, window = None):
+        self.name = name
+        self.cpu = mode in ("cpu", "both")
+        self.alloc = mode in ("alloc", "both")
+        self.directory = directory
+        self.interval = interval or float(os.environ.get("REPA_PROFILE_INTERVAL", SAMPLE_INTERVAL))
+        self.window = window if window is not None else float(os.environ.get("REPA_PROFILE_WINDOW", 0))
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.prefix = os.path.join(directory, f"{name}-{stamp}-{os.getpid()}")
+        self.stacks = Counter()
+        self.samples = 0
+        self.phases = {}
+        self.alloc_snapshot = None
+        self.stop_event = Event()
+        self.sampler = None
+        self.profile = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok = True)
+        self.started = time.perf_counter()
+        if self.alloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.cpu:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        if self.cpu or (self.alloc and self.window):
+            self.sampler = Thread(target = self._sample_loop, name = "profiler-sampler", daemon = True)
+            self.sampler.start()
+
+    def _sample_loop(self):
+        own_id = get_ident()
+        deadline = self.started + self.window if self.window else None
+        while not self.stop_event.wait(self.interval):
+            if deadline and time.perf_counter() >= deadline:
+                self._take_alloc_snapshot()
+                logging.info(f"[Profiler] Sampling window of {self.window}s elapsed.")
+                return
+            if not self.cpu:
+                continue
+            names = {t.ident: t.name.replace(" ", "_") for t in enumerate_threads()}
+            phase = _phase_stack[-1] if _phase_stack else None
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                root = [names.get(thread_id, str(thread_id))]
+                if phase:
+                    root.append(f"phase:{phase}")
+                self.stacks[";".join(root + stack[::-1])] += 1
+            self.samples += 1
+
+    def _take_alloc_snapshot(self):
+        if self.alloc and self.alloc_snapshot is None and tracemalloc.is_tracing():
+            self.alloc_snapshot = tracemalloc.take_snapshot()
+
+    def enter_phase(self, name):
+        entry = {"start": time.perf_counter()}
+        if self.alloc and tracemalloc.is_tracing():
+            entry["memory"] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        return entry
+
+    def exit_phase(self, name, entry):
+        stats = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0})
+        stats["calls"] += 1
+        stats["seconds"] += time.perf_counter() - entry["start"]
+        if "memory" in entry and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stats["memory_delta_mb"] = stats.get("memory_delta_mb", 0.0) + (current - entry["memory"]) / 1024 / 1024
+            stats["peak_mb"] = max(stats.get("peak_mb", 0.0), peak / 1024 / 1024)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if self.profile is not None:
+            self.profile.disable()
+        self._take_alloc_snapshot()
+        if self.alloc:
+            tracemalloc.stop()
+        self.elapsed = time.perf_counter() - self.started
+        self._write()
+
+    def _write(self):
+        written = []
+        if self.profile is not None:
+            self.profile.dump_stats(self.prefix + ".pstats")
+            report = io.StringIO()
+            pstats.Stats(self.profile, stream = report).sort_stats("cumulative").print_stats(TOP_ENTRIES)
+            with open(self.prefix + ".cpu.txt", "w", encoding = "utf-8") as f:
+                f.write(report.getvalue())
+            with open(self.prefix + ".folded", "w", encoding = "utf-8") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            written += [".pstats", ".cpu.txt", ".folded"]
+
+        if self.alloc_snapshot is not None:
+            self.alloc_snapshot.dump(self.prefix + ".tracemalloc")
+            with open(self.prefix + ".alloc.txt", "w", encoding = "utf-8") as f:
+                for stat in self.alloc_snapshot.statistics("traceback")[:TOP_ENTRIES]:
+                    f.write(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+                    for line in stat.traceback.format(limit = 8):
+                        f.write(f"    {line}\n")
+            written += [".tracemalloc", ".alloc.txt"]
+
+        with open(self.prefix + ".phases.json", "w", encoding = "utf-8") as f:
+            json.dump({
+                "name": self.name,
+                "elapsed_seconds": self.elapsed,
+                "cpu_samples": self.samples,
+                "sample_interval": self.interval,
+                "window_seconds": self.window,
+                "phases": self.phases
+            }, f, indent = 2)
+        written.append(".phases.json")
+        logging.info(f"[Profiler] {self.name}: wrote {', '.join(self.prefix + s for s in written)}")
+
+class phase:
+    # Named section of a run; a no-op unless a profiler is active.
+    def __init__(self, name):
+        self.name = name
+        self.entry = None
+
+    def __enter__(self):
+        profiler = _active
+        if profiler is not None:
+            with _phase_lock:
+                _phase_stack.append(self.name)
+            self.entry = profiler.enter_phase(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        profiler = _active
+        if profiler is not None and self.entry is not None:
+            profiler.exit_phase(self.name, self.entry)
+            with _phase_lock:
+                if _phase_stack and _phase_stack[-1] == self.name:
+                    _phase_stack.pop()
+        return False
+
+class profiled:
+    # Wraps an entry point: `with profiled("author_paper"): run(storage)`.
+    def __init__(self, name, mode = None):
+        self.name = name
+        self.mode = mode or profile_mode()
+        self.profiler = None
+
+    def __enter__(self):
+        global _active
+        if self.mode and _active is None:
+            self.profiler = Profiler(self.name, self.mode)
+            self.profiler.start()
+            _active = self.profiler
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        if self.profiler is not None:
+            _active = None
+            self.profiler.stop()
+        return False
@@ -1,43 +1,17 @@
 # Find the specific topics
 
-import pandas as pd
-import urllib.parse
-from collections import defaultdict
-import re
-import networkx as nx
-from nltk.stem import WordNetLemmatizer
-from pymongo import MongoClient
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from metrics import stage_metrics
+from profiling import phase, profiled
+from topic_labels import extract_topic
 
-DB_NAME = "research_db"
 COLLECTION_NAME = "specific_topics"
 
-import nltk
-nltk.download('wordnet')
-nltk.download('omw-1.4')
-
-lemmatizer = WordNetLemmatizer()
-
-df = pd.read_csv("Input/CSO.3.4.1.csv", header = None)
-df.columns = ["super_topic_uri", "predicate", "sub_topic_uri"]
-
-def extract_topic(uri):
-    if isinstance(uri, str) and "topics/" in uri:
-        topics = uri.split("/")[-1]
-        topics = urllib.parse.unquote(topics)
-        topics = topics.lower()
-        topics = re.sub(r"\s*\([^)]*\)", "", topics)
-        topics = topics.replace("-", "").replace("_", " ")
-        topics = topics.strip().lower().strip(">")
-        topics = re.sub(r"\s+", " ", topics).strip()
-
-        words = topics.split()
-        lemmatized = [lemmatizer.lemmatize(word, pos = 'n') for word in words]
-        topics = " ".join(lemmatized)
-
-        return topics
-    return None
-
 def build_graph(csv_path):
+    import pandas as pd
+    import networkx as nx
+
     df = pd.read_csv(csv_path, header=None, names=["super_topic_uri", "predicate", "sub_topic_uri"])
     df["super_topic"] = df["super_topic_uri"].apply(extract_topic)
     df["sub_topic"] = df["sub_topic_uri"].apply(extract_topic)
@@ -60,29 +34,36 @@ def export_topics(topics, filename):
             f.write(topic + "\n")
     print(f"{len(topics)} specific topics written to {filename}")
 
-def export_to_mongodb(topics, db_name=DB_NAME, collection_name=COLLECTION_NAME, uri="mongodb://localhost:27017/"):
-    client = MongoClient(uri)
-    db = client[db_name]
-    collection = db[collection_name]
-    
-    collection.delete_many({})
+def export_to_storage(topics, storage, collection_name=COLLECTION_NAME):
+    storage.clear(collection_name)
+    prepare_for_load(storage, collection_name)
 
     documents = [{"topic": topic} for topic in topics]
-    collection.insert_many(documents)
+    storage.insert_many(collection_name, documents)
+    build_indexes(storage, collection_name)
     
-    print(f"{len(topics)} specific topics exported to MongoDB collection '{collection_name}' in database '{db_name}'")
+    print(f"{len(topics)} specific topics exported to collection '{collection_name}'")
 
 
-def main():
+def main(storage):
+    metrics = stage_metrics("read_cso_csv")
     csv_path = "Input/CSO.3.4.1.csv"
     print("Building topic graph...")
-    G = build_graph(csv_path)
+    with phase("load"):
+        G = build_graph(csv_path)
 
     print("Finding specific topics...")
     specific_topics = find_specific_topics(G)
 
-    export_topics(specific_topics, "specific_topics.txt")
-    export_to_mongodb(specific_topics)
+    with phase("write"):
+        export_topics(specific_topics, "specific_topics.txt")
+        export_to_storage(specific_topics, storage)
+    metrics.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    storage = get_storage()
+    try:
+        with profiled("read_cso_csv"):
+            main(storage)
+    finally:
+        storage.close()
\ No newline at end of file
@@ -0,0 +1,161 @@
+# Incremental re-ranking of the specific topics after a CSO release or a change
+# of the specific-topic list: only topics whose semantic score can have moved
+# are rescored, every other row keeps its semantic score from the ranking file.
+#
+# Almost every release changes the total topic frequency, which shifts every
+# information content a little. For a topic outside the edited part of the
+# graph that shift is the only way its semantic score can move, and it is
+# bounded per topic from the old and new IC of its ancestors and of the
+# reference topics; the topic is rescored when the bound exceeds --tolerance
+# (an absolute change of the semantic score, in [0, 1]).
+
+import argparse
+import csv
+import math
+import time
+
+from impact_un_topic import CSOTopicImpactCalculator
+from profiling import phase, profiled
+
+RANKING_FILE = "Output/specific_topics_ranked.csv"
+CSV_FILE = "Input/CSO.3.4.1.csv"
+SPECIFIC_TOPICS_FILE = "Output/specific_topics.txt"
+SEMANTIC_TOLERANCE = 0.005
+
+def topic_signature(calculator, topic):
+    return (
+        frozenset(calculator.graph.predecessors(topic)),
+        frozenset(calculator.graph.successors(topic)),
+        frozenset(calculator.equivalents.get(topic, [])),
+        frozenset(calculator.contributions.get(topic, []))
+    )
+
+def diff_graphs(old, new):
+    old_nodes = set(old.graph.nodes())
+    new_nodes = set(new.graph.nodes())
+    changed = {
+        topic for topic in old_nodes & new_nodes
+        if topic_signature(old, topic) != topic_signature(new, topic)
+    }
+    return {
+        "added": new_nodes - old_nodes,
+        "removed": old_nodes - new_nodes,
+        "changed": changed
+    }
+
+def affected_topics(new, diff):
+    # A topic's depth, ancestor set and the IC ranking of its ancestors only
+    # move if one of its ancestors (or itself) gained or lost an edge, so the
+    # descendants of the touched nodes in the new graph cover every case.
+    affected = set()
+    for topic in diff["changed"] | diff["added"]:
+        affected |= new.get_descendants(topic)
+    return affected
+
+def lin(ic_ancestor, ic_topic, ic_reference):
+    denominator = ic_topic + ic_reference
+    return 2 * ic_ancestor / denominator if denominator != 0 else 0.0
+
+def semantic_drift_bound(old, new, topic, reference_ics):
+    # The semantic score is a mean of Lin similarities 2 IC(lca) / (IC(topic) +
+    # IC(reference)), where the LCA is one of the topic's ancestors (equivalent
+    # pairs score a constant 0.9). The ancestors of an unaffected topic are the
+    # same in both graphs, so as long as their LCA order is too, every term
+    # moves by at most the largest change over (ancestor, reference) pairs.
+    ancestors = new.get_ancestors(topic)
+    if sorted(ancestors, key = old._lca_key) != sorted(ancestors, key = new._lca_key):
+        return math.inf
+    ic_old = old.calculate_information_content(topic)
+    ic_new = new.calculate_information_content(topic)
+    drift = 0.0
+    for ancestor in ancestors:
+        if not ancestor:
+            continue
+        ancestor_old = old.calculate_information_content(ancestor)
+        ancestor_new = new.calculate_information_content(ancestor)
+        for reference_old, reference_new in reference_ics:
+            drift = max(drift, abs(lin(ancestor_new, ic_new, reference_new) - lin(ancestor_old, ic_old, reference_old)))
+    return drift
+
+def read_ranking(ranking_file):
+    with open(ranking_file, "r", encoding = "utf-8", newline = "") as f:
+        return {row["topic_id"]: row for row in csv.DictReader(f)}
+
+def incremental_rerank(old, new, ranking_file = RANKING_FILE, output_file = None, tolerance = SEMANTIC_TOLERANCE):
+    start_time = time.time()
+    previous = read_ranking(ranking_file)
+
+    diff = diff_graphs(old, new)
+    affected = affected_topics(new, diff)
+    print(
+        f"Diff: {len(diff['added'])} added, {len(diff['removed'])} removed, "
+        f"{len(diff['changed'])} changed topics, {len(affected)} affected"
+    )
+
+    reference_topics = new.default_reference_topics()
+    full_rescore = False
+    if reference_topics != old.default_reference_topics():
+        print("Reference topics changed: every semantic score is recomputed.")
+        full_rescore = True
+    elif affected.intersection(reference_topics):
+        print("Reference topics moved in the graph: every semantic score is recomputed.")
+        full_rescore = True
+    reference_ics = sorted({
+        (old.calculate_information_content(t), new.calculate_information_content(t)) for t in reference_topics
+    })
+
+    topic_ids = sorted(new.specific_topics.intersection(set(new.graph.nodes())))
+    results = []
+    rescored = 0
+    drifted = 0
+    with phase("scoring"):
+        for topic_id in topic_ids:
+            row = previous.get(topic_id)
+            rescore = full_rescore or row is None or topic_id in affected or topic_id not in old.graph
+            if not rescore and semantic_drift_bound(old, new, topic_id, reference_ics) > tolerance:
+                rescore = True
+                drifted += 1
+            if rescore:
+                impact_data = new.calculate_impact_factor(topic_id, reference_topics)
+                rescored += 1
+            else:
+                impact_data = new.calculate_impact_factor(
+                    topic_id, reference_topics, semantic_score = float(row["semantic_score"])
+                )
+            if 'error' not in impact_data:
+                results.append(impact_data)
+
+    results.sort(key = lambda x: x['impact_factor'], reverse = True)
+    dropped = len(set(previous) - set(topic_ids))
+    print(
+        f"{rescored}/{len(topic_ids)} semantic scores recomputed ({drifted} over the drift tolerance), "
+        f"{dropped} rows dropped "
+        f"in {round(time.time() - start_time, 2)} seconds"
+    )
+
+    output_file = output_file or ranking_file
+    with phase("write"):
+        import pandas as pd
+
+        pd.DataFrame(results).to_csv(output_file, index = False, encoding = 'utf-8')
+    print(f"Export terminé : {output_file}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Re-rank the specific topics against a previous ranking.")
+    parser.add_argument("--old-csv", required = True, help = "CSO release the ranking file was computed from")
+    parser.add_argument("--old-specific", default = SPECIFIC_TOPICS_FILE, help = "Specific topics the ranking file was computed from")
+    parser.add_argument("--new-csv", default = CSV_FILE)
+    parser.add_argument("--new-specific", default = SPECIFIC_TOPICS_FILE)
+    parser.add_argument("--ranking", default = RANKING_FILE)
+    parser.add_argument("--output", default = None)
+    parser.add_argument("--tolerance", type = float, default = SEMANTIC_TOLERANCE)
+    args = parser.parse_args()
+
+    old = CSOTopicImpactCalculator(args.old_csv, args.old_specific, compute_centrality = False)
+    new = CSOTopicImpactCalculator(args.new_csv, args.new_specific)
+    incremental_rerank(old, new, args.ranking, args.output, args.tolerance)
+
+if __name__ == "__main__":
+    with profiled("rerank_topics"):
+        main()
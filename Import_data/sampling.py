@@ -0,0 +1,196 @@
+# Sampled runs: REPA_SAMPLE=0.01 (or --sample 0.01) runs the pipeline on a
+# reproducible fraction of the corpus. A paper is in the sample when a hash of
+# its corpusid, salted with REPA_SAMPLE_SEED, falls below the fraction, so the
+# same papers are picked on every run and every host, independently of the
+# shard they land in. load_data keeps the sampled papers, their annotations
+# and the authors of those papers; every corpus collection then lives under a
+# <collection>__sample<pct>pct name (see SAMPLED_COLLECTIONS), so the later
+# stages read and write the sampled data through their usual names and the
+# full collections stay untouched.
+#
+# `python sampling.py status --sample F` compares the sampled collections
+# with the full ones, `python sampling.py drop --sample F` removes them.
+
+from hashlib import blake2b
+import argparse
+import logging
+import os
+import re
+import sys
+
+from sharding import base_collection
+
+SAMPLE_SEPARATOR = "__sample"
+DEFAULT_SEED = "repa"
+HASH_RANGE = 2 ** 64
+
+# Collections derived from the corpus; CSO topics, dead letters and the
+# collections of other tools are shared with the full run.
+SAMPLED_COLLECTIONS = {
+    "authors", "papers", "annotated_papers", "papers_with_annotations", "author_paper_topics",
+    "authors_papers_annotations", "temp_author_topics", "author_topics", "temp_corpus_topics",
+    "corpus_topics", "author_specific_topics", "corpus_specific_topics", "pipeline_shards",
+    "similar_authors", "topic_cooccurrence", "specific_topic_cooccurrence", "author_topic_rollup",
+    "corpus_topic_rollup", "paper_impact"
+}
+
+class SampleSpec:
+    def __init__(self, fraction, seed = DEFAULT_SEED):
+        if not 0 < fraction <= 1:
+            raise ValueError(f"Invalid sample fraction {fraction}, expected 0 < f <= 1")
+        self.fraction = fraction
+        self.seed = seed
+        self.threshold = int(fraction * HASH_RANGE)
+
+    def __repr__(self):
+        return f"{self.fraction:.4%} (seed {self.seed})"
+
+    @property
+    def suffix(self):
+        percent = f"{self.fraction * 100:g}".replace(".", "p")
+        seed = "" if self.seed == DEFAULT_SEED else "_" + re.sub(r"\W", "", self.seed)
+        return f"{SAMPLE_SEPARATOR}{percent}pct{seed}"
+
+    def includes(self, corpusid):
+        if corpusid is None:
+            return False
+        # 1234, 1234.0 and "1234" are the same paper across the input files.
+        try:
+            key = str(int(corpusid))
+        except (TypeError, ValueError):
+            key = str(corpusid)
+        digest = blake2b(f"{self.seed}:{key}".encode(), digest_size = 8).digest()
+        return int.from_bytes(digest, "big") < self.threshold
+
+    def collection(self, name):
+        if base_collection(name) in SAMPLED_COLLECTIONS:
+            return name + self.suffix
+        return name
+
+def parse_sample(text, seed = DEFAULT_SEED):
+    try:
+        fraction = float(text.rstrip("%")) / (100 if text.endswith("%") else 1)
+    except ValueError:
+        raise SystemExit(f"Invalid sample '{text}', expected a fraction like 0.01 or 1%")
+    if fraction >= 1:
+        return None
+    return SampleSpec(fraction, seed)
+
+_current = None
+_parsed = False
+
+def current_sample(argv = None):
+    # Consumes --sample F from argv, like current_shard does for --shard.
+    global _current, _parsed
+    if _parsed:
+        return _current
+    argv = sys.argv if argv is None else argv
+    text = os.environ.get("REPA_SAMPLE")
+    for i, arg in enumerate(list(argv)):
+        if arg == "--sample" and i + 1 < len(argv):
+            text = argv[i + 1]
+            del argv[i : i + 2]
+            break
+        if arg.startswith("--sample="):
+            text = arg.split("=", 1)[1]
+            del argv[i]
+            break
+    if text:
+        _current = parse_sample(text, os.environ.get("REPA_SAMPLE_SEED", DEFAULT_SEED))
+    _parsed = True
+    return _current
+
+def sample_suffix():
+    sample = current_sample()
+    return sample.suffix if sample else ""
+
+def sample_environment():
+    # For child processes, which do not see a --sample consumed from our argv.
+    sample = current_sample()
+    if sample is None:
+        return {}
+    return {"REPA_SAMPLE": repr(sample.fraction), "REPA_SAMPLE_SEED": sample.seed}
+
+# Storage methods whose first argument is a collection name.
+NAMED_METHODS = {
+    "reader", "find", "find_one", "count", "insert_many", "upsert_many", "upsert_push", "create_index",
+    "create_indexes", "drop_indexes", "explain", "clear", "drop", "put_marker", "markers", "claim_marker",
+    "delete_markers"
+}
+
+class SampledStorage:
+    # Wraps a storage so stages address the sampled collections by their
+    # usual names.
+    def __init__(self, storage, sample):
+        self.storage = storage
+        self.sample = sample
+
+    def __getattr__(self, attr):
+        value = getattr(self.storage, attr)
+        if attr in NAMED_METHODS:
+            return lambda name, *args, **kwargs: value(self.collection_name(name), *args, **kwargs)
+        return value
+
+    def collection_name(self, name):
+        return self.sample.collection(name)
+
+    def union_by_key(self, source, key_field, array_field, destination):
+        if isinstance(source, str):
+            source = self.collection_name(source)
+        else:
+            source = [self.collection_name(s) for s in source]
+        self.storage.union_by_key(source, key_field, array_field, self.collection_name(destination))
+
+    def concat_by_key(self, sources, key_field, array_field, destination):
+        self.storage.concat_by_key([self.collection_name(s) for s in sources], key_field, array_field,
+                                   self.collection_name(destination))
+
+    def concat(self, sources, destination):
+        self.storage.concat([self.collection_name(s) for s in sources], self.collection_name(destination))
+
+def sampled_storage(storage):
+    sample = current_sample()
+    if sample is None:
+        return storage
+    logging.info(f"Sampled run: {sample} of the corpus, collections suffixed '{sample.suffix}'")
+    return SampledStorage(storage, sample)
+
+def status(storage):
+    rows = []
+    for name in sorted(SAMPLED_COLLECTIONS):
+        full = storage.storage.count(name)
+        sampled = storage.count(name)
+        if full or sampled:
+            rows.append((name, full, sampled, sampled / full if full else None))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description = "Inspect or remove the collections of a sampled run.")
+    parser.add_argument("action", choices = ["status", "drop"])
+    parser.add_argument("--sample", help = "Sample fraction, as passed to the stages (default: REPA_SAMPLE)")
+    args = parser.parse_args()
+    logging.basicConfig(format = "%(asctime)s - [%(levelname)s] %(message)s", level = logging.INFO)
+
+    from storage import get_storage
+
+    # get_storage() goes through the imported sampling module, which picks
+    # --sample up from argv.
+    storage = get_storage()
+    try:
+        sample = getattr(storage, "sample", None)
+        if sample is None:
+            raise SystemExit("No sample selected: pass --sample F or set REPA_SAMPLE")
+        if args.action == "status":
+            print(f"Sample {sample}, suffix '{sample.suffix}'")
+            for name, full, sampled, ratio in status(storage):
+                share = f"{ratio:8.2%}" if ratio is not None else "       -"
+                print(f"{name:<28} {full:>12,} {sampled:>12,} {share}")
+        else:
+            for name in sorted(SAMPLED_COLLECTIONS):
+                storage.drop(name)
+            logging.info(f"Dropped the '{sample.suffix}' collections.")
+    finally:
+        storage.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# Multi-node execution: each stage can run as shard i of N on a different
+# host. A shard reads a disjoint slice of its source collection, either by
+# _id range from $bucketAuto (range) or by the stage's integer key modulo N
+# (mod), and writes to its own <collection>__shard<i>of<N> collections. When a shard
+# finishes it records a marker in pipeline_shards; the shard that sees all N
+# markers claims the merge and combines the partial outputs (union for topic
+# sets, concatenation for documents and paper links) into the real
+# collections, then builds their indexes. No coordinator is involved.
+#
+# Range slicing works for any stage. Mod slicing is a plain $mod on the key,
+# which the key's index serves; it only accepts integer keys (corpusid, not
+# the string authorIds or ObjectIds), and documents without the key go to
+# shard 0.
+#
+# REPA_SHARD=i/N (or --shard i/N) selects the shard, REPA_SHARD_MODE=range|mod
+# the slicing and REPA_SHARD_RUN names the run so markers of an earlier run
+# are not mistaken for this one. The run name is required with REPA_SHARD and
+# must be new for every run: a run that already merged is refused. `python sharding.py simulate <script> -n N`
+# runs N shards as local processes.
+
+from datetime import datetime
+import argparse
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+MARKERS_COLLECTION = "pipeline_shards"
+SHARD_SEPARATOR = "__shard"
+MODES = ("range", "mod")
+SIMULATION_LOG_DIR = "Output/shards"
+
+# Merge of each stage's partial outputs:
+# (kind, collection, key field, array field), kind being
+#   concat        documents appended as they are
+#   union         one document per key, union of the array
+#   concat_by_key one document per key, arrays concatenated
+#   drop          per-shard scratch collection, only dropped
+STAGE_MERGES = {
+    "load_data": [("concat", "authors", None, None), ("concat", "annotated_papers", None, None),
+                  ("concat", "papers", None, None)],
+    "link_papers": [("concat", "papers_with_annotations", None, None)],
+    "associate_each_paper": [("concat", "author_paper_topics", None, None)],
+    "author_paper": [("concat_by_key", "authors_papers_annotations", "authorId", "papers")],
+    "author_topic": [("union", "author_topics", "authorId", "topics"),
+                     ("drop", "temp_author_topics", None, None)],
+    "corpus_topic": [("union", "corpus_topics", "corpusId", "topics"),
+                     ("drop", "temp_corpus_topics", None, None)],
+    "specific_topic": [("concat", "author_specific_topics", None, None)],
+    "corpus_specific_topic": [("concat", "corpus_specific_topics", None, None)]
+}
+
+class ShardSpec:
+    def __init__(self, index, count, mode = "range", run_id = "default"):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index}/{count}")
+        if mode not in MODES:
+            raise ValueError(f"Unknown shard mode '{mode}', expected one of {', '.join(MODES)}")
+        self.index = index
+        self.count = count
+        self.mode = mode
+        self.run_id = run_id
+
+    def __repr__(self):
+        return f"{self.index}/{self.count} ({self.mode})"
+
+    @property
+    def suffix(self):
+        return f"{SHARD_SEPARATOR}{self.index}of{self.count}"
+
+    def shard_of(self, value):
+        # Must agree with mongo_query: $mod keeps the sign of the value.
+        if value is None:
+            return 0
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f"Shard mode 'mod' needs integer keys, got {type(value).__name__} {value!r}; "
+                             f"use REPA_SHARD_MODE=range")
+        return abs(value) % self.count
+
+    def owns(self, value):
+        return self.shard_of(value) == self.index
+
+    def owns_position(self, position, total = None):
+        if self.mode == "range" and total is not None:
+            return position * self.count // max(total, 1) == self.index
+        return position % self.count == self.index
+
+    def select(self, docs, key):
+        if self.mode == "range":
+            docs = list(docs)
+            return [doc for position, doc in enumerate(docs) if self.owns_position(position, len(docs))]
+        return [doc for doc in docs if self.owns(doc.get(key))]
+
+    def mongo_query(self, collection, key, query = None):
+        if self.mode == "range":
+            from parallel_reader import compute_split_points, range_filters
+
+            # $bucketAuto is deterministic, so every shard derives the same bounds.
+            filters = range_filters(compute_split_points(collection, self.count, method = "bucketAuto"))
+            condition = filters[self.index] if self.index < len(filters) else {"_id": {"$exists": False}}
+        else:
+            # Non-integer keys are rejected up front: $mod would match them on no shard.
+            invalid = collection.find_one({key: {"$exists": True, "$not": {"$type": ["int", "long", "null"]}}},
+                                          {key: 1})
+            if invalid is not None:
+                self.shard_of(invalid[key])
+            clauses = [{key: {"$mod": [self.count, remainder]}} for remainder in sorted({self.index, -self.index})]
+            if self.index == 0:
+                clauses.append({key: None})
+            condition = clauses[0] if len(clauses) == 1 else {"$or": clauses}
+        if query:
+            return {"$and": [query, condition]}
+        return condition
+
+def parse_shard(text, mode = "range", run_id = "default"):
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise SystemExit(f"Invalid shard spec '{text}', expected i/N")
+    return ShardSpec(index, count, mode, run_id)
+
+_current = None
+_parsed = False
+
+def current_shard(argv = None):
+    # Consumes --shard i/N from argv so scripts with their own argparse keep working.
+    global _current, _parsed
+    if _parsed:
+        return _current
+    argv = sys.argv if argv is None else argv
+    text = os.environ.get("REPA_SHARD")
+    for i, arg in enumerate(list(argv)):
+        if arg == "--shard" and i + 1 < len(argv):
+            text = argv[i + 1]
+            del argv[i : i + 2]
+            break
+        if arg.startswith("--shard="):
+            text = arg.split("=", 1)[1]
+            del argv[i]
+            break
+    if text:
+        run_id = os.environ.get("REPA_SHARD_RUN")
+        if not run_id:
+            # With a fixed name, the markers of the last run would stop this one from merging.
+            raise SystemExit("REPA_SHARD_RUN must name the run when a shard is selected")
+        _current = parse_shard(text, os.environ.get("REPA_SHARD_MODE", "range"), run_id)
+    _parsed = True
+    return _current
+
+def shard_suffix():
+    shard = current_shard()
+    return shard.suffix if shard else ""
+
+def shard_collection(name):
+    return name + shard_suffix()
+
+def base_collection(name):
+    return name.split(SHARD_SEPARATOR, 1)[0]
+
+def shard_names(name, count):
+    return [f"{name}{SHARD_SEPARATOR}{i}of{count}" for i in range(count)]
+
+def marker_prefix(stage, count, run_id):
+    return f"{run_id}:{stage}:{count}:"
+
+def merge_stage(storage, stage, count):
+    from index_plan import build_indexes
+
+    for kind, name, key_field, array_field in STAGE_MERGES[stage]:
+        sources = shard_names(name, count)
+        if kind == "drop":
+            for source in sources:
+                storage.drop(source)
+            continue
+        start = time.perf_counter()
+        if kind == "concat":
+            storage.concat(sources, name)
+        elif kind == "union":
+            storage.union_by_key(sources, key_field, array_field, name)
+        else:
+            storage.concat_by_key(sources, key_field, array_field, name)
+        for source in sources:
+            storage.drop(source)
+        build_indexes(storage, name)
+        logging.info(f"[{stage}] Merged {count} shards into '{name}' ({kind}) in {time.perf_counter() - start:.1f}s")
+
+def finish_shard(storage, stage):
+    # Records this shard as done; the shard that completes the set merges.
+    shard = current_shard()
+    if shard is None:
+        return False
+
+    prefix = marker_prefix(stage, shard.count, shard.run_id)
+    if storage.markers(MARKERS_COLLECTION, f"{prefix}merge"):
+        raise RuntimeError(f"[{stage}] Run '{shard.run_id}' was already merged, set a new REPA_SHARD_RUN")
+    storage.put_marker(MARKERS_COLLECTION, f"{prefix}{shard.index}", {
+        "run": shard.run_id,
+        "stage": stage,
+        "shard": shard.index,
+        "count": shard.count,
+        "mode": shard.mode,
+        "host": socket.gethostname(),
+        "finished_at": datetime.now()
+    })
+    done = {m["shard"] for m in storage.markers(MARKERS_COLLECTION, prefix) if m.get("shard") is not None}
+    if len(done) < shard.count:
+        logging.info(f"[{stage}] Shard {shard} done, {len(done)}/{shard.count} shards finished.")
+        return False
+    if not storage.claim_marker(MARKERS_COLLECTION, f"{prefix}merge", {"host": socket.gethostname(), "shard": None}):
+        logging.info(f"[{stage}] All shards finished, another shard is merging.")
+        return False
+
+    logging.info(f"[{stage}] All {shard.count} shards finished, merging ...")
+    merge_stage(storage, stage, shard.count)
+    return True
+
+def simulate(script, count, mode, run_id):
+    from sampling import sample_environment
+
+    os.makedirs(SIMULATION_LOG_DIR, exist_ok = True)
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    name = os.path.splitext(os.path.basename(script))[0]
+    processes = []
+    for index in range(count):
+        env = dict(os.environ, REPA_SHARD = f"{index}/{count}", REPA_SHARD_MODE = mode, REPA_SHARD_RUN = run_id,
+                   **sample_environment())
+        log = open(os.path.join(SIMULATION_LOG_DIR, f"{name}-{index}of{count}.log"), "w", encoding = "utf-8")
+        processes.append((index, log, subprocess.Popen(
+            [sys.executable, script_path], env = env, stdout = log, stderr = subprocess.STDOUT
+        )))
+
+    failed = 0
+    for index, log, process in processes:
+        returncode = process.wait()
+        log.close()
+        status = "ok" if returncode == 0 else f"failed (exit {returncode})"
+        failed += returncode != 0
+        logging.info(f"[{name}] Shard {index}/{count}: {status}")
+    logging.info(f"[{name}] Logs in {SIMULATION_LOG_DIR}/")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run and finalize sharded pipeline stages.")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    sim = subparsers.add_parser("simulate", help = "Run N shards of a stage as local processes")
+    sim.add_argument("script")
+    sim.add_argument("-n", "--shards", type = int, default = 4)
+    sim.add_argument("--mode", choices = MODES, default = "range")
+    sim.add_argument("--run", default = None, help = "Run id (default: a fresh timestamp)")
+
+    for command, description in (("status", "Show the shard markers of a stage"),
+                                 ("finalize", "Merge the shard outputs of a stage"),
+                                 ("reset", "Delete the shard markers of a stage")):
+        sub = subparsers.add_parser(command, help = description)
+        sub.add_argument("stage", choices = sorted(STAGE_MERGES))
+        sub.add_argument("-n", "--shards", type = int, required = True)
+        sub.add_argument("--run", default = os.environ.get("REPA_SHARD_RUN"),
+                         required = not os.environ.get("REPA_SHARD_RUN"))
+
+    from sampling import current_sample
+
+    current_sample()
+    args = parser.parse_args()
+    logging.basicConfig(format = "%(asctime)s - [%(levelname)s] %(message)s", level = logging.INFO)
+
+    if args.command == "simulate":
+        run_id = args.run or f"sim-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        raise SystemExit(1 if simulate(args.script, args.shards, args.mode, run_id) else 0)
+
+    from storage import get_storage
+
+    storage = get_storage()
+    try:
+        prefix = marker_prefix(args.stage, args.shards, args.run)
+        if args.command == "status":
+            for marker in storage.markers(MARKERS_COLLECTION, prefix):
+                print(marker)
+        elif args.command == "finalize":
+            merge_stage(storage, args.stage, args.shards)
+        else:
+            storage.delete_markers(MARKERS_COLLECTION, prefix)
+    finally:
+        storage.close()
+
+if __name__ == "__main__":
+    main()
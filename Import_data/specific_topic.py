@@ -1,42 +1,42 @@
 # Step 5: Filter out general topics, keep only specific ones
 
-from pymongo import MongoClient
 from threading import Thread, Lock
 from queue import Queue
-import itertools
 import logging
 import time
 
-DB_NAME = "research_db"
+from parallel_reader import reader_checkpoint
+from document_access import transfer_meter
+from storage import get_storage
+from sharding import current_shard, shard_collection, finish_shard
+from index_plan import prepare_for_load, build_indexes
+from connection import configure_pool
+from metrics import stage_metrics
+from profiling import profiled
+
 SOURCE_COLLECTION = "author_topics"
-TARGET_COLLECTION = "author_specific_topics"
+SPECIFIC_TOPICS_FILE = "Output/specific_topics.txt"
+TARGET_COLLECTION = shard_collection("author_specific_topics")
 
+SOURCE_FIELDS = {"_id": 0, "authorId": 1, "topics": 1}
 BATCH_SIZE = 1000
 NUM_WORKERS = 4
+NUM_READERS = 4
 QUEUE_MAXSIZE = 1000
 
-client = MongoClient("mongodb://localhost:27017/")
-db = client[DB_NAME]
-
 logging.basicConfig(
     format="%(asctime)s - [%(levelname)s] %(message)s",
     level = logging.INFO
 )
 
-with open("Output/specific_topics.txt", "r") as f:
-    specific_topics = set(line.strip().lower() for line in f if line.strip())
-
 batch_queue = Queue(maxsize = QUEUE_MAXSIZE)
 insert_lock = Lock() 
 
-def chunked_cursor(cursor, size):
-    while True:
-        batch = list(itertools.islice(cursor, size))
-        if not batch:
-            break
-        yield batch
+def load_specific_topics(path = SPECIFIC_TOPICS_FILE):
+    with open(path, "r") as f:
+        return set(line.strip().lower() for line in f if line.strip())
 
-def filter_batch(batch):
+def filter_batch(batch, specific_topics):
     filtered_docs = []
     for doc in batch:
         topics = doc.get("topics", [])
@@ -48,7 +48,7 @@ def filter_batch(batch):
             })
     return filtered_docs
 
-def worker(worker_id):
+def worker(worker_id, storage, specific_topics):
     while True:
         batch = batch_queue.get()
         if batch is None:
@@ -56,39 +56,55 @@ def worker(worker_id):
             logging.info(f"[Worker-{worker_id}] received stop signal.")
             break
 
-        filtered_docs = filter_batch(batch)
+        batch_start = time.perf_counter()
+        filtered_docs = filter_batch(batch, specific_topics)
 
         if filtered_docs:
             with insert_lock:
                 try:
-                    db[TARGET_COLLECTION].insert_many(filtered_docs, ordered = False)
+                    storage.insert_many(TARGET_COLLECTION, filtered_docs)
                 except Exception as e:
                     logging.error(f"[Worker-{worker_id}] Insert error: {e}")
 
+        stage_metrics().record_batch(worker_id, time.perf_counter() - batch_start)
         batch_queue.task_done()
         logging.info(f"[Worker-{worker_id}] processed a batch of size {len(batch)}")
 
-def producer():
-    cursor = db[SOURCE_COLLECTION].find({}, no_cursor_timeout = True).batch_size(BATCH_SIZE)
-    try:
-        for batch in chunked_cursor(cursor, BATCH_SIZE):
-            batch_queue.put(batch)
-    finally:
-        cursor.close()
+def producer(reader):
+    for batch in reader.batches(barrier = batch_queue.join):
+        batch_queue.put(batch)
+        stage_metrics().set("queue_depth", batch_queue.qsize())
 
-if __name__ == "__main__":
+def run(storage):
     start_time = time.time()
+    metrics = stage_metrics("specific_topic")
+    configure_pool(workers = NUM_WORKERS, readers = NUM_READERS)
     logging.info("Starting filtering and insertion of specific topics ...")
-
-    db[TARGET_COLLECTION].drop()
+    specific_topics = load_specific_topics()
+
+    meter = transfer_meter("specific_topic")
+    reader = storage.reader(
+        SOURCE_COLLECTION,
+        projection = SOURCE_FIELDS,
+        num_ranges = NUM_READERS,
+        batch_size = BATCH_SIZE,
+        checkpoint_file = reader_checkpoint("specific_topic"),
+        raw = True,
+        meter = meter,
+        shard = current_shard(),
+        shard_key = "authorId"
+    )
+    if not reader.resuming:
+        storage.drop(TARGET_COLLECTION)
+    prepare_for_load(storage, TARGET_COLLECTION)
 
     workers = []
     for i in range(NUM_WORKERS):
-        t = Thread(target = worker, args = (i,))
+        t = Thread(target = worker, args = (i, storage, specific_topics))
         t.start()
         workers.append(t)
 
-    producer()
+    producer(reader)
 
     for _ in range(NUM_WORKERS):
         batch_queue.put(None)
@@ -97,5 +113,19 @@ if __name__ == "__main__":
 
     for t in workers:
         t.join()
+    reader.clear_checkpoint()
+    build_indexes(storage, TARGET_COLLECTION)
+    finish_shard(storage, "specific_topic")
+    if meter:
+        meter.report()
+    metrics.close()
+
+    logging.info(f"Filtering and insertion done in {round(time.time() - start_time, 2)} seconds.")
 
-    logging.info(f"Filtering and insertion done in {round(time.time() - start_time, 2)} seconds.")
\ No newline at end of file
+if __name__ == "__main__":
+    storage = get_storage()
+    try:
+        with profiled("specific_topic"):
+            run(storage)
+    finally:
+        storage.close()
@@ -0,0 +1,578 @@
+# Storage backends for the Import_data stages. MongoStorage works on the
+# research_db database; LocalStorage keeps collections in memory and, when
+# given a directory, persists them as JSON-lines files so the pipeline can run
+# and be benchmarked without a mongod.
+
+from bson import ObjectId, json_util
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+import itertools
+import logging
+import os
+import re
+import time
+
+from bulk_writer import BulkWriter, DEAD_LETTER_COLLECTION, upsert_push_requests, upsert_requests
+from connection import close_client, get_client
+from document_access import raw_collection
+from metrics import stage_metrics
+from sampling import sampled_storage
+
+DB_NAME = "research_db"
+MONGO_URI = "mongodb://localhost:27017/"
+LOCAL_DIR = "Output/local_db"
+
+@contextmanager
+def record_write(name, count):
+    metrics = stage_metrics()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        failed = len((getattr(e, "details", None) or {}).get("writeErrors", [])) or count
+        metrics.inc("write_errors_total", failed, collection = name)
+        metrics.inc("docs_written_total", count - failed, collection = name)
+        raise
+    else:
+        metrics.inc("docs_written_total", count, collection = name)
+    finally:
+        metrics.observe("write_seconds", time.perf_counter() - start, collection = name)
+
+class MongoStorage:
+    def __init__(self, uri = MONGO_URI, db_name = DB_NAME):
+        self.uri = uri
+        self.db_name = db_name
+        self._client = None
+        self.writer = BulkWriter()
+
+    @property
+    def db(self):
+        if self._client is None:
+            self._client = get_client(self.uri)
+        return self._client[self.db_name]
+
+    def collection(self, name):
+        return self.db[name]
+
+    def collection_name(self, name):
+        return name
+
+    def reader(self, name, projection = None, query = None, num_ranges = 1, batch_size = 1000,
+               checkpoint_file = None, raw = False, meter = None, read_preference = None,
+               shard = None, shard_key = "_id"):
+        from parallel_reader import PartitionedReader
+
+        collection = self.db[name]
+        if read_preference is not None:
+            collection = collection.with_options(read_preference = read_preference)
+        if shard is not None:
+            query = shard.mongo_query(self.db[name], shard_key, query)
+        return PartitionedReader(
+            collection,
+            projection = projection,
+            query = query,
+            num_ranges = num_ranges,
+            batch_size = batch_size,
+            checkpoint_file = checkpoint_file,
+            raw = raw,
+            meter = meter
+        )
+
+    def find(self, name, query = None, projection = None, raw = False, batch_size = 1000):
+        collection = raw_collection(self.db[name]) if raw else self.db[name]
+        return collection.find(query or {}, projection, no_cursor_timeout = True).batch_size(batch_size)
+
+    def find_one(self, name, query, projection = None, raw = False):
+        collection = raw_collection(self.db[name]) if raw else self.db[name]
+        return collection.find_one(query, projection)
+
+    def count(self, name):
+        return self.db[name].estimated_document_count()
+
+    def _dead_letter(self, docs):
+        self.db[DEAD_LETTER_COLLECTION].insert_many(docs, ordered = False)
+
+    def insert_many(self, name, docs):
+        if docs:
+            collection = self.db[name]
+            self.writer.run(
+                self.writer.insert_plan(name, docs),
+                lambda batch: collection.insert_many(batch, ordered = False),
+                self._dead_letter
+            )
+
+    def upsert_many(self, name, key_fields, docs):
+        if docs:
+            collection = self.db[name]
+            self.writer.run(
+                self.writer.upsert_plan(name, key_fields, docs),
+                lambda items: collection.bulk_write(upsert_requests(items), ordered = False),
+                self._dead_letter
+            )
+
+    def upsert_push(self, name, key_field, array_field, values, add_to_set = False):
+        if values:
+            collection = self.db[name]
+            self.writer.run(
+                self.writer.upsert_push_plan(name, key_field, array_field, values, add_to_set),
+                lambda items: collection.bulk_write(upsert_push_requests(array_field, items, add_to_set),
+                                                    ordered = False),
+                self._dead_letter
+            )
+
+    def _group_arrays(self, sources, key_field, array_field, destination, accumulate, combine):
+        sources = [sources] if isinstance(sources, str) else list(sources)
+        pipeline = [{"$unionWith": source} for source in sources[1:]] + [
+            {
+                "$group": {
+                    "_id": f"${key_field}",
+                    array_field: {accumulate: f"${array_field}"}
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    key_field: "$_id",
+                    array_field: {
+                        "$reduce": {
+                            "input": f"${array_field}",
+                            "initialValue": [],
+                            "in": {combine: ["$$value", "$$this"]}
+                        }
+                    }
+                }
+            },
+            {
+                "$out": destination
+            }
+        ]
+        self.db[sources[0]].aggregate(pipeline, allowDiskUse = True)
+
+    def union_by_key(self, source, key_field, array_field, destination):
+        self._group_arrays(source, key_field, array_field, destination, "$addToSet", "$setUnion")
+
+    def concat_by_key(self, sources, key_field, array_field, destination):
+        self._group_arrays(sources, key_field, array_field, destination, "$push", "$concatArrays")
+
+    def concat(self, sources, destination):
+        pipeline = [{"$unionWith": source} for source in sources[1:]] + [{"$out": destination}]
+        self.db[sources[0]].aggregate(pipeline, allowDiskUse = True)
+
+    def create_index(self, name, field):
+        self.db[name].create_index(field)
+
+    def create_indexes(self, name, indexes):
+        from pymongo import IndexModel
+
+        self.db[name].create_indexes([IndexModel(keys) for keys in indexes])
+
+    def drop_indexes(self, name, keep = ()):
+        keep = [[(field, int(direction)) for field, direction in keys] for keys in keep]
+        dropped = []
+        for index_name, info in self.db[name].index_information().items():
+            keys = [(field, int(direction)) for field, direction in info["key"]]
+            if index_name != "_id_" and keys not in keep:
+                self.db[name].drop_index(index_name)
+                dropped.append(index_name)
+        return dropped
+
+    def explain(self, name, query, sort = None):
+        cursor = self.db[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        return plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+
+    def clear(self, name):
+        self.db[name].delete_many({})
+
+    def put_marker(self, name, marker_id, doc):
+        self.db[name].replace_one({"_id": marker_id}, dict(doc, _id = marker_id), upsert = True)
+
+    def markers(self, name, prefix):
+        return list(self.db[name].find({"_id": {"$regex": f"^{re.escape(prefix)}"}}))
+
+    def claim_marker(self, name, marker_id, doc):
+        from pymongo.errors import DuplicateKeyError
+
+        try:
+            self.db[name].insert_one(dict(doc, _id = marker_id))
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def delete_markers(self, name, prefix):
+        self.db[name].delete_many({"_id": {"$regex": f"^{re.escape(prefix)}"}})
+
+    def drop(self, name):
+        self.db[name].drop()
+
+    def close(self):
+        if self._client is not None:
+            close_client(self.uri)
+            self._client = None
+
+def plan_stages(plan):
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("queryPlan", "inputStage"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+def project(doc, projection):
+    if not projection:
+        return dict(doc)
+
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if not include:
+        projected = {k: v for k, v in doc.items() if k not in projection}
+        return projected
+
+    projected = {}
+    if projection.get("_id", 1) and "_id" in doc:
+        projected["_id"] = doc["_id"]
+    for path in include:
+        _copy_path(doc, projected, path.split("."))
+    return projected
+
+def _copy_path(source, target, keys):
+    key = keys[0]
+    if key not in source:
+        return
+    value = source[key]
+    if len(keys) == 1:
+        target[key] = value
+    elif isinstance(value, list):
+        items = target.setdefault(key, [{} for _ in value])
+        for item, sub_target in zip(value, items):
+            if isinstance(item, dict):
+                _copy_path(item, sub_target, keys[1:])
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(key, {}), keys[1:])
+
+def matches(doc, query):
+    for field, expected in (query or {}).items():
+        value = doc.get(field)
+        if isinstance(expected, dict):
+            if set(expected) != {"$in"}:
+                raise NotImplementedError(f"LocalStorage only supports equality and $in queries (got {field}: {expected})")
+            # Like Mongo, an array field matches when any of its elements does.
+            values = value if isinstance(value, list) else [value]
+            if not any(v in expected["$in"] for v in values):
+                return False
+        elif value != expected:
+            return False
+    return True
+
+class LocalReader:
+    def __init__(self, storage, name, projection = None, query = None, batch_size = 1000, meter = None,
+                 shard = None, shard_key = "_id"):
+        self.storage = storage
+        self.name = name
+        self.projection = projection
+        self.query = query
+        self.batch_size = batch_size
+        self.meter = meter
+        self.shard = shard
+        self.shard_key = shard_key
+        self.resuming = False
+
+    def batches(self, barrier = None):
+        metrics = stage_metrics()
+        if self.shard is None:
+            cursor = self.storage.find(self.name, self.query, self.projection)
+        else:
+            docs = self.shard.select(self.storage.find(self.name, self.query), self.shard_key)
+            cursor = (project(doc, self.projection) for doc in docs)
+        while True:
+            with metrics.timer("read_batch_seconds", collection = self.name):
+                batch = list(itertools.islice(cursor, self.batch_size))
+            if not batch:
+                break
+            metrics.inc("docs_read_total", len(batch), collection = self.name)
+            if self.meter:
+                self.meter.add(self.name, batch)
+            yield batch
+
+    def clear_checkpoint(self):
+        pass
+
+class LocalStorage:
+    def __init__(self, directory = LOCAL_DIR):
+        self.directory = directory
+        self.collections = {}
+        self.indexes = defaultdict(dict)
+        # Compound keys of upsert_many: {name: {key fields: {key values: position}}}
+        self.key_indexes = defaultdict(dict)
+        self.dirty = set()
+        self.memory_markers = {}
+        self._lock = Lock()
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.jsonl")
+
+    def _docs(self, name):
+        if name not in self.collections:
+            docs = []
+            if self.directory and os.path.exists(self._path(name)):
+                with open(self._path(name), "r", encoding = "utf-8") as f:
+                    docs = [json_util.loads(line) for line in f if line.strip()]
+            self.collections[name] = docs
+        return self.collections[name]
+
+    def reader(self, name, projection = None, query = None, num_ranges = 1, batch_size = 1000,
+               checkpoint_file = None, raw = False, meter = None, read_preference = None,
+               shard = None, shard_key = "_id"):
+        if shard is not None and shard.mode == "mod":
+            # Rejects non-integer keys before the stage starts, as MongoStorage does.
+            for doc in self.find(name, query):
+                shard.shard_of(doc.get(shard_key))
+        return LocalReader(self, name, projection, query, batch_size, meter, shard, shard_key)
+
+    def find(self, name, query = None, projection = None, raw = False, batch_size = 1000):
+        with self._lock:
+            docs = list(self._docs(name))
+        return (project(doc, projection) for doc in docs if matches(doc, query))
+
+    def find_one(self, name, query, projection = None, raw = False):
+        with self._lock:
+            docs = self._docs(name)
+            if len(query) == 1:
+                field, value = next(iter(query.items()))
+                if field in self.indexes[name] and not isinstance(value, dict):
+                    position = self.indexes[name][field].get(value)
+                    return project(docs[position], projection) if position is not None else None
+            for doc in docs:
+                if matches(doc, query):
+                    return project(doc, projection)
+        return None
+
+    def count(self, name):
+        with self._lock:
+            return len(self._docs(name))
+
+    def collection_name(self, name):
+        return name
+
+    def insert_many(self, name, docs):
+        with record_write(name, len(docs)), self._lock:
+            collection = self._docs(name)
+            for doc in docs:
+                doc = dict(doc)
+                doc.setdefault("_id", ObjectId())
+                for field, index in self.indexes[name].items():
+                    index.setdefault(doc.get(field), len(collection))
+                self._index_keys(name, doc, len(collection))
+                collection.append(doc)
+            self.dirty.add(name)
+
+    def _index_keys(self, name, doc, position):
+        for key_fields, index in self.key_indexes[name].items():
+            index.setdefault(tuple(doc.get(field) for field in key_fields), position)
+
+    def upsert_many(self, name, key_fields, docs):
+        key_fields = tuple(key_fields)
+        with record_write(name, len(docs)), self._lock:
+            collection = self._docs(name)
+            positions = self.key_indexes[name].get(key_fields)
+            if positions is None:
+                positions = {}
+                for i, doc in enumerate(collection):
+                    positions.setdefault(tuple(doc.get(field) for field in key_fields), i)
+                self.key_indexes[name][key_fields] = positions
+            for doc in docs:
+                doc = dict(doc)
+                position = positions.get(tuple(doc.get(field) for field in key_fields))
+                if position is None:
+                    doc.setdefault("_id", ObjectId())
+                    for field, index in self.indexes[name].items():
+                        index.setdefault(doc.get(field), len(collection))
+                    self._index_keys(name, doc, len(collection))
+                    collection.append(doc)
+                else:
+                    doc.setdefault("_id", collection[position]["_id"])
+                    collection[position] = doc
+            self.dirty.add(name)
+
+    def upsert_push(self, name, key_field, array_field, values, add_to_set = False):
+        with record_write(name, len(values)), self._lock:
+            collection = self._docs(name)
+            index = self.indexes[name].get(key_field)
+            if index is None:
+                index = {doc.get(key_field): i for i, doc in reversed(list(enumerate(collection)))}
+                self.indexes[name][key_field] = index
+            for key, items in values.items():
+                position = index.get(key)
+                if position is None:
+                    index[key] = len(collection)
+                    doc = {"_id": ObjectId(), key_field: key, array_field: list(items)}
+                    self._index_keys(name, doc, len(collection))
+                    collection.append(doc)
+                else:
+                    existing = collection[position].setdefault(array_field, [])
+                    if add_to_set:
+                        items = [item for item in items if item not in existing]
+                    existing.extend(items)
+            self.dirty.add(name)
+
+    def union_by_key(self, source, key_field, array_field, destination):
+        grouped = {}
+        for name in [source] if isinstance(source, str) else source:
+            for doc in self.find(name):
+                values = grouped.setdefault(doc.get(key_field), {})
+                for value in doc.get(array_field, []):
+                    values[value] = None
+        self.drop(destination)
+        self.insert_many(destination, [{key_field: k, array_field: list(v)} for k, v in grouped.items()])
+
+    def concat_by_key(self, sources, key_field, array_field, destination):
+        grouped = {}
+        for name in sources:
+            for doc in self.find(name):
+                grouped.setdefault(doc.get(key_field), []).extend(doc.get(array_field, []))
+        self.drop(destination)
+        self.insert_many(destination, [{key_field: k, array_field: v} for k, v in grouped.items()])
+
+    def concat(self, sources, destination):
+        docs = [doc for name in sources for doc in self.find(name)]
+        self.drop(destination)
+        self.insert_many(destination, docs)
+
+    def create_index(self, name, field):
+        with self._lock:
+            index = {}
+            for position, doc in enumerate(self._docs(name)):
+                index.setdefault(doc.get(field), position)
+            self.indexes[name][field] = index
+
+    # Hash indexes only serve single-field equality on scalar top-level
+    # fields, so only the leading field of a planned index is kept and
+    # multikey (array) fields are skipped.
+    def create_indexes(self, name, indexes):
+        for keys in indexes:
+            field = keys[0][0]
+            if "." in field:
+                continue
+            with self._lock:
+                multikey = any(isinstance(doc.get(field), list) for doc in self._docs(name))
+            if not multikey:
+                self.create_index(name, field)
+
+    def drop_indexes(self, name, keep = ()):
+        keep_fields = {keys[0][0] for keys in keep}
+        with self._lock:
+            dropped = [field for field in self.indexes[name] if field not in keep_fields]
+            for field in dropped:
+                del self.indexes[name][field]
+        return dropped
+
+    def explain(self, name, query, sort = None):
+        with self._lock:
+            indexed = len(query) == 1 and all(
+                field in self.indexes[name] and not isinstance(value, dict) for field, value in query.items()
+            )
+        return ["IXSCAN"] if indexed else ["COLLSCAN"]
+
+    def clear(self, name):
+        with self._lock:
+            self.collections[name] = []
+            for field in self.indexes[name]:
+                self.indexes[name][field] = {}
+            self.key_indexes.pop(name, None)
+            self.dirty.add(name)
+
+    def drop(self, name):
+        with self._lock:
+            self.collections[name] = []
+            self.indexes.pop(name, None)
+            self.key_indexes.pop(name, None)
+            self.dirty.add(name)
+
+    # Markers are one file each (or in memory without a directory) so shard
+    # processes sharing a directory never overwrite each other's; a marker is
+    # only written after this process's collections are flushed.
+    def _marker_path(self, name, marker_id):
+        return os.path.join(self.directory, name, re.sub(r"[^\w.-]", "_", marker_id) + ".json")
+
+    def put_marker(self, name, marker_id, doc):
+        self.flush()
+        doc = dict(doc, _id = marker_id)
+        if not self.directory:
+            self.memory_markers.setdefault(name, {})[marker_id] = doc
+            return
+        path = self._marker_path(name, marker_id)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path + ".tmp", "w", encoding = "utf-8") as f:
+            f.write(json_util.dumps(doc))
+        os.replace(path + ".tmp", path)
+
+    def markers(self, name, prefix):
+        if not self.directory:
+            return [d for k, d in self.memory_markers.get(name, {}).items() if k.startswith(prefix)]
+        directory = os.path.join(self.directory, name)
+        if not os.path.isdir(directory):
+            return []
+        found = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".json"):
+                with open(os.path.join(directory, filename), "r", encoding = "utf-8") as f:
+                    doc = json_util.loads(f.read())
+                if doc["_id"].startswith(prefix):
+                    found.append(doc)
+        return found
+
+    def claim_marker(self, name, marker_id, doc):
+        self.flush()
+        doc = dict(doc, _id = marker_id)
+        if not self.directory:
+            claimed = self.memory_markers.setdefault(name, {})
+            return claimed.setdefault(marker_id, doc) is doc
+        path = self._marker_path(name, marker_id)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding = "utf-8") as f:
+            f.write(json_util.dumps(doc))
+        return True
+
+    def delete_markers(self, name, prefix):
+        for doc in self.markers(name, prefix):
+            if self.directory:
+                os.remove(self._marker_path(name, doc["_id"]))
+            else:
+                del self.memory_markers[name][doc["_id"]]
+
+    def flush(self):
+        if not self.directory:
+            return
+        with self._lock:
+            for name in self.dirty:
+                if not self.collections[name]:
+                    if os.path.exists(self._path(name)):
+                        os.remove(self._path(name))
+                    continue
+                tmp_path = self._path(name) + ".tmp"
+                with open(tmp_path, "w", encoding = "utf-8") as f:
+                    for doc in self.collections[name]:
+                        f.write(json_util.dumps(doc) + "\n")
+                os.replace(tmp_path, self._path(name))
+            self.dirty.clear()
+
+    def close(self):
+        self.flush()
+
+def get_storage():
+    engine = os.environ.get("REPA_STORAGE", "mongo")
+    if engine == "local":
+        directory = os.environ.get("REPA_LOCAL_DIR", LOCAL_DIR)
+        logging.info(f"Using local storage in {directory or 'memory'}")
+        return sampled_storage(LocalStorage(directory or None))
+    return sampled_storage(
+        MongoStorage(os.environ.get("REPA_MONGO_URI", MONGO_URI), os.environ.get("REPA_DB_NAME", DB_NAME))
+    )
@@ -0,0 +1,275 @@
+# Synthetic inputs for the pipeline: a CSO-like topic DAG in the CSO CSV
+# format, and papers / authors / annotations JSON-lines files whose
+# authors-per-paper and topics-per-paper follow Zipfian distributions.
+
+from collections import defaultdict
+import argparse
+import json
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+SUPER_TOPIC_OF = "<http://cso.kmi.open.ac.uk/schema/cso#superTopicOf>"
+RELATED_EQUIVALENT = "<http://cso.kmi.open.ac.uk/schema/cso#relatedEquivalent>"
+CONTRIBUTES_TO = "<http://cso.kmi.open.ac.uk/schema/cso#contributesTo>"
+TOPIC_URI = "<https://cso.kmi.open.ac.uk/topics/{}>"
+
+# Singular nouns only, so the labels survive the lemmatizer of the stages unchanged.
+WORDS = [
+    "network", "learning", "system", "model", "graph", "retrieval", "security",
+    "vision", "language", "database", "robot", "sensor", "protocol", "compiler",
+    "algorithm", "ontology", "signal", "circuit", "cloud", "memory"
+]
+
+SCALES = {
+    "10k": {"papers": 10_000, "authors": 5_000, "topics": 2_000},
+    "1m": {"papers": 1_000_000, "authors": 400_000, "topics": 14_000},
+    "10m": {"papers": 10_000_000, "authors": 3_000_000, "topics": 14_000}
+}
+
+MAX_DEPTH = 6
+FAN_OUT = 4
+EXTRA_PARENT_PROB = 0.15
+EQUIVALENCE_DENSITY = 0.05
+CONTRIBUTION_DENSITY = 0.05
+ANNOTATED_FRACTION = 0.8
+
+AUTHORS_EXPONENT = 1.8
+MAX_AUTHORS_PER_PAPER = 50
+AUTHOR_POPULARITY_EXPONENT = 1.0
+TOPICS_EXPONENT = 1.6
+MAX_TOPICS_PER_PAPER = 40
+TOPIC_POPULARITY_EXPONENT = 1.1
+CHUNK_SIZE = 100_000
+MAX_OUT_DEGREE = 2
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+def topic_label(index):
+    return f"{WORDS[index % len(WORDS)]}_{index}"
+
+def generate_topic_dag(num_topics, max_depth = MAX_DEPTH, fan_out = FAN_OUT, extra_parent_prob = EXTRA_PARENT_PROB, seed = 0):
+    # Topics are laid out level by level: every topic of a level draws a
+    # Poisson number of children around fan_out until the topic budget is
+    # spent, and some children also get an extra parent from a shallower level.
+    rng = np.random.default_rng(seed)
+    roots = max(1, int(num_topics // fan_out ** max_depth))
+    levels = [list(range(roots))]
+    parents = defaultdict(list)
+    next_topic = roots
+
+    while next_topic < num_topics:
+        depth = len(levels)
+        level = []
+        for parent in levels[-1]:
+            children = rng.poisson(fan_out) if depth < max_depth else 0
+            for _ in range(children):
+                if next_topic >= num_topics:
+                    break
+                parents[next_topic].append(parent)
+                level.append(next_topic)
+                next_topic += 1
+        if not level:
+            # Budget left once max_depth is reached: hang it under random topics.
+            for child in range(next_topic, num_topics):
+                parents[child].append(int(rng.integers(0, next_topic)))
+            next_topic = num_topics
+            break
+        levels.append(level)
+
+    for child in range(roots, num_topics):
+        if rng.random() < extra_parent_prob:
+            extra = int(rng.integers(0, child))
+            if extra not in parents[child]:
+                parents[child].append(extra)
+    return parents
+
+def write_cso_csv(path, num_topics, max_depth = MAX_DEPTH, fan_out = FAN_OUT, extra_parent_prob = EXTRA_PARENT_PROB,
+                  equivalence_density = EQUIVALENCE_DENSITY, contribution_density = CONTRIBUTION_DENSITY, seed = 0):
+    rng = np.random.default_rng(seed + 1)
+    parents = generate_topic_dag(num_topics, max_depth, fan_out, extra_parent_prob, seed)
+    rows = []
+    for child, topic_parents in parents.items():
+        for parent in topic_parents:
+            rows.append((parent, SUPER_TOPIC_OF, child))
+    for _ in range(int(num_topics * equivalence_density)):
+        a, b = rng.choice(num_topics, size = 2, replace = False)
+        rows.append((int(a), RELATED_EQUIVALENT, int(b)))
+    for _ in range(int(num_topics * contribution_density)):
+        a, b = rng.choice(num_topics, size = 2, replace = False)
+        rows.append((int(a), CONTRIBUTES_TO, int(b)))
+
+    with open(path, "w", encoding = "utf-8") as f:
+        for subject, predicate, obj in rows:
+            f.write(f"{TOPIC_URI.format(topic_label(subject))},{predicate},{TOPIC_URI.format(topic_label(obj))}\n")
+    logging.info(f"{path}: {num_topics} topics, {len(rows)} rows")
+    return parents, rows
+
+def specific_topics(rows, max_out_degree = MAX_OUT_DEGREE):
+    # Same rule as read_cso_csv.find_specific_topics on the graph of all rows.
+    successors = defaultdict(set)
+    nodes = set()
+    for subject, _, obj in rows:
+        successors[subject].add(obj)
+        nodes.update((subject, obj))
+    return sorted(
+        topic_label(node).replace("_", " ")
+        for node in nodes
+        if len(successors[node]) <= max_out_degree
+    )
+
+def zipf_counts(rng, exponent, maximum, size):
+    return np.minimum(rng.zipf(exponent, size), maximum)
+
+def popularity_cdf(size, exponent):
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+def draw(rng, cdf, ranking, size):
+    return ranking[np.minimum(np.searchsorted(cdf, rng.random(size)), len(ranking) - 1)]
+
+def write_corpus(input_dir, num_papers, num_authors, parents, num_topics, annotated_fraction = ANNOTATED_FRACTION, seed = 0):
+    rng = np.random.default_rng(seed + 2)
+    author_ranking = rng.permutation(num_authors)
+    author_cdf = popularity_cdf(num_authors, AUTHOR_POPULARITY_EXPONENT)
+    topic_ranking = rng.permutation(num_topics)
+    topic_cdf = popularity_cdf(num_topics, TOPIC_POPULARITY_EXPONENT)
+    labels = [topic_label(t).replace("_", " ") for t in range(num_topics)]
+    first_parent = [parents[t][0] if parents.get(t) else None for t in range(num_topics)]
+
+    paper_counts = np.zeros(num_authors, dtype = np.int64)
+    annotated_authors = np.zeros(num_authors, dtype = bool)
+    stats = defaultdict(int)
+
+    papers_path = os.path.join(input_dir, "papers.jsonl")
+    annotations_path = os.path.join(input_dir, "D3_annotated_papers.jsonl")
+    with open(papers_path, "w", encoding = "utf-8") as papers, open(annotations_path, "w", encoding = "utf-8") as annotations:
+        for start in range(0, num_papers, CHUNK_SIZE):
+            size = min(CHUNK_SIZE, num_papers - start)
+            author_counts = zipf_counts(rng, AUTHORS_EXPONENT, MAX_AUTHORS_PER_PAPER, size)
+            topic_counts = zipf_counts(rng, TOPICS_EXPONENT, MAX_TOPICS_PER_PAPER, size)
+            authors = draw(rng, author_cdf, author_ranking, int(author_counts.sum()))
+            topics = draw(rng, topic_cdf, topic_ranking, int(topic_counts.sum()))
+            annotated = rng.random(size) < annotated_fraction
+            np.add.at(paper_counts, authors, 1)
+
+            author_offset = 0
+            topic_offset = 0
+            for i in range(size):
+                corpusid = start + i + 1
+                paper_authors = list(dict.fromkeys(authors[author_offset : author_offset + author_counts[i]].tolist()))
+                paper_topics = list(dict.fromkeys(topics[topic_offset : topic_offset + topic_counts[i]].tolist()))
+                author_offset += author_counts[i]
+                topic_offset += topic_counts[i]
+
+                papers.write(json.dumps({
+                    "corpusid": corpusid,
+                    "title": f"Synthetic paper {corpusid}",
+                    "year": 1990 + corpusid % 35,
+                    "authors": [{"authorId": str(a), "name": f"Author {a}"} for a in paper_authors]
+                }) + "\n")
+                stats["papers"] += 1
+                stats["authorships"] += len(paper_authors)
+
+                if not annotated[i]:
+                    continue
+                syntactic = [labels[t] for t in paper_topics[: math.ceil(len(paper_topics) / 2)]]
+                semantic = [labels[t] for t in paper_topics[len(paper_topics) // 3 :]]
+                enhanced = sorted({labels[first_parent[t]] for t in paper_topics if first_parent[t] is not None})
+                annotations.write(json.dumps({
+                    "corpusid": corpusid,
+                    "syntactic": syntactic,
+                    "semantic": semantic,
+                    "enhanced": enhanced,
+                    "union": sorted(set(syntactic) | set(semantic))
+                }) + "\n")
+                stats["annotated_papers"] += 1
+                stats["annotated_authorships"] += len(paper_authors)
+                annotated_authors[paper_authors] = True
+            logging.info(f"{start + size:,}/{num_papers:,} papers written")
+
+    authors_path = os.path.join(input_dir, "authors.jsonl")
+    with open(authors_path, "w", encoding = "utf-8") as f:
+        for author in range(num_authors):
+            count = int(paper_counts[author])
+            f.write(json.dumps({
+                "authorid": str(author),
+                "name": f"Author {author}",
+                "papercount": count,
+                "hindex": int(math.sqrt(count))
+            }) + "\n")
+    stats["authors"] = num_authors
+    stats["annotated_authors"] = int(annotated_authors.sum())
+    return dict(stats)
+
+def generate(output_root, papers, authors, topics, seed = 0, max_depth = MAX_DEPTH, fan_out = FAN_OUT,
+             extra_parent_prob = EXTRA_PARENT_PROB, equivalence_density = EQUIVALENCE_DENSITY):
+    # Lays out the tree the stages expect when run from output_root:
+    # Input/ for the raw files and Output/specific_topics.txt.
+    start_time = time.time()
+    input_dir = os.path.join(output_root, "Input")
+    output_dir = os.path.join(output_root, "Output")
+    os.makedirs(input_dir, exist_ok = True)
+    os.makedirs(output_dir, exist_ok = True)
+
+    parents, rows = write_cso_csv(
+        os.path.join(input_dir, "CSO.3.4.1.csv"), topics, max_depth, fan_out,
+        extra_parent_prob, equivalence_density, seed = seed
+    )
+    specific = specific_topics(rows)
+    with open(os.path.join(output_dir, "specific_topics.txt"), "w", encoding = "utf-8") as f:
+        for topic in specific:
+            f.write(topic + "\n")
+
+    stats = write_corpus(input_dir, papers, authors, parents, topics, seed = seed)
+    stats.update({"topics": topics, "cso_rows": len(rows), "specific_topics": len(specific)})
+    stats["input_documents"] = stats["papers"] + stats["annotated_papers"] + stats["authors"]
+
+    manifest = {
+        "params": {
+            "papers": papers, "authors": authors, "topics": topics, "seed": seed, "max_depth": max_depth,
+            "fan_out": fan_out, "extra_parent_prob": extra_parent_prob, "equivalence_density": equivalence_density
+        },
+        "stats": stats
+    }
+    with open(os.path.join(output_root, "manifest.json"), "w", encoding = "utf-8") as f:
+        json.dump(manifest, f, indent = 2)
+    logging.info(f"Synthetic dataset written to {output_root} in {round(time.time() - start_time, 2)} seconds.")
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description = "Generate a synthetic CSO graph and corpus for the pipeline.")
+    parser.add_argument("output_root", help = "Directory that will hold Input/ and Output/")
+    parser.add_argument("--scale", choices = sorted(SCALES), default = "10k")
+    parser.add_argument("--papers", type = int)
+    parser.add_argument("--authors", type = int)
+    parser.add_argument("--topics", type = int)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--max-depth", type = int, default = MAX_DEPTH)
+    parser.add_argument("--fan-out", type = float, default = FAN_OUT)
+    parser.add_argument("--extra-parent-prob", type = float, default = EXTRA_PARENT_PROB)
+    parser.add_argument("--equivalence-density", type = float, default = EQUIVALENCE_DENSITY)
+    args = parser.parse_args()
+
+    scale = SCALES[args.scale]
+    generate(
+        args.output_root,
+        papers = args.papers or scale["papers"],
+        authors = args.authors or scale["authors"],
+        topics = args.topics or scale["topics"],
+        seed = args.seed,
+        max_depth = args.max_depth,
+        fan_out = args.fan_out,
+        extra_parent_prob = args.extra_parent_prob,
+        equivalence_density = args.equivalence_density
+    )
+
+if __name__ == "__main__":
+    main()
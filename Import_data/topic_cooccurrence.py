@@ -0,0 +1,269 @@
+# Topic co-occurrence over the paper annotations: how often two topics are
+# attached to the same paper, and how much more often than chance (PMI and
+# normalized PMI). Each paper's topics are the union of its syntactic,
+# semantic, enhanced and union annotations, as in associate_each_paper.
+#
+# Worker processes each stream a slice of annotated_papers (corpusid modulo
+# the number of workers), number the topics they meet and buffer the pairs
+# of every paper as COO coordinates; full buffers are summed into a CSR
+# matrix of the upper triangle. The parent remaps every worker's topic ids
+# onto one sorted vocabulary and adds the matrices up, so nothing quadratic
+# ever goes through Mongo ($unwind of the topic pairs would). Results land in
+# Output/cooccurrence/ (counts.npz, npmi.npz, topics.json,
+# topic_counts.npy) and, for each topic, its top-k neighbours by NPMI go to
+# the topic_cooccurrence collection. --specific restricts everything to the
+# specific topics (specific_topic_cooccurrence).
+#
+# Requires scipy (pip install scipy).
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import logging
+import os
+import time
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+import numpy as np
+
+from storage import get_storage
+from index_plan import prepare_for_load, build_indexes
+from metrics import stage_metrics
+from profiling import phase, profile_mode, profiled
+from sampling import current_sample, sample_environment, sample_suffix
+from sharding import ShardSpec
+from specific_topic import load_specific_topics, SPECIFIC_TOPICS_FILE
+
+SOURCE_COLLECTION = "annotated_papers"
+SOURCE_FIELDS = {"_id": 0, "corpusid": 1, "syntactic": 1, "semantic": 1, "enhanced": 1, "union": 1}
+ANNOTATION_KEYS = ["syntactic", "semantic", "enhanced", "union"]
+NEIGHBORS_COLLECTION = "topic_cooccurrence"
+SPECIFIC_NEIGHBORS_COLLECTION = "specific_topic_cooccurrence"
+OUTPUT_DIR = "Output/cooccurrence"
+BATCH_SIZE = 1000
+CHUNK_PAIRS = 2000000
+NUM_PROCESSES = min(4, os.cpu_count() or 1)
+TOP_K = 20
+# Pairs seen on fewer papers are kept in the counts but not ranked: PMI of
+# rare pairs is dominated by noise.
+MIN_COUNT = 3
+WRITE_BATCH_SIZE = 1000
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+_pair_cache = {}
+
+def upper_pairs(size):
+    if size not in _pair_cache:
+        _pair_cache[size] = np.triu_indices(size, 1)
+    return _pair_cache[size]
+
+def paper_topics(doc, allowed = None):
+    topics = set()
+    for key in ANNOTATION_KEYS:
+        topics.update(doc.get(key) or [])
+    if allowed is not None:
+        topics = {topic for topic in topics if topic.lower() in allowed}
+    return topics
+
+class PairCounter:
+    def __init__(self):
+        self.positions = {}
+        self.topics = []
+        self.topic_counts = []
+        self.papers = 0
+        self.rows = []
+        self.cols = []
+        self.buffered = 0
+        self.counts = sparse.csr_matrix((0, 0), dtype = np.int64)
+
+    def add(self, topics):
+        if not topics:
+            return
+        ids = []
+        for topic in topics:
+            position = self.positions.get(topic)
+            if position is None:
+                position = self.positions[topic] = len(self.topics)
+                self.topics.append(topic)
+                self.topic_counts.append(0)
+            self.topic_counts[position] += 1
+            ids.append(position)
+        self.papers += 1
+        if len(ids) < 2:
+            return
+        ids = np.sort(np.array(ids, dtype = np.int32))
+        first, second = upper_pairs(len(ids))
+        self.rows.append(ids[first])
+        self.cols.append(ids[second])
+        self.buffered += len(first)
+        if self.buffered >= CHUNK_PAIRS:
+            self.flush()
+
+    def flush(self):
+        size = len(self.topics)
+        if self.counts.shape[0] < size:
+            self.counts.resize((size, size))
+        if self.rows:
+            rows = np.concatenate(self.rows)
+            chunk = sparse.coo_matrix((np.ones(len(rows), dtype = np.int64), (rows, np.concatenate(self.cols))),
+                                      shape = (size, size)).tocsr()
+            self.counts = self.counts + chunk
+        self.rows, self.cols, self.buffered = [], [], 0
+
+def count_slice(index, processes, specific_topics):
+    # Runs in a worker process, on its own storage connection.
+    storage = get_storage()
+    try:
+        counter = PairCounter()
+        shard = ShardSpec(index, processes, mode = "mod") if processes > 1 else None
+        reader = storage.reader(SOURCE_COLLECTION, projection = SOURCE_FIELDS, batch_size = BATCH_SIZE,
+                                shard = shard, shard_key = "corpusid")
+        for batch in reader.batches():
+            for doc in batch:
+                counter.add(paper_topics(doc, specific_topics))
+        counter.flush()
+        return counter.topics, np.array(counter.topic_counts, dtype = np.int64), counter.counts, counter.papers
+    finally:
+        storage.close()
+
+def merge(partials):
+    # One sorted vocabulary; each worker's ids are remapped onto it and the
+    # pairs folded back into the upper triangle.
+    topics = sorted(set().union(*(set(part[0]) for part in partials)))
+    positions = {topic: i for i, topic in enumerate(topics)}
+    size = len(topics)
+    topic_counts = np.zeros(size, dtype = np.int64)
+    counts = sparse.csr_matrix((size, size), dtype = np.int64)
+    papers = 0
+    for local_topics, local_counts, local_pairs, local_papers in partials:
+        mapping = np.array([positions[topic] for topic in local_topics], dtype = np.int64)
+        if len(mapping):
+            np.add.at(topic_counts, mapping, local_counts)
+        coo = local_pairs.tocoo()
+        rows, cols = mapping[coo.row], mapping[coo.col]
+        counts = counts + sparse.coo_matrix(
+            (coo.data, (np.minimum(rows, cols), np.maximum(rows, cols))), shape = (size, size)
+        ).tocsr()
+        papers += local_papers
+    return topics, topic_counts, counts, papers
+
+def npmi_values(pair_counts, counts_a, counts_b, papers):
+    # PMI = log(p(a,b) / (p(a) p(b))), NPMI = PMI / -log p(a,b), in [-1, 1].
+    joint = pair_counts / papers
+    pmi = np.log(joint / ((counts_a / papers) * (counts_b / papers)))
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return np.where(joint < 1, pmi / -np.log(joint), 1.0)
+
+def npmi_matrix(counts, topic_counts, papers):
+    upper = counts.tocoo()
+    values = npmi_values(upper.data, topic_counts[upper.row], topic_counts[upper.col], papers)
+    return sparse.csr_matrix((values, (upper.row, upper.col)), shape = counts.shape)
+
+def neighbor_docs(topics, topic_counts, counts, papers, k, min_count):
+    # Both triangles, so every topic sees all of its partners.
+    full = (counts + counts.T).tocsr()
+    for i, topic in enumerate(topics):
+        start, end = full.indptr[i], full.indptr[i + 1]
+        partners = full.indices[start:end]
+        pair_counts = full.data[start:end]
+        keep = pair_counts >= min_count
+        partners, pair_counts = partners[keep], pair_counts[keep]
+        scores = npmi_values(pair_counts, topic_counts[i], topic_counts[partners], papers)
+        best = np.argsort(-scores, kind = "stable")[:k]
+        yield {
+            "topic": topic,
+            "papers": int(topic_counts[i]),
+            "neighbors": [
+                {"topic": topics[partners[j]], "count": int(pair_counts[j]), "npmi": round(float(scores[j]), 4)}
+                for j in best
+            ]
+        }
+
+def save(directory, topics, topic_counts, counts, npmi, papers):
+    os.makedirs(directory, exist_ok = True)
+    sparse.save_npz(os.path.join(directory, "counts.npz"), counts)
+    sparse.save_npz(os.path.join(directory, "npmi.npz"), npmi)
+    np.save(os.path.join(directory, "topic_counts.npy"), topic_counts)
+    with open(os.path.join(directory, "topics.json"), "w", encoding = "utf-8") as f:
+        json.dump({"papers": papers, "topics": topics}, f)
+
+def store_neighbors(storage, name, docs):
+    storage.drop(name)
+    prepare_for_load(storage, name)
+    batch = []
+    total = 0
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= WRITE_BATCH_SIZE:
+            storage.insert_many(name, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        storage.insert_many(name, batch)
+        total += len(batch)
+    build_indexes(storage, name)
+    logging.info(f"[{name}] Neighbours stored for {total:,} topics")
+
+def run(storage, specific = False, processes = NUM_PROCESSES, k = TOP_K, min_count = MIN_COUNT,
+        specific_topics_file = SPECIFIC_TOPICS_FILE):
+    if sparse is None:
+        raise SystemExit("topic_cooccurrence requires scipy: pip install scipy")
+
+    start_time = time.time()
+    metrics = stage_metrics("topic_cooccurrence")
+    specific_topics = load_specific_topics(specific_topics_file) if specific else None
+
+    with phase("count"):
+        if processes > 1:
+            # Workers read the sample from the environment, not our argv.
+            os.environ.update(sample_environment())
+            with ProcessPoolExecutor(max_workers = processes) as executor:
+                partials = list(executor.map(count_slice, range(processes), [processes] * processes,
+                                             [specific_topics] * processes))
+        else:
+            partials = [count_slice(0, 1, specific_topics)]
+    with phase("merge"):
+        topics, topic_counts, counts, papers = merge(partials)
+    if processes > 1:
+        # Reads counted in the workers never reach this process's metrics.
+        metrics.inc("docs_read_total", papers, collection = SOURCE_COLLECTION)
+    logging.info(f"{papers:,} annotated papers, {len(topics):,} topics, {counts.nnz:,} co-occurring pairs")
+
+    with phase("npmi"):
+        npmi = npmi_matrix(counts, topic_counts, max(papers, 1))
+    directory = OUTPUT_DIR + ("_specific" if specific else "") + sample_suffix()
+    with phase("write"):
+        save(directory, topics, topic_counts, counts, npmi, papers)
+        name = SPECIFIC_NEIGHBORS_COLLECTION if specific else NEIGHBORS_COLLECTION
+        store_neighbors(storage, name, neighbor_docs(topics, topic_counts, counts, max(papers, 1), k, min_count))
+    metrics.close()
+    logging.info(f"Co-occurrence matrix in {directory}, done in {round(time.time() - start_time, 2)} seconds.")
+
+def main(storage, mode):
+    parser = argparse.ArgumentParser(description = "Topic co-occurrence counts, PMI/NPMI and top-k neighbours.")
+    parser.add_argument("--specific", action = "store_true", help = "Only count specific topics")
+    parser.add_argument("--specific-topics", default = SPECIFIC_TOPICS_FILE)
+    parser.add_argument("--processes", type = int, default = NUM_PROCESSES)
+    parser.add_argument("-k", type = int, default = TOP_K, help = "Neighbours stored per topic")
+    parser.add_argument("--min-count", type = int, default = MIN_COUNT,
+                        help = "Minimum number of shared papers for a neighbour")
+    args = parser.parse_args()
+    with profiled("topic_cooccurrence", mode):
+        run(storage, args.specific, args.processes, args.k, args.min_count, args.specific_topics)
+
+if __name__ == "__main__":
+    mode = profile_mode()
+    current_sample()
+    storage = get_storage()
+    try:
+        main(storage, mode)
+    finally:
+        storage.close()
@@ -0,0 +1,93 @@
+# Topic labels from CSO URIs, lemmatized with WordNet. The corpus is looked up
+# locally (REPA_NLTK_DATA, then the repository's nltk_data/ directory, then
+# nltk's default paths) the first time a label is normalised, never at import.
+# Outside REPA_OFFLINE=1 a missing corpus is downloaded once into nltk_data/;
+# in offline mode it is an error. `python topic_labels.py --download` fetches
+# the corpus ahead of time for air-gapped workers.
+
+from functools import lru_cache
+from threading import Lock
+import argparse
+import os
+import re
+import urllib.parse
+
+NLTK_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nltk_data")
+NLTK_RESOURCES = [("wordnet", "corpora/wordnet"), ("omw-1.4", "corpora/omw-1.4")]
+
+_lemmatizer = None
+_lemmatizer_lock = Lock()
+
+def offline():
+    return os.environ.get("REPA_OFFLINE") == "1"
+
+def nltk_data_dirs():
+    dirs = [os.environ.get("REPA_NLTK_DATA"), NLTK_DATA_DIR]
+    return [d for d in dirs if d]
+
+def download_resources(download_dir = NLTK_DATA_DIR):
+    import nltk
+
+    os.makedirs(download_dir, exist_ok = True)
+    for package, _ in NLTK_RESOURCES:
+        if not nltk.download(package, download_dir = download_dir, quiet = True):
+            raise LookupError(f"Could not download the nltk resource '{package}' into {download_dir}")
+
+def get_lemmatizer():
+    global _lemmatizer
+    if _lemmatizer is not None:
+        return _lemmatizer
+
+    with _lemmatizer_lock:
+        if _lemmatizer is None:
+            import nltk
+            from nltk.stem import WordNetLemmatizer
+
+            for directory in reversed(nltk_data_dirs()):
+                if directory not in nltk.data.path:
+                    nltk.data.path.insert(0, directory)
+            try:
+                nltk.data.find("corpora/wordnet")
+            except LookupError:
+                if offline():
+                    raise LookupError(
+                        "WordNet corpus not found and REPA_OFFLINE=1. Copy an nltk_data directory to "
+                        f"{NLTK_DATA_DIR} or point REPA_NLTK_DATA at one "
+                        "(`python Import_data/topic_labels.py --download` on a connected machine)."
+                    )
+                download_resources()
+            _lemmatizer = WordNetLemmatizer()
+    return _lemmatizer
+
+@lru_cache(maxsize = None)
+def lemmatize_noun(word):
+    return get_lemmatizer().lemmatize(word, pos = 'n')
+
+@lru_cache(maxsize = None)
+def extract_topic(uri):
+    if isinstance(uri, str) and "topics/" in uri:
+        topics = uri.split("/")[-1]
+        topics = urllib.parse.unquote(topics)
+        topics = topics.lower()
+        topics = re.sub(r"\s*\([^)]*\)", "", topics)
+        topics = topics.replace("-", "").replace("_", " ")
+        topics = topics.strip().lower().strip(">")
+        topics = re.sub(r"\s+", " ", topics).strip()
+        return " ".join(lemmatize_noun(word) for word in topics.split())
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description = "Fetch the nltk corpora used to normalise topic labels.")
+    parser.add_argument("--download", action = "store_true", help = "Download the corpora into --dir")
+    parser.add_argument("--dir", default = NLTK_DATA_DIR)
+    args = parser.parse_args()
+    if args.download:
+        download_resources(args.dir)
+        print(f"nltk resources available in {args.dir}")
+    else:
+        os.environ["REPA_OFFLINE"] = "1"
+        get_lemmatizer()
+        print("WordNet corpus found locally.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Hierarchy roll-up of the topic profiles: every topic of an author
+# (author_topics) or a paper (corpus_topics) also counts for its CSO
+# ancestors, up to --depth levels above it. An ancestor reached at distance d
+# weighs decay**d, and the weights of all the profile's topics under it add
+# up, so an author with many papers in sub-areas of "machine learning" ranks
+# high for "machine learning" itself without ever being annotated with it.
+#
+# The CSO graph is the one parsed by CSOTopicImpactCalculator (the snapshot in
+# Output/cso_calculator.pkl when it is up to date). Only superTopicOf edges
+# are climbed: relatedEquivalent and contributesTo edges are in the same graph
+# but do not make a broader area. The ancestors of a topic are computed once,
+# the first time any profile meets it, and reused for every other profile.
+#
+# Results go to author_topic_rollup and corpus_topic_rollup:
+#   {"authorId": ..., "areas": [...], "topics": [{"topic", "weight", "distance", "sources"}]}
+# with a multikey index on areas, so "all authors in an area" is one index
+# lookup on {"areas": <topic>}.
+#
+# REPA_ROLLUP_DEPTH and REPA_ROLLUP_DECAY set the defaults of --depth and --decay.
+
+from collections import deque
+import argparse
+import logging
+import os
+import time
+
+from impact_un_topic import load_calculator
+from storage import get_storage
+from connection import configure_pool
+from index_plan import prepare_for_load, build_indexes
+from metrics import stage_metrics
+from profiling import phase, profile_mode, profiled
+from sampling import current_sample
+
+CSV_FILE = "Input/CSO.3.4.1.csv"
+SPECIFIC_TOPICS_FILE = "Output/specific_topics.txt"
+SNAPSHOT_FILE = "Output/cso_calculator.pkl"
+# profile -> (source collection, key field, destination collection)
+PROFILES = {
+    "author": ("author_topics", "authorId", "author_topic_rollup"),
+    "corpus": ("corpus_topics", "corpusId", "corpus_topic_rollup")
+}
+MAX_DEPTH = int(os.environ.get("REPA_ROLLUP_DEPTH", 3))
+DECAY = float(os.environ.get("REPA_ROLLUP_DECAY", 0.5))
+BATCH_SIZE = 1000
+WRITE_BATCH_SIZE = 1000
+WEIGHT_DIGITS = 4
+
+logging.basicConfig(
+    format = "%(asctime)s - [%(levelname)s] %(message)s",
+    level = logging.INFO
+)
+
+class AncestorTable:
+    def __init__(self, calculator, max_depth = MAX_DEPTH):
+        self.graph = calculator.graph
+        self.equivalents = calculator.equivalents
+        self.contributions = calculator.contributions
+        self.max_depth = max_depth
+        self.table = {}
+
+    def parents(self, topic):
+        for parent in self.graph.predecessors(topic):
+            if topic in self.equivalents.get(parent, ()) or topic in self.contributions.get(parent, ()):
+                continue
+            yield parent
+
+    def ancestors(self, topic):
+        # {ancestor: shortest distance}, the topic itself at distance 0.
+        # Topics outside the CSO graph roll up to nothing but themselves.
+        if topic not in self.table:
+            distances = {topic: 0}
+            if topic in self.graph:
+                frontier = deque([topic])
+                while frontier:
+                    current = frontier.popleft()
+                    distance = distances[current] + 1
+                    if distance > self.max_depth:
+                        continue
+                    for parent in self.parents(current):
+                        if parent not in distances:
+                            distances[parent] = distance
+                            frontier.append(parent)
+            self.table[topic] = distances
+        return self.table[topic]
+
+    def __len__(self):
+        return len(self.table)
+
+def rollup(topics, table, decay = DECAY):
+    weights = {}
+    for topic in {t.lower() for t in topics if t}:
+        for ancestor, distance in table.ancestors(topic).items():
+            entry = weights.get(ancestor)
+            if entry is None:
+                weights[ancestor] = [decay ** distance, distance, 1]
+            else:
+                entry[0] += decay ** distance
+                entry[1] = min(entry[1], distance)
+                entry[2] += 1
+    ranked = sorted(weights.items(), key = lambda item: (-item[1][0], item[1][1], item[0]))
+    return [
+        {"topic": topic, "weight": round(weight, WEIGHT_DIGITS), "distance": distance, "sources": sources}
+        for topic, (weight, distance, sources) in ranked
+    ]
+
+def rollup_profiles(storage, profile, table, decay = DECAY):
+    source, key_field, destination = PROFILES[profile]
+    storage.drop(destination)
+    prepare_for_load(storage, destination)
+    reader = storage.reader(source, projection = {"_id": 0, key_field: 1, "topics": 1}, batch_size = BATCH_SIZE)
+    total = 0
+    for batch in reader.batches():
+        docs = []
+        for doc in batch:
+            if doc.get(key_field) is None:
+                continue
+            topics = rollup(doc.get("topics") or [], table, decay)
+            docs.append({key_field: doc[key_field], "areas": [t["topic"] for t in topics], "topics": topics})
+        for start in range(0, len(docs), WRITE_BATCH_SIZE):
+            storage.insert_many(destination, docs[start:start + WRITE_BATCH_SIZE])
+        total += len(docs)
+    build_indexes(storage, destination)
+    logging.info(f"[{destination}] {total:,} profiles rolled up, {len(table):,} distinct topics expanded")
+
+def run(storage, profiles = tuple(PROFILES), max_depth = MAX_DEPTH, decay = DECAY,
+        csv_file = CSV_FILE, specific_topics_file = SPECIFIC_TOPICS_FILE, snapshot = SNAPSHOT_FILE):
+    start_time = time.time()
+    metrics = stage_metrics("topic_rollup")
+    configure_pool()
+
+    with phase("load"):
+        calculator = load_calculator(csv_file, specific_topics_file, snapshot_path = snapshot)
+    # One table for both profiles: authors and papers share most topics.
+    table = AncestorTable(calculator, max_depth)
+    for profile in profiles:
+        with phase(profile):
+            rollup_profiles(storage, profile, table, decay)
+    metrics.set("rollup_topics", len(table))
+    metrics.close()
+    logging.info(f"Topic roll-up (depth {max_depth}, decay {decay}) done in "
+                 f"{round(time.time() - start_time, 2)} seconds.")
+
+def main(storage, mode):
+    parser = argparse.ArgumentParser(description = "Roll author and corpus topic profiles up the CSO hierarchy.")
+    parser.add_argument("--profiles", nargs = "+", choices = sorted(PROFILES), default = sorted(PROFILES))
+    parser.add_argument("--depth", type = int, default = MAX_DEPTH, help = "Levels of ancestors added per topic")
+    parser.add_argument("--decay", type = float, default = DECAY, help = "Weight factor per level")
+    parser.add_argument("--csv", default = CSV_FILE)
+    parser.add_argument("--specific-topics", default = SPECIFIC_TOPICS_FILE)
+    parser.add_argument("--snapshot", default = SNAPSHOT_FILE)
+    args = parser.parse_args()
+    with profiled("topic_rollup", mode):
+        run(storage, args.profiles, args.depth, args.decay, args.csv, args.specific_topics, args.snapshot)
+
+if __name__ == "__main__":
+    mode = profile_mode()
+    current_sample()
+    storage = get_storage()
+    try:
+        main(storage, mode)
+    finally:
+        storage.close()
@@ -0,0 +1,173 @@
+const express = require("express");
+const axios = require("axios");
+const router = express.Router();
+
+const IMPACT_SERVICE_URL = process.env.IMPACT_SERVICE_URL || "http://localhost:8001";
+
+// The service's own answers (400 on an invalid request, 404...) are passed
+// through; 503/502 only mean the service could not be reached or answered
+// with something unusable.
+function sendServiceError(res, err, what) {
+    if (err.response) {
+        return res.status(err.response.status).json(err.response.data);
+    }
+    console.error(`Error fetching ${what}:`, err.message);
+    if (err.request) {
+        return res.status(503).json({ error: "Impact service unavailable" });
+    }
+    res.status(502).json({ error: "Invalid response from impact service" });
+}
+
+/**
+ * @swagger
+ * /impact/topics:
+ *     post:
+ *         tags:
+ *             - Topic impact
+ *         summary: Get the impact factor of a list of topics
+ *         requestBody:
+ *             required: true
+ *             content:
+ *                 application/json:
+ *                     schema:
+ *                         type: object
+ *                         properties:
+ *                             topics:
+ *                                 type: array
+ *                                 items:
+ *                                     type: string
+ *         responses:
+ *             200:
+ *                 description: Impact factor of each topic
+ *             400:
+ *                 description: Invalid request, as reported by the impact service
+ *             502:
+ *                 description: Invalid response from the impact service
+ *             503:
+ *                 description: Impact service unreachable
+ */
+
+router.post("/topics", async (req, res) => {
+    try {
+        const { data } = await axios.post(`${IMPACT_SERVICE_URL}/impact`, { topics: req.body.topics || [] });
+        res.json(data.results);
+    } catch (err) {
+        sendServiceError(res, err, "topic impact");
+    }
+});
+
+/**
+ * @swagger
+ * /impact/groups:
+ *     post:
+ *         tags:
+ *             - Topic impact
+ *         summary: Get the impact factor of groups of topics
+ *         requestBody:
+ *             required: true
+ *             content:
+ *                 application/json:
+ *                     schema:
+ *                         type: object
+ *                         properties:
+ *                             groups:
+ *                                 type: array
+ *                                 items:
+ *                                     type: array
+ *                                     items:
+ *                                         type: string
+ *         responses:
+ *             200:
+ *                 description: Impact factor of each group
+ *             400:
+ *                 description: Invalid request, as reported by the impact service
+ *             502:
+ *                 description: Invalid response from the impact service
+ *             503:
+ *                 description: Impact service unreachable
+ */
+
+router.post("/groups", async (req, res) => {
+    try {
+        const { data } = await axios.post(`${IMPACT_SERVICE_URL}/group_impact`, { groups: req.body.groups || [] });
+        res.json(data.results);
+    } catch (err) {
+        sendServiceError(res, err, "group impact");
+    }
+});
+
+/**
+ * @swagger
+ * /impact/similar/{topic}:
+ *     get:
+ *         tags:
+ *             - Topic impact
+ *         summary: Get the topics most similar to a topic
+ *         parameters:
+ *             - in: path
+ *               name: topic
+ *               required: true
+ *               schema:
+ *                   type: string
+ *             - in: query
+ *               name: k
+ *               schema:
+ *                   type: integer
+ *                   default: 10
+ *             - in: query
+ *               name: min_sim
+ *               schema:
+ *                   type: number
+ *                   default: 0
+ *         responses:
+ *             200:
+ *                 description: List of similar topics with their Lin similarity
+ *             400:
+ *                 description: Invalid request, as reported by the impact service
+ *             502:
+ *                 description: Invalid response from the impact service
+ *             503:
+ *                 description: Impact service unreachable
+ */
+
+router.get("/similar/:topic", async (req, res) => {
+    try {
+        const k = parseInt(req.query.k) > 0 ? parseInt(req.query.k) : 10;
+        const minSim = parseFloat(req.query.min_sim) || 0;
+        const { data } = await axios.post(`${IMPACT_SERVICE_URL}/most_similar`, {
+            topics: [req.params.topic],
+            k,
+            min_sim: minSim
+        });
+        res.json(data.results[0]);
+    } catch (err) {
+        sendServiceError(res, err, "similar topics");
+    }
+});
+
+/**
+ * @swagger
+ * /impact/stats:
+ *     get:
+ *         tags:
+ *             - Topic impact
+ *         summary: Get latency percentiles and batch sizes of the impact service
+ *         responses:
+ *             200:
+ *                 description: Impact service statistics
+ *             502:
+ *                 description: Invalid response from the impact service
+ *             503:
+ *                 description: Impact service unreachable
+ */
+
+router.get("/stats", async (req, res) => {
+    try {
+        const { data } = await axios.get(`${IMPACT_SERVICE_URL}/stats`);
+        res.json(data);
+    } catch (err) {
+        sendServiceError(res, err, "impact service stats");
+    }
+});
+
+module.exports = router;
@@ -0,0 +1,110 @@
+const express = require("express");
+const router = express.Router();
+const { getDB } = require("../db");
+
+/**
+ * @swagger
+ * /paper_impact/ranking:
+ *     get:
+ *         tags:
+ *             - Paper impact
+ *         summary: Get papers ranked by the impact factor of their topics
+ *         parameters:
+ *             - in: query
+ *               name: page
+ *               schema:
+ *                   type: integer
+ *                   default: 1
+ *             - in: query
+ *               name: limit
+ *               schema:
+ *                   type: integer
+ *                   default: 100
+ *         responses:
+ *             200:
+ *                 description: Papers sorted by impact factor
+ *                 content:
+ *                     application/json:
+ *                         schema:
+ *                             type: object
+ *                             properties:
+ *                                 corpusid:
+ *                                     type: int
+ *                                     example: 66
+ *                                 title:
+ *                                     type: string
+ *                                     example: Machine Learning
+ *                                 impact_factor:
+ *                                     type: number
+ *                                     example: 0.42
+ */
+
+router.get("/ranking", async (req, res) => {
+    try {
+        const db = getDB();
+        const page = parseInt(req.query.page) || 1;
+        const limit = parseInt(req.query.limit) || 100;
+        const skip = (page - 1) * limit;
+
+        const cursor = db.collection("paper_impact")
+            .find({}, { projection: { _id: 0, corpusid: 1, title: 1, year: 1, topics: 1, impact_factor: 1 } })
+            .sort({ impact_factor: -1 })
+            .skip(skip)
+            .limit(limit);
+
+        const papers = await cursor.toArray();
+        const total = await db.collection("paper_impact").estimatedDocumentCount();
+
+        res.json({
+            page,
+            limit,
+            totalPages: Math.ceil(total / limit),
+            totalResults: total,
+            results: papers
+        });
+    } catch (err) {
+        console.error("Error fetching paper impact ranking:", err);
+        res.status(500).json({ error: "Internal server error" });
+    }
+});
+
+/**
+ * @swagger
+ * /paper_impact/{corpus_id}:
+ *     get:
+ *         tags:
+ *             - Paper impact
+ *         summary: Get the impact scores of a paper
+ *         parameters:
+ *             - in: path
+ *               name: corpus_id
+ *               required: true
+ *               schema:
+ *                   type: string
+ *               description: The corpus ID of the paper
+ *         responses:
+ *             200:
+ *                 description: Impact factor, depth, influence and semantic scores of the paper
+ *             404:
+ *                 description: Not found
+ */
+
+router.get("/:corpus_id", async (req, res) => {
+    try {
+        const db = getDB();
+        const corpusId = parseInt(req.params.corpus_id, 10);
+        const impact = await db.collection("paper_impact")
+            .findOne({ corpusid: corpusId }, { projection: { _id: 0 } });
+
+        if (impact) {
+            res.json(impact);
+        } else {
+            res.status(404).json({ error: "No impact score found for the given corpus ID" });
+        }
+    } catch (err) {
+        console.error("Error fetching paper impact:", err);
+        res.status(500).json({ error: "Internal server error" });
+    }
+});
+
+module.exports = router;
\ No newline at end of file